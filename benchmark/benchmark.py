@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+import numpy as np
+from mendelianPea.pea.pea import Pea
+from mendelianPea.pea.population import PeaPopulation
+from mendelianPea.simulate.simulate import Simulate
+
+ADVANTAGE = {"y": 0.1, "G": 0.1, "w": 0.1, "R": 0.1}
+BASE_SURVIVAL = 0.4
+
+DEFAULT_SIZES = [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+DEFAULT_CHILDREN = [2, 4]
+# The DataFrame engine is quadratic in the population size, larger sizes are skipped for it
+DEFAULT_MAX_DATAFRAME_SIZE = 10 ** 3
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that must not import pandas, it is only needed for DataFrame results and the DataFrame engine
+CORE_MODULES = ["mendelianPea.simulate.simulate", "mendelianPea.simulate.engine", "mendelianPea.pea.genome"]
+
+
+class BenchmarkResult(object):
+    """
+    Timing of one benchmark case
+    """
+
+    def __init__(self, name, engine=None, size=None, children=None, seconds=0.0, peas=0, peak_memory=0):
+        """
+        :param name (str): timed function
+        :param engine (str): engine mode, None for the engine independent functions
+        :param size (int): population size
+        :param children (int): no_of_children
+        :param seconds (float): best time of one call
+        :param peas (int): number of peas processed by one call
+        :param peak_memory (int): peak memory traced during one call, in bytes
+        """
+        self.name = name
+        self.engine = engine
+        self.size = size
+        self.children = children
+        self.seconds = seconds
+        self.peas = peas
+        self.peak_memory = peak_memory
+
+    @property
+    def key(self):
+        return "{}|{}|{}|{}".format(self.name, self.engine, self.size, self.children)
+
+    @property
+    def peas_per_sec(self):
+        return self.peas / self.seconds if self.seconds > 0 else float("inf")
+
+    def to_dict(self):
+        return {"name": self.name, "engine": self.engine, "size": self.size, "children": self.children,
+                "seconds": self.seconds, "peas": self.peas, "peas_per_sec": self.peas_per_sec,
+                "peak_memory": self.peak_memory}
+
+    def __str__(self):
+        return "{:<34} {:>10} {:>8} {:>3} {:>12.6f}s {:>14.0f} peas/s {:>10.1f} KiB".format(
+            self.name, str(self.engine), str(self.size), str(self.children), self.seconds, self.peas_per_sec,
+            self.peak_memory / 1024)
+
+
+def measure(name, func, peas, repeat=3, min_time=0.2, setup=None, **kwargs):
+    """
+    Times func, keeping the best of at least repeat runs lasting min_time in total, then measures its peak memory
+    in one more traced run
+    :param name (str): timed function
+    :param func: function to time, called with the result of setup
+    :param peas (int): number of peas processed by one call
+    :param repeat (int): minimum number of timed runs
+    :param min_time (float): minimum total time of the timed runs, in seconds
+    :param setup: function preparing the argument of func, not timed
+    :param kwargs: engine, size and children of the case
+    :return (BenchmarkResult):
+    """
+    best = float("inf")
+    runs, total = 0, 0.0
+    while runs < repeat or total < min_time:
+        arg = setup() if setup is not None else None
+        t1 = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - t1
+        best = min(best, elapsed)
+        runs, total = runs + 1, total + elapsed
+
+    arg = setup() if setup is not None else None
+    tracemalloc.start()
+    func(arg)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return BenchmarkResult(name, seconds=best, peas=peas, peak_memory=peak_memory, **kwargs)
+
+
+def _simulation(engine, size, children):
+    """
+    :return (Simulate): simulation of heterozygotes ready to run its first generation
+    """
+    population = PeaPopulation.from_peas([Pea.get_hetrozygote()])
+    generation0 = PeaPopulation.from_codes(np.repeat(population.color, size), np.repeat(population.shape, size))
+    sim = Simulate(generation0=generation0, no_of_generations=1, no_of_children=children,
+                   base_survival=BASE_SURVIVAL, advantage=ADVANTAGE, engine=engine)
+    sim._init_data()
+    return sim
+
+
+def bench_pea(calls=10 ** 5):
+    """
+    :return (list): BenchmarkResult of Pea.__init__ and Pea.spawn
+    """
+    Pea.set_advantage(ADVANTAGE)
+    Pea.set_base_survival(BASE_SURVIVAL)
+    parent1, parent2 = Pea.get_hetrozygote(), Pea.get_dominant_homozygote()
+
+    def init(_):
+        for _ in range(calls):
+            Pea(**{"color": "Gy", "shape": "wR"})
+
+    def spawn(_):
+        for _ in range(calls):
+            Pea.spawn(parent1, parent2)
+
+    return [measure("Pea.__init__", init, calls), measure("Pea.spawn", spawn, calls)]
+
+
+def bench_spawn_peas(children_values, calls=10 ** 3):
+    """
+    :return (list): BenchmarkResult of Simulate.spawn_peas, which only the DataFrame engine uses
+    """
+    results = []
+    for children in children_values:
+        sim = _simulation(Simulate.DATAFRAME_ENGINE, 2, children)
+        parent1, parent2 = Pea.get_hetrozygote(), Pea.get_hetrozygote()
+
+        def spawn_peas(_):
+            for _ in range(calls):
+                sim.spawn_peas(parent1, parent2)
+
+        results.append(measure("Simulate.spawn_peas", spawn_peas, calls * children,
+                               engine=Simulate.DATAFRAME_ENGINE, children=children))
+    return results
+
+
+def bench_generation(engines, sizes, children_values, max_dataframe_size=DEFAULT_MAX_DATAFRAME_SIZE):
+    """
+    :return (list): BenchmarkResult of Simulate.get_next_generation and Simulate.get_cur_generation_stats
+    """
+    results = []
+    for engine in engines:
+        for size in sizes:
+            if engine == Simulate.DATAFRAME_ENGINE and size > max_dataframe_size:
+                continue
+            for children in children_values:
+                sim = _simulation(engine, size, children)
+                results.append(measure("Simulate.get_next_generation",
+                                       lambda _: sim.get_next_generation(sim.generation0), size,
+                                       engine=engine, size=size, children=children))
+            results.append(measure("Simulate.get_cur_generation_stats", lambda _: sim.get_cur_generation_stats(),
+                                   size, engine=engine, size=size))
+    return results
+
+
+def bench_save_xls(engines, iterations=5, generations=5):
+    """
+    :return (list): BenchmarkResult of Simulate.save_xls, skipped when no Excel writer is installed
+    """
+    results = []
+    for engine in engines:
+        sim = _simulation(engine, 20, 4)
+        sim.no_of_generations = generations
+        with contextlib.redirect_stdout(None):
+            sim.run_iterations(iterations, seed=0)
+        rows = sum(len(df) for df in sim.generation_results) + len(sim.iteration_results)
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                results.append(measure("Simulate.save_xls", lambda _: sim.save_xls(os.path.join(tmp, "b.xlsx")),
+                                       rows, engine=engine))
+            except ImportError as e:
+                print("Skipping Simulate.save_xls: {}".format(e))
+                return []
+    return results
+
+
+def _cold_start(args, repeat):
+    """
+    :param args (list): arguments of a fresh interpreter
+    :param repeat (int): number of runs
+    :return (float): best wall time of the runs
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(PACKAGE_DIR)] +
+                                                       [p for p in [os.environ.get("PYTHONPATH")] if p]))
+    best = float("inf")
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env, stdout=subprocess.DEVNULL, check=True)
+        best = min(best, time.perf_counter() - t1)
+    return best
+
+
+def bench_import(repeat=5):
+    """
+    Times the cold start of a fresh interpreter importing the simulation core and running run.py --version, the
+    start time of an empty interpreter is subtracted. Warns when the core imports pandas.
+    :return (list): BenchmarkResult of every cold start
+    """
+    empty = _cold_start(["-c", "pass"], repeat)
+    results = [BenchmarkResult("import " + module, seconds=_cold_start(["-c", "import " + module], repeat) - empty,
+                               peas=1) for module in CORE_MODULES]
+    results.append(BenchmarkResult("run.py --version",
+                                   seconds=_cold_start([os.path.join(PACKAGE_DIR, "run.py"), "--version"], repeat) -
+                                   empty, peas=1))
+    check = "import sys, {}; sys.exit('pandas' in sys.modules)".format(", ".join(CORE_MODULES))
+    try:
+        _cold_start(["-c", check], 1)
+    except subprocess.CalledProcessError:
+        print("WARNING the simulation core imports pandas")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results (list): BenchmarkResult of this run
+    :param baseline (dict): saved results, as written by save_results
+    :param tolerance (float): allowed relative slow down before a case is flagged
+    :return (list): (result, baseline peas/sec) of the regressed cases
+    """
+    saved = {"{}|{}|{}|{}".format(r["name"], r["engine"], r["size"], r["children"]): r
+             for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        if result.key in saved and result.peas_per_sec < saved[result.key]["peas_per_sec"] * (1 - tolerance):
+            regressions.append((result, saved[result.key]["peas_per_sec"]))
+    return regressions
+
+
+def save_results(results, file_path):
+    """
+    Writes the results as JSON, along with the environment they were measured in
+    :return:
+    """
+    with open(file_path, "w") as f:
+        json.dump({"meta": {"python": sys.version, "numpy": np.__version__, "platform": platform.platform(),
+                            "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+                   "results": [r.to_dict() for r in results]}, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mendelian Pea Simulator benchmarks.')
+    parser.add_argument('-o', '--output', type=str, default=None, dest='output',
+                        help='Json file to save the results to')
+    parser.add_argument('-b', '--baseline', type=str, default=None, dest='baseline',
+                        help='Json results of a previous run to compare against')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1, dest='tolerance',
+                        help='Relative slow down allowed before a case is flagged as a regression')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, dest='sizes',
+                        help='Population sizes to sweep')
+    parser.add_argument('--children', type=int, nargs='+', default=DEFAULT_CHILDREN, dest='children',
+                        help='no_of_children values to sweep')
+    parser.add_argument('--engines', type=str, nargs='+', default=list(Simulate.ENGINES), dest='engines',
+                        help='Engine modes to sweep')
+    parser.add_argument('--max-dataframe-size', type=int, default=DEFAULT_MAX_DATAFRAME_SIZE,
+                        dest='max_dataframe_size', help='Largest population size run with the DataFrame engine')
+    parser.add_argument('--imports-only', action='store_true', dest='imports_only',
+                        help='Only time the cold start imports')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    results = bench_import()
+    if not args.imports_only:
+        results += bench_pea()
+        if Simulate.DATAFRAME_ENGINE in args.engines:
+            results += bench_spawn_peas(args.children)
+        results += bench_generation(args.engines, args.sizes, args.children, args.max_dataframe_size)
+        results += bench_save_xls(args.engines)
+    for result in results:
+        print(result)
+
+    if args.output:
+        save_results(results, args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, baseline_rate in regressions:
+            print("REGRESSION {} : {:.0f} peas/s, baseline {:.0f} peas/s".format(result.key, result.peas_per_sec,
+                                                                                 baseline_rate))
+        if regressions:
+            sys.exit(1)
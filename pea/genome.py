@@ -0,0 +1,244 @@
+import numpy as np
+from mendelianPea.pea.pea import Pea, ColorGene, ShapeGene
+
+# A genome packs the 2 bit code of every locus, see pea.population, into uint64 words: locus l is stored in
+# bits 2 * (l % 32) and 2 * (l % 32) + 1 of word l // 32
+LOCI_PER_WORD = 32
+# Bit 0 of every locus of a word
+FIRST_ALLELE_BITS = np.uint64(0x5555555555555555)
+
+COMPLETE_DOMINANCE = "complete"
+ADDITIVE = "additive"
+DOMINANCES = (COMPLETE_DOMINANCE, ADDITIVE)
+
+# Number of recessive alleles of every 2 bit code
+_CODE_TO_CLASS = np.array([0, 1, 1, 2])
+
+
+class InvalidGenome(Exception):
+    """
+    Exception class for an invalid genome definition
+    """
+    pass
+
+
+class Locus(object):
+    """
+    A locus with a dominant and a recessive allele, each one with its survival advantage
+    """
+
+    def __init__(self, name, alleles, dominance=COMPLETE_DOMINANCE, advantage=None):
+        """
+        :param name (str): name of the locus
+        :param alleles (list): dominant and recessive allele names
+        :param dominance (str): "complete", the heterozygote gets the advantage of the dominant allele, or
+                                "additive", it gets the mean of both advantages
+        :param advantage (dict): survival advantage of every allele, 0 for the missing ones
+        """
+        if len(alleles) != 2 or alleles[0] == alleles[1]:
+            raise InvalidGenome("Locus {} needs two distinct alleles, got {}".format(name, alleles))
+        if dominance not in DOMINANCES:
+            raise InvalidGenome("Not a valid dominance {} for locus {}, expected one of {}".format(
+                dominance, name, list(DOMINANCES)))
+        self.name = name
+        self.alleles = tuple(alleles)
+        self.dominance = dominance
+        self.advantage = dict(advantage) if advantage is not None else {}
+
+    def contributions(self):
+        """
+        :return (ndarray): survival advantage of the dominant homozygote, the heterozygote and the recessive
+                           homozygote
+        """
+        dominant = self.advantage.get(self.alleles[0], 0)
+        recessive = self.advantage.get(self.alleles[1], 0)
+        heterozygote = dominant if self.dominance == COMPLETE_DOMINANCE else (dominant + recessive) / 2
+        return np.array([dominant, heterozygote, recessive], dtype=float)
+
+
+class Genome(object):
+    """
+    Ordered list of loci. The survival chance of a pea is the base survival plus the advantage of every locus,
+    clipped to [0, 1].
+    """
+
+    def __init__(self, loci):
+        """
+        :param loci (list): Locus of the genome
+        """
+        if len(loci) == 0:
+            raise InvalidGenome("A genome needs at least one locus")
+        names = [locus.name for locus in loci]
+        if len(set(names)) != len(names):
+            raise InvalidGenome("Locus names must be unique, got {}".format(names))
+        self.loci = list(loci)
+        self.no_of_words = (len(self.loci) + LOCI_PER_WORD - 1) // LOCI_PER_WORD
+        self._survival_lookup = {}
+
+    def __len__(self):
+        return len(self.loci)
+
+    @property
+    def names(self):
+        return [locus.name for locus in self.loci]
+
+    @classmethod
+    def default(cls, advantage=None):
+        """
+        :param advantage (dict): survival advantage of every allele, as in the "advantage" config key
+        :return (Genome): the two locus pea genome, color then shape
+        """
+        advantage = advantage if advantage is not None else {}
+        return cls([Locus("color", (ColorGene.GREEN.value, ColorGene.YELLOW.value), advantage=advantage),
+                    Locus("shape", (ShapeGene.ROUND.value, ShapeGene.WRINKLED.value), advantage=advantage)])
+
+    @classmethod
+    def from_config(cls, config, advantage=None):
+        """
+        Builds a genome from the "genome" config key, a list of loci like
+        {"name": "color", "alleles": ["G", "y"], "dominance": "complete", "advantage": {"G": 0.1, "y": 0.1}}.
+        A locus with a "count" is repeated count times, its copies named name_0, name_1, ...
+        :param config (dict): {"loci": [...]}, the default genome if None
+        :param advantage (dict): advantage of the default genome
+        :return (Genome):
+        """
+        if config is None:
+            return cls.default(advantage)
+        loci = []
+        for entry in config.get("loci", []):
+            names = [entry.get("name")] if entry.get("count") is None else \
+                ["{}_{}".format(entry.get("name"), n) for n in range(entry["count"])]
+            for name in names:
+                loci.append(Locus(name, entry.get("alleles", ()), entry.get("dominance", COMPLETE_DOMINANCE),
+                                  entry.get("advantage")))
+        return cls(loci)
+
+    def survival_lookup(self, base_survival):
+        """
+        Splits the survival advantage by genome byte, every byte holding 4 loci
+        :param base_survival (float): base survival chance
+        :return (ndarray): (no_of_words * 8, 256) advantage of every value of every byte, the base survival added
+                           to byte 0
+        """
+        lookup = self._survival_lookup.get(base_survival)
+        if lookup is None:
+            values = np.arange(256)
+            lookup = np.zeros((self.no_of_words * 8, 256))
+            for l, locus in enumerate(self.loci):
+                lookup[l // 4] += locus.contributions()[_CODE_TO_CLASS[(values >> (2 * (l % 4))) & 3]]
+            lookup[0] += base_survival
+            self._survival_lookup[base_survival] = lookup
+        return lookup
+
+    def survival(self, words, base_survival):
+        """
+        :param words (ndarray): (n, no_of_words) packed genomes
+        :param base_survival (float): base survival chance
+        :return (ndarray): survival chance of every genome
+        """
+        lookup = self.survival_lookup(base_survival)
+        genome_bytes = np.ascontiguousarray(words).view(np.uint8)
+        survival = np.zeros(len(words))
+        for b in range(genome_bytes.shape[1]):
+            survival += lookup[b, genome_bytes[:, b]]
+        return np.clip(survival, 0, 1)
+
+    def uniform(self, code, n):
+        """
+        :param code (int): 2 bit code given to every locus
+        :param n (int): number of genomes
+        :return (ndarray): (n, no_of_words) packed genomes
+        """
+        words = np.zeros((n, self.no_of_words), dtype=np.uint64)
+        for l in range(len(self.loci)):
+            words[:, l // LOCI_PER_WORD] |= np.uint64(code << (2 * (l % LOCI_PER_WORD)))
+        return words
+
+    def pack(self, codes):
+        """
+        :param codes (ndarray): (n, len(loci)) 2 bit code of every locus of every pea
+        :return (ndarray): (n, no_of_words) packed genomes
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        words = np.zeros((len(codes), self.no_of_words), dtype=np.uint64)
+        for l in range(len(self.loci)):
+            words[:, l // LOCI_PER_WORD] |= codes[:, l] << np.uint64(2 * (l % LOCI_PER_WORD))
+        return words
+
+    def locus_counts(self, words, chunk_size=1 << 16):
+        """
+        Counts the genotypes of every locus, unpacking the genomes chunk by chunk
+        :param words (ndarray): (n, no_of_words) packed genomes
+        :param chunk_size (int): number of genomes unpacked at once
+        :return (ndarray): (len(loci), 3) number of dominant homozygotes, heterozygotes and recessive homozygotes
+        """
+        no_of_loci = len(self.loci)
+        heterozygotes = np.zeros(self.no_of_words * LOCI_PER_WORD, dtype=np.int64)
+        recessive = np.zeros(self.no_of_words * LOCI_PER_WORD, dtype=np.int64)
+        for start in range(0, len(words), chunk_size):
+            chunk = words[start:start + chunk_size]
+            first = chunk & FIRST_ALLELE_BITS
+            second = (chunk >> np.uint64(1)) & FIRST_ALLELE_BITS
+            # After the unpacking locus l is at bit 2 * l
+            het_bits = np.unpackbits(np.ascontiguousarray(first ^ second).view(np.uint8), axis=1, bitorder="little")
+            rec_bits = np.unpackbits(np.ascontiguousarray(first & second).view(np.uint8), axis=1, bitorder="little")
+            heterozygotes += het_bits[:, 0::2].sum(axis=0, dtype=np.int64)
+            recessive += rec_bits[:, 0::2].sum(axis=0, dtype=np.int64)
+        counts = np.empty((no_of_loci, 3), dtype=np.int64)
+        counts[:, 1] = heterozygotes[:no_of_loci]
+        counts[:, 2] = recessive[:no_of_loci]
+        counts[:, 0] = len(words) - counts[:, 1] - counts[:, 2]
+        return counts
+
+
+def gametes(words, rng):
+    """
+    Picks one allele of every locus of every genome at random
+    :param words (ndarray): (n, no_of_words) packed genomes
+    :param rng (numpy Generator):
+    :return (ndarray): (n, no_of_words) the picked allele of every locus in its bit 0
+    """
+    picks = rng.integers(0, np.iinfo(np.uint64).max, size=words.shape, dtype=np.uint64, endpoint=True) & \
+        FIRST_ALLELE_BITS
+    return ((words & ~picks) | ((words >> np.uint64(1)) & picks)) & FIRST_ALLELE_BITS
+
+
+class GenomePopulation(object):
+    """
+    A population of peas stored as one row of packed genome words per pea
+    """
+
+    def __init__(self, words, genome):
+        """
+        :param words (ndarray): (n, genome.no_of_words) uint64 packed genomes
+        :param genome (Genome): genome definition
+        """
+        self.words = words
+        self.genome = genome
+
+    @classmethod
+    def from_classes(cls, genome, dominant=0, heterozygote=0, recessive=0):
+        """
+        :param genome (Genome): genome definition
+        :param dominant (int): number of peas dominant homozygote at every locus
+        :param heterozygote (int): number of peas heterozygote at every locus
+        :param recessive (int): number of peas recessive homozygote at every locus
+        :return (GenomePopulation):
+        """
+        return cls(np.concatenate((genome.uniform(0, dominant), genome.uniform(1, heterozygote),
+                                   genome.uniform(3, recessive))), genome)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, item):
+        return GenomePopulation(self.words[item], self.genome)
+
+    def survival(self, base_survival=None):
+        """
+        :param base_survival (float): base survival chance, Pea.BASE_SURVIVAL_CHANCE if not supplied
+        :return (ndarray): survival chance of every pea
+        """
+        if base_survival is None:
+            base_survival = Pea.BASE_SURVIVAL_CHANCE
+        return self.genome.survival(self.words, base_survival)
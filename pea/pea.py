@@ -1,3 +1,5 @@
+import random
+from collections import namedtuple
 from enum import Enum
 
 
@@ -38,15 +40,38 @@ class InvalidBaseSurvival(Exception):
     pass
 
 
+GenotypeInfo = namedtuple("GenotypeInfo", ["survival", "active_color_gene", "active_shape_gene", "description",
+                                           "color_dominant_homozygote", "color_recessive_homozygote",
+                                           "color_hetrozygote", "shape_dominant_homozygote",
+                                           "shape_recessive_homozygote", "shape_hetrozygote"])
+
+
+class _GenotypeTable(dict):
+    """
+    Maps a (color gene, shape gene) pair to its GenotypeInfo, computing missing entries on first use
+    """
+
+    def __missing__(self, genotype):
+        info = Pea._get_genotype_info(*genotype)
+        self[genotype] = info
+        return info
+
+
 class Pea(object):
     """
     Pea class
 
+    Peas are interned: creating a Pea with the genes and status of an existing one returns that same instance, so a
+    Pea is immutable. kill returns the dead Pea of the same genes instead of changing the status of a shared instance.
+    Everything derived from the genes is looked up in a table shared by all peas, which is rebuilt whenever
+    set_advantage or set_base_survival change the survival chances.
+
     Attributes:
         VALID_SHAPE_GENES (str): List of valid shpaes for a Pea.
         BASE_SURVIVAL_CHANCE (float): Assigning a starting constant survival probability for a Pea.
         ADVANTAGE (dict) : Initialising survival probabilities based on gene variation
     """
+    __slots__ = ("_color_gene", "_shape_gene", "_genotype", "_is_alive", "_children")
 
     VALID_SHAPE_GENES = [i.value for i in ShapeGene]
     BASE_SURVIVAL_CHANCE = 0.4
@@ -58,30 +83,68 @@ class Pea(object):
                         ShapeGene.WRINKLED.value: ShapeGene.WRINKLED.name.capitalize(),
                         ShapeGene.ROUND.value: ShapeGene.ROUND.name.capitalize()}
 
-    def __init__(self, **kwargs):
+    _INTERNED = {}
+    _TABLE = _GenotypeTable()
+
+    def __new__(cls, **kwargs):
         """
-        Setting a new Pea instance
+        Returns the interned Pea instance for the genes
         :param kwargs: Selecting color, shape , status and calculating survival chance
         """
-        self._color_gene = kwargs.get("color")
-        self._shape_gene = kwargs.get("shape")
-        self._validate_genes()
+        color = kwargs.get("color")
+        shape = kwargs.get("shape")
+        is_alive = kwargs.get('is-alive', True)
+        pea = cls._INTERNED.get((color, shape, is_alive)) if isinstance(color, str) and isinstance(shape, str) \
+            else None
+        if pea is None:
+            color = cls._valid_gene(color, ColorGene)
+            shape = cls._valid_gene(shape, ShapeGene)
+            key = (color, shape, is_alive)
+            pea = cls._INTERNED.get(key)
+            if pea is None:
+                pea = super(Pea, cls).__new__(cls)
+                for name, value in (("_color_gene", color), ("_shape_gene", shape), ("_genotype", (color, shape)),
+                                    ("_is_alive", is_alive), ("_children", None)):
+                    object.__setattr__(pea, name, value)
+                # Fills the table entry now so invalid genes fail on creation
+                Pea._TABLE[pea._genotype]
+                cls._INTERNED[key] = pea
+        return pea
 
-        self.active_color_gene = self._get_active_color_gene()
-        self.active_shape_gene = self._get_active_shape_gene()
-        self._set_survival_chance()
-        self._set_description()
-        self.is_alive = kwargs.get('is-alive', True)
-
-    def _validate_genes(self):
+    def __init__(self, **kwargs):
         """
-        Input : a Pea
-        :return: Sets a color and and a shape for a it
+        Setting a new Pea instance, all the work is done once per genotype by __new__
+        :param kwargs: Selecting color, shape , status and calculating survival chance
         """
-        self._color_gene = self._valid_gene(self._color_gene, ColorGene)
-        self._shape_gene = self._valid_gene(self._shape_gene, ShapeGene)
+        pass
+
+    def __setattr__(self, name, value):
+        # Interned instances are shared by every pea of the same genes and status
+        if name == "is_alive":
+            raise AttributeError("Pea.is_alive can no longer be set as peas are shared, use pea = pea.kill() instead "
+                                 "of pea.is_alive = False")
+        if name != "_children":
+            raise AttributeError("Pea is immutable, use kill to get the dead Pea of the same genes")
+        object.__setattr__(self, name, value)
+
+    @property
+    def is_alive(self):
+        return self._is_alive
+
+    def kill(self):
+        """
+        :return (Pea): the dead Pea with the same genes
+        """
+        return Pea(**{"color": self._color_gene, "shape": self._shape_gene, "is-alive": False})
+
+    def __getnewargs_ex__(self):
+        return (), {"color": self._color_gene, "shape": self._shape_gene, "is-alive": self.is_alive}
 
-    def _valid_gene(self, gene, valid_values):
+    def __getstate__(self):
+        return None
+
+    @staticmethod
+    def _valid_gene(gene, valid_values):
         """
         Validating if the gene is valid
         :param gene: color and shape
@@ -104,43 +167,86 @@ class Pea(object):
             raise InvalidGene("Not a valid Gene {}".format(final_gene))
         return final_gene
 
-    def _set_survival_chance(self):
+    @staticmethod
+    def _get_genotype_info(color_gene, shape_gene):
         """
-        Setting survival chance for a Pea
-        :return: setting it up based on the color and shape
+        Computes everything derived from a pair of genes with the current survival settings
+        :param color_gene (str): color gene
+        :param shape_gene (str): shape gene
+        :return (GenotypeInfo):
         """
-        self.survival = Pea.BASE_SURVIVAL_CHANCE + \
-                        Pea.ADVANTAGE.get(self.active_color_gene, 0) + \
-                        Pea.ADVANTAGE.get(self.active_shape_gene, 0)
-
-        if self.survival > 1:
-            self.survival = 1
-        if self.survival < 0:
-            self.survival = 0
+        active_color_gene = Pea._get_active_gene(color_gene)
+        active_shape_gene = Pea._get_active_gene(shape_gene)
+
+        survival = Pea.BASE_SURVIVAL_CHANCE + \
+                   Pea.ADVANTAGE.get(active_color_gene, 0) + \
+                   Pea.ADVANTAGE.get(active_shape_gene, 0)
+        if survival > 1:
+            survival = 1
+        if survival < 0:
+            survival = 0
+
+        description = Pea.GENE_DESCRIPTION.get(active_color_gene) + " and " + \
+                      Pea.GENE_DESCRIPTION.get(active_shape_gene)
+
+        shape_dominant_homozygote = shape_gene == "RR"
+        shape_recessive_homozygote = active_shape_gene == ShapeGene.WRINKLED.value
+        return GenotypeInfo(survival=survival, active_color_gene=active_color_gene,
+                            active_shape_gene=active_shape_gene, description=description,
+                            color_dominant_homozygote=color_gene == "GG",
+                            color_recessive_homozygote=active_color_gene == ColorGene.YELLOW.value,
+                            color_hetrozygote=color_gene == "Gy" or color_gene == "yG",
+                            shape_dominant_homozygote=shape_dominant_homozygote,
+                            shape_recessive_homozygote=shape_recessive_homozygote,
+                            shape_hetrozygote=not (shape_dominant_homozygote or shape_recessive_homozygote))
 
-    def _set_description(self):
+    @classmethod
+    def _build_table(cls):
         """
-        Setting up description for a Pea to print it later
-        :return: None
+        Rebuilds the genotype table for every combination of valid genes
+        :return:
         """
-        self.description = Pea.GENE_DESCRIPTION.get(self._get_active_color_gene()) + " and " + \
-                           Pea.GENE_DESCRIPTION.get(self._get_active_shape_gene())
+        table = _GenotypeTable()
+        for c1 in ColorGene:
+            for c2 in ColorGene:
+                for s1 in ShapeGene:
+                    for s2 in ShapeGene:
+                        genotype = (c1.value + c2.value, s1.value + s2.value)
+                        table[genotype] = cls._get_genotype_info(*genotype)
+        Pea._TABLE = table
+
+    @property
+    def survival(self):
+        return Pea._TABLE[self._genotype].survival
+
+    @property
+    def active_color_gene(self):
+        return Pea._TABLE[self._genotype].active_color_gene
+
+    @property
+    def active_shape_gene(self):
+        return Pea._TABLE[self._genotype].active_shape_gene
+
+    @property
+    def description(self):
+        return Pea._TABLE[self._genotype].description
 
     def _get_active_color_gene(self):
         """
 
         :return: returns active  color for a gene. (it may be dominant or recessive gene based on the combination)
         """
-        return self._get_active_gene(self._color_gene)
+        return Pea._TABLE[self._genotype].active_color_gene
 
     def _get_active_shape_gene(self):
         """
 
         :return: returns ac active hape of a gene. (it may be dominant or recessive gene based on the combination)
         """
-        return self._get_active_gene(self._shape_gene)
+        return Pea._TABLE[self._genotype].active_shape_gene
 
-    def _get_active_gene(self, gene):
+    @staticmethod
+    def _get_active_gene(gene):
         """
         Checking if a gene is still alove
         :param gene:
@@ -159,22 +265,22 @@ class Pea(object):
         return active_gene
 
     def is_color_recessive_homozygote(self):
-        return self._get_active_color_gene() == ColorGene.YELLOW.value
+        return Pea._TABLE[self._genotype].color_recessive_homozygote
 
     def is_color_dominant_homozygote(self):
-        return self._color_gene == "GG"
+        return Pea._TABLE[self._genotype].color_dominant_homozygote
 
     def is_color_hetrozygote(self):
-        return self._color_gene == "Gy" or self._color_gene == "yG"
+        return Pea._TABLE[self._genotype].color_hetrozygote
 
     def is_shape_recessive_homozygote(self):
-        return self._get_active_shape_gene() == ShapeGene.WRINKLED.value
+        return Pea._TABLE[self._genotype].shape_recessive_homozygote
 
     def is_shape_dominant_homozygote(self):
-        return self._shape_gene == "RR"
+        return Pea._TABLE[self._genotype].shape_dominant_homozygote
 
     def is_shape_hetrozygote(self):
-        return not (self.is_shape_dominant_homozygote() or self.is_shape_recessive_homozygote())
+        return Pea._TABLE[self._genotype].shape_hetrozygote
 
     @classmethod
     def set_advantage(cls, advantage):
@@ -184,6 +290,7 @@ class Pea(object):
         :return:
         """
         Pea.ADVANTAGE = advantage
+        cls._build_table()
 
     @classmethod
     def set_base_survival(cls, base_survival):
@@ -194,6 +301,7 @@ class Pea(object):
         """
         if 0 <= base_survival <= 1:
             Pea.BASE_SURVIVAL_CHANCE = base_survival
+            cls._build_table()
         else:
             raise InvalidBaseSurvival("Since its a probability value , it should be between 0 and 1")
 
@@ -219,6 +327,22 @@ class Pea(object):
         """
         return  Pea(**{"color": [ColorGene.GREEN, ColorGene.YELLOW], "shape": [ShapeGene.WRINKLED, ShapeGene.ROUND]})
 
+    def _get_children(self, other):
+        """
+        :param other: the other parent
+        :return (tuple): the 16 possible children of the pair, indexed by 4 random bits choosing the allele taken
+                         from each parent for each gene
+        """
+        if self._children is None:
+            self._children = {}
+        children = self._children.get(other)
+        if children is None:
+            children = tuple(Pea(**{"color": self._color_gene[bits & 1] + other._color_gene[(bits >> 1) & 1],
+                                    "shape": self._shape_gene[(bits >> 2) & 1] + other._shape_gene[(bits >> 3) & 1]})
+                             for bits in range(16))
+            self._children[other] = children
+        return children
+
     @classmethod
     def spawn(cls, pea1, pea2):
         """
@@ -230,14 +354,7 @@ class Pea(object):
         if not pea1.is_alive or not pea2.is_alive:
             raise PeaNotAlive("Both Peas should be alive to spawn!")
 
-        import random
-        c1 = random.choices([char for char in pea1._color_gene])[0]
-        c2 = random.choices([char for char in pea2._color_gene])[0]
-
-        s1 = random.choices([char for char in pea1._shape_gene])[0]
-        s2 = random.choices([char for char in pea2._shape_gene])[0]
-        genome = {"color": c1 + c2, "shape": s1 + s2}
-        return Pea(**genome)
+        return pea1._get_children(pea2)[random.getrandbits(4)]
 
     def __str__(self):
         """
@@ -245,4 +362,3 @@ class Pea(object):
         :return: the prinatable version for the Pea class
         """
         return "{}{} : {} , {}".format(self._color_gene, self._shape_gene, self.survival, self.description)
-
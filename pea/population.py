@@ -0,0 +1,205 @@
+import numpy as np
+from mendelianPea.pea.pea import Pea, ColorGene, ShapeGene
+
+
+# A gene is stored as a 2 bit code: bit 0 is the first allele, bit 1 the second one.
+# A set bit means the recessive allele, so 0 is the dominant homozygote, 3 the recessive homozygote
+# and 1 / 2 are the two orderings of the heterozygote.
+DOMINANT_HOMOZYGOTE = 0
+RECESSIVE_HOMOZYGOTE = 3
+
+COLOR_ALLELES = (ColorGene.GREEN.value, ColorGene.YELLOW.value)
+SHAPE_ALLELES = (ShapeGene.ROUND.value, ShapeGene.WRINKLED.value)
+
+COLOR = 0
+SHAPE = 1
+
+_IS_DOMINANT_HOMOZYGOTE = np.array([True, False, False, False])
+_IS_RECESSIVE_HOMOZYGOTE = np.array([False, False, False, True])
+_IS_HETROZYGOTE = np.array([False, True, True, False])
+
+
+def gene_to_code(gene, alleles):
+    """
+    Converts a two character gene string to its 2 bit code
+    :param gene (str): gene string like "Gy"
+    :param alleles (tuple): (dominant, recessive) allele characters
+    :return (int): code of the gene
+    """
+    return alleles.index(gene[0]) | (alleles.index(gene[1]) << 1)
+
+
+def code_to_gene(code, alleles):
+    """
+    Converts a 2 bit code back to its two character gene string
+    :param code (int): code of the gene
+    :param alleles (tuple): (dominant, recessive) allele characters
+    :return (str): gene string
+    """
+    return alleles[code & 1] + alleles[(code >> 1) & 1]
+
+
+def code_to_pea(color, shape):
+    """
+    :param color (int): color gene code
+    :param shape (int): shape gene code
+    :return (Pea): the pea with these genes
+    """
+    return Pea(**{"color": code_to_gene(color, COLOR_ALLELES), "shape": code_to_gene(shape, SHAPE_ALLELES)})
+
+
+def survival_table():
+    """
+    Builds the survival probability for every (color code, shape code) combination from the current Pea settings
+    :return (ndarray): 4x4 table indexed by color code and shape code
+    """
+    table = np.empty((4, 4))
+    for c in range(4):
+        for s in range(4):
+            table[c, s] = code_to_pea(c, s).survival
+    return table
+
+
+class PeaPopulation(object):
+    """
+    A population of peas stored as one row of two uint8 gene codes (color, shape) per pea in a contiguous array.
+    Slicing returns a view sharing the same storage, appending grows the storage geometrically.
+    """
+
+    def __init__(self, codes=None):
+        """
+        :param codes (ndarray): (n, 2) uint8 array of color and shape codes, used as the storage without copying
+        """
+        if codes is None:
+            codes = np.empty((0, 2), dtype=np.uint8)
+        self._codes = codes
+        self._size = len(codes)
+
+    @classmethod
+    def from_codes(cls, color, shape):
+        """
+        :param color (ndarray): color gene codes
+        :param shape (ndarray): shape gene codes
+        :return (PeaPopulation):
+        """
+        codes = np.empty((len(color), 2), dtype=np.uint8)
+        codes[:, COLOR] = color
+        codes[:, SHAPE] = shape
+        return cls(codes)
+
+    @classmethod
+    def from_peas(cls, peas):
+        """
+        Builds a population from a list of Peas
+        :param peas: list of peas
+        :return (PeaPopulation):
+        """
+        if isinstance(peas, PeaPopulation):
+            return peas
+        codes = np.empty((len(peas), 2), dtype=np.uint8)
+        for n, p in enumerate(peas):
+            codes[n] = gene_to_code(p._color_gene, COLOR_ALLELES), gene_to_code(p._shape_gene, SHAPE_ALLELES)
+        return cls(codes)
+
+    @property
+    def codes(self):
+        return self._codes[:self._size]
+
+    @property
+    def color(self):
+        return self._codes[:self._size, COLOR]
+
+    @property
+    def shape(self):
+        return self._codes[:self._size, SHAPE]
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, item):
+        """
+        :param item: an index returns the Pea, a slice a view on the same storage and a boolean mask or index
+                     array a new population
+        """
+        if isinstance(item, (int, np.integer)):
+            color, shape = self.codes[item]
+            return code_to_pea(color, shape)
+        return PeaPopulation(self.codes[item])
+
+    def __iter__(self):
+        for color, shape in self.codes:
+            yield code_to_pea(color, shape)
+
+    def append(self, other):
+        """
+        Appends all the peas of another population
+        :param other (PeaPopulation): peas to append
+        :return:
+        """
+        new_size = self._size + len(other)
+        if new_size > len(self._codes):
+            codes = np.empty((max(new_size, 2 * len(self._codes)), 2), dtype=np.uint8)
+            codes[:self._size] = self.codes
+            self._codes = codes
+        self._codes[self._size:new_size] = other.codes
+        self._size = new_size
+
+    def shuffle(self, rng):
+        """
+        Shuffles the peas in place
+        :param rng (numpy Generator): random generator to shuffle with
+        :return:
+        """
+        rng.shuffle(self.codes)
+
+    def filter(self, mask):
+        """
+        Keeps only the peas selected by the mask, in place
+        :param mask (ndarray): boolean mask with one entry per pea
+        :return:
+        """
+        kept = self.codes[mask]
+        self._size = len(kept)
+        self._codes[:self._size] = kept
+
+    def survival(self):
+        """
+        :return (ndarray): survival chance of every pea with the current Pea settings
+        """
+        return survival_table()[self.color, self.shape]
+
+    def genotype_counts(self):
+        """
+        :return (ndarray): 4x4 number of peas per (color code, shape code)
+        """
+        return np.bincount(self.color.astype(np.intp) * 4 + self.shape, minlength=16).reshape(4, 4)
+
+    def is_color_recessive(self):
+        """
+        :return (ndarray): True for peas showing the recessive color
+        """
+        return _IS_RECESSIVE_HOMOZYGOTE[self.color]
+
+    def is_shape_recessive(self):
+        """
+        :return (ndarray): True for peas showing the recessive shape
+        """
+        return _IS_RECESSIVE_HOMOZYGOTE[self.shape]
+
+    def is_color_dominant_homozygote(self):
+        return _IS_DOMINANT_HOMOZYGOTE[self.color]
+
+    def is_color_recessive_homozygote(self):
+        return _IS_RECESSIVE_HOMOZYGOTE[self.color]
+
+    def is_color_hetrozygote(self):
+        return _IS_HETROZYGOTE[self.color]
+
+    def is_shape_dominant_homozygote(self):
+        return _IS_DOMINANT_HOMOZYGOTE[self.shape]
+
+    def is_shape_recessive_homozygote(self):
+        return _IS_RECESSIVE_HOMOZYGOTE[self.shape]
+
+    def is_shape_hetrozygote(self):
+        return _IS_HETROZYGOTE[self.shape]
@@ -1,39 +1,70 @@
 import os
+import glob
 import json
 import time
 import argparse
-from mendelianPea.simulate.simulate import Simulate
+from mendelianPea import __version__
+from mendelianPea.simulate.sink import open_sink, sink_class, export_xls, SinkNotAvailable
+from mendelianPea.simulate.checkpoint import Checkpoint
+from mendelianPea.simulate.convergence import Convergence
+from mendelianPea.simulate.cache import ResultCache, DEFAULT_CACHE_DIR
+from mendelianPea.simulate.instrumentation import PrintObserver, JsonLinesLogger
 from mendelianPea.pea.pea import Pea, ColorGene, ShapeGene
 
+# The simulation modules need NumPy and the process pool pulls in multiprocessing, they are imported where they are
+# used so --help and --version start right away
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Meandeian Pea Simulator.')
-    parser.add_argument('--version', action='version', version='Mendelian Simulator 1.0')
-    parser.add_argument('-i', '--input', type=str, required=True, dest='input_file',
-                        help='Input json file with config params')
+    parser.add_argument('--version', action='version', version='Mendelian Simulator {}'.format(__version__))
+    parser.add_argument('-i', '--input', type=str, required=True, nargs='+', dest='input_files',
+                        help='Input json files with config params or directories of them')
+    parser.add_argument('-w', '--workers', type=int, default=1, dest='workers',
+                        help='Number of worker processes to run the iterations on')
+    parser.add_argument('-s', '--seed', type=int, default=None, dest='seed',
+                        help='Master random seed, overrides the seed in the config file')
+    parser.add_argument('--export-xls', type=str, default=None, dest='export_xls',
+                        help='Also export the streamed results to this Excel workbook (single config only)')
+    parser.add_argument('--checkpoint-every', type=int, default=None, dest='checkpoint_every',
+                        help='Write a checkpoint next to the output file every N generations')
+    parser.add_argument('--checkpoint-seconds', type=float, default=None, dest='checkpoint_seconds',
+                        help='Write a checkpoint next to the output file every N seconds')
+    parser.add_argument('--resume', action='store_true', dest='resume',
+                        help='Resume from the checkpoint next to the output file when there is one')
+    parser.add_argument('-q', '--quiet', action='store_true', dest='quiet',
+                        help='Do not print the progress of every generation and iteration')
+    parser.add_argument('--log-jsonl', type=str, default=None, dest='log_jsonl',
+                        help='Write every generation and iteration event, with phase timings, to this JSON lines file')
+    parser.add_argument('--analytic', action='store_true', dest='analytic',
+                        help='Compute the exact expected results of every generation instead of running iterations. '
+                             'Only tractable for a handful of peas over 1 or 2 generations, larger configs such as '
+                             'the ones in input/ are refused: --approximate is the only analytic answer for them')
+    parser.add_argument('--approximate', action='store_true', dest='approximate',
+                        help='Compute the mean field approximation of the expected results instead of running '
+                             'iterations, written to a separate .approximate.csv')
+    parser.add_argument('--max-states', type=int, default=200000, dest='max_states',
+                        help='Largest number of genotype count states an exact --analytic distribution may reach')
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+                        help='Do not read or write the result cache of seeded runs')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR, dest='cache_dir',
+                        help='Directory of the result cache')
+    parser.add_argument('--cache-size', type=float, default=1024, dest='cache_size',
+                        help='Size in MB the result cache is kept under, least recently used results are evicted')
     return parser.parse_args()
 
 
 NO_EXTERNAL_FACTORS = {ColorGene.YELLOW.value: 0.1, ColorGene.GREEN.value: 0.1, ShapeGene.WRINKLED.value: 0.1,
                        ShapeGene.ROUND.value: 0.1}
 
-if __name__ == "__main__":
-    args = parse_args()
-
-    with open(args.input_file) as json_file:
-        data = json.load(json_file)
-
-    iterations = data.get("no-of-iterations", 30)
-    no_of_generations = data.get("no-of-generations-per-iteration", 30)
-    advantage = data.get("advantage", NO_EXTERNAL_FACTORS)
-    base_survival = data.get("base-survival", 0.4)
-    no_of_children = data.get("no-of-children", 4)
+XLS_EXTENSIONS = (".xls", ".xlsx")
 
-    output_location = data.get("output-location")
-    output_file = data.get("output-file")
-    op_file_path = os.path.join(output_location, output_file)
 
-    raw_generation0 = data.get("generation0", {"hetrogygote": 20})
+def _peas(raw_generation0):
+    """
+    :param raw_generation0 (dict): number of peas of every genotype class, as in the generation0 config entry
+    :return (list): the peas, heterozygotes first
+    """
     peas = []
     if raw_generation0.get("hetrogygote"):
         peas += [Pea.get_hetrozygote()] * raw_generation0.get("hetrogygote")
@@ -41,12 +72,316 @@ if __name__ == "__main__":
         peas += [Pea.get_recessive_homozygote()] * raw_generation0.get("homozygote-recessive")
     if raw_generation0.get("homozygote-dominant"):
         peas += [Pea.get_dominant_homozygote()] * raw_generation0.get("homozygote-dominant")
+    return peas
+
+
+class SimulationConfig(object):
+    """
+    A simulation loaded from a json config file along with how to run it and where to write its results
+    """
+
+    def __init__(self, input_file, seed=None, data=None):
+        """
+        :param input_file (str): json config file, only used as the name of the config when data is supplied
+        :param seed (int): master seed overriding the one in the config file
+        :param data (dict): config already loaded, e.g. received by the job server
+        """
+        from mendelianPea.simulate.simulate import Simulate
+        from mendelianPea.simulate import regulation
+        from mendelianPea.pea.population import PeaPopulation
+        from mendelianPea.pea.genome import Genome, GenomePopulation
+        from mendelianPea.simulate.demes import Demes
+
+        if data is None:
+            with open(input_file) as json_file:
+                data = json.load(json_file)
+
+        self.input_file = input_file
+        self.iterations = data.get("no-of-iterations", 30)
+        no_of_generations = data.get("no-of-generations-per-iteration", 30)
+        advantage = data.get("advantage", NO_EXTERNAL_FACTORS)
+        base_survival = data.get("base-survival", 0.4)
+        no_of_children = data.get("no-of-children", 4)
+        genome = data.get("genome")
+        demes = Demes.from_config(data["demes"], data.get("migration"), data.get("deme-workers", 1)) \
+            if data.get("demes") is not None else None
+        engine = data.get("engine", Simulate.GENOME_ENGINE if genome is not None else
+                          Simulate.VECTORIZED_ENGINE if demes is not None else Simulate.DATAFRAME_ENGINE)
+        self.seed = seed if seed is not None else data.get("seed")
+        # With a convergence entry no-of-iterations is the maximum number of iterations
+        self.convergence = Convergence.from_config(data.get("convergence"))
+
+        output_location = data.get("output-location")
+        output_file = data.get("output-file")
+        # Jobs of the job server stream their results and may not write any file
+        self.op_file_path = os.path.join(output_location or "", output_file) if output_file is not None else None
+
+        raw_generation0 = data.get("generation0", {"hetrogygote": 20})
+        if genome is not None:
+            # Every locus of a pea gets the same genotype
+            genome = Genome.from_config(genome)
+            generation0 = GenomePopulation.from_classes(genome, raw_generation0.get("homozygote-dominant", 0),
+                                                        raw_generation0.get("hetrogygote", 0),
+                                                        raw_generation0.get("homozygote-recessive", 0))
+        elif demes is not None:
+            # Demes without a generation0 of their own share the one of the config
+            generation0 = demes.population(_peas(raw_generation0),
+                                           [_peas(deme.generation0) if deme.generation0 is not None else None
+                                            for deme in demes.demes])
+        else:
+            generation0 = PeaPopulation.from_peas(_peas(raw_generation0))
+
+        self.sim = Simulate(generation0=generation0, no_of_generations=no_of_generations,
+                            advantage=advantage, base_survival=base_survival, no_of_children=no_of_children,
+                            engine=engine, regulation=regulation.from_config(data.get("density-regulation")),
+                            genome=genome, lineage=data.get("lineage", False), demes=demes)
+        if self.sim.record_lineage and self.op_file_path is not None:
+            self.sim.lineage_directory = self.op_file_path + ".lineage"
+
+    def open_sink(self, resume_state=None):
+        """
+        :param resume_state (dict): checkpoint snapshot the run resumes from
+        :return (ResultSink): sink for the results, None when they are saved as a workbook at the end
+        """
+        if os.path.splitext(self.op_file_path)[1].lower() in XLS_EXTENSIONS:
+            return None
+        position = resume_state["sink_position"] if resume_state is not None else None
+        # Configs sharing a results store write their own scenario, named after the config file
+        scenario = os.path.splitext(os.path.basename(self.input_file))[0]
+        return open_sink(self.op_file_path, self.sim.columns, position=position, scenario=scenario)
+
+    @property
+    def resumable(self):
+        """
+        :return (bool): whether the output file can be resumed from a checkpoint, workbooks always can as their
+                        results are kept by the checkpoint
+        """
+        if os.path.splitext(self.op_file_path)[1].lower() in XLS_EXTENSIONS:
+            return True
+        return sink_class(self.op_file_path).RESUMABLE
+
+    def checkpoint(self, every_generations=None, every_seconds=None):
+        """
+        :return (Checkpoint): checkpoint written next to the output file
+        """
+        return Checkpoint(self.op_file_path + ".checkpoint", every_generations, every_seconds)
+
+    def save(self, sink, export_xls_path=None):
+        """
+        Writes the results once all the iterations are collected
+        :param sink (ResultSink): sink returned by open_sink
+        :param export_xls_path (str): workbook to export the streamed results to
+        :return:
+        """
+        if sink is None:
+            self.sim.save_xls(self.op_file_path)
+        else:
+            sink.close()
+            if export_xls_path:
+                export_xls(self.op_file_path, export_xls_path)
+        if self.convergence is not None:
+            with open(self.op_file_path + ".convergence.json", "w") as json_file:
+                json.dump(self.convergence.history, json_file, indent=2)
+            print("{} after {} iterations".format("Converged" if self.convergence.converged() else "Not converged",
+                                                   self.convergence.iterations))
+        print("Seed : {}".format(self.sim.seed))
+
+    def save_analytic(self, result):
+        """
+        Writes the expected results of every generation next to the output file, the exact ones to .analytic.csv and
+        the mean field approximation to .approximate.csv
+        :param result (AnalyticResult): returned by Simulate.run_analytic
+        :return:
+        """
+        file_path = os.path.splitext(self.op_file_path)[0] + (".analytic.csv" if result.exact else ".approximate.csv")
+        with open_sink(file_path, self.sim.ANALYTIC_COLUMNS) as sink:
+            for row in result.rows():
+                sink.write(row)
+        print("{} : {} results written to {}".format(
+            self.input_file, "Exact" if result.exact else "Approximate (mean field, biased for small populations)",
+            file_path))
+
+    @property
+    def iterations_run(self):
+        return self.convergence.iterations if self.convergence is not None else self.iterations
+
+
+def find_configs(paths):
+    """
+    :param paths: json config files or directories holding them
+    :return (list): config files
+    """
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            configs += sorted(glob.glob(os.path.join(path, "*.json")))
+        else:
+            configs.append(path)
+    return configs
+
 
+def _timed_iteration(sim, iteration, seed_sequence):
+    """
+    Runs one iteration in a worker process
+    :return (tuple): the iteration results and the time it took
+    """
+    from mendelianPea.simulate.simulate import run_iteration_task
     t1 = time.time()
-    sim = Simulate(generation0=peas, no_of_generations=no_of_generations, advantage=advantage,
-                  base_survival=base_survival, no_of_children=no_of_children)
-    sim.run_iterations(iterations=iterations)
+    result = run_iteration_task(sim, iteration, seed_sequence, record_events=bool(sim.observers))
+    return result, time.time() - t1
 
-    sim.save_xls(op_file_path)
+
+def run_batch(configs, workers, cache=None):
+    """
+    Runs several configs on one shared process pool. All the (config, iteration) tasks are queued at once, the
+    most expensive configs first so the pool stays busy until the end, and every config writes its own output.
+    :param configs (list): SimulationConfig to run
+    :param workers (int): number of worker processes
+    :param cache (ResultCache): only the iterations missing from the cache are queued for seeded configs
+    :return (list): (config, wall time, busy time) for every config
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    t1 = time.time()
+    summary = []
+    executor = None
+    futures, keys, seeds = {}, {}, {}
+
+    def submit(config, y):
+        nonlocal executor
+        if executor is None:
+            # Only started once an iteration is not read from the cache
+            executor = ProcessPoolExecutor(max_workers=workers)
+        return executor.submit(_timed_iteration, config.sim, y, seeds[config][y])
+
+    try:
+        for config in sorted(configs, key=lambda c: c.sim.estimated_cost(), reverse=True):
+            seeds[config] = config.sim.iteration_seeds(config.iterations, config.seed)
+            keys[config] = cache.key(config.sim, config.sim.seed) if cache is not None and \
+                config.seed is not None and config.sim.lineage_directory is None else None
+            futures[config] = {y: submit(config, y) for y in range(config.iterations)
+                               if keys[config] is None or not cache.contains(keys[config], y)}
+
+        for config in configs:
+            busy = []
+
+            def compute(iterations):
+                for y in iterations:
+                    future = futures[config].get(y) or submit(config, y)
+                    result, elapsed = future.result()
+                    busy.append(elapsed)
+                    yield result
+
+            iterations = range(config.iterations)
+            sink = config.open_sink()
+            config.sim.collect_iterations(compute(iterations) if keys[config] is None else
+                                          cache.results(keys[config], iterations, compute), sink)
+            config.save(sink)
+            summary.append((config, time.time() - t1, sum(busy)))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if cache is not None:
+        cache.evict()
+    return summary
+
+
+def run_serial(configs, workers, export_xls_path=None, checkpoint_every=None, checkpoint_seconds=None,
+               resume=False, cache=None):
+    """
+    Runs the configs one after the other, each one on its own process pool when workers is more than 1
+    :param configs (list): SimulationConfig to run
+    :param workers (int): number of worker processes
+    :param export_xls_path (str): workbook to export the streamed results to
+    :param checkpoint_every (int): number of generations between checkpoints
+    :param checkpoint_seconds (float): number of seconds between checkpoints
+    :param resume (bool): resume every config from its checkpoint when there is one
+    :param cache (ResultCache): result cache of the seeded configs, not used with checkpoints
+    :return (list): (config, wall time, busy time) for every config
+    :raise SinkNotAvailable: when checkpointing a config whose output can not be resumed, before any config runs
+    """
+    if checkpoint_every is not None or checkpoint_seconds is not None or resume:
+        for config in configs:
+            if not config.resumable:
+                raise SinkNotAvailable("{} : {} outputs can not be checkpointed, use a .csv, .store or .xlsx "
+                                       "output".format(config.input_file,
+                                                       os.path.splitext(config.op_file_path)[1]))
+    t1 = time.time()
+    summary = []
+    for config in configs:
+        t2 = time.time()
+        checkpoint = None
+        resume_state = None
+        if checkpoint_every is not None or checkpoint_seconds is not None or resume:
+            checkpoint = config.checkpoint(checkpoint_every, checkpoint_seconds)
+            resume_state = checkpoint.load() if resume else None
+        sink = config.open_sink(resume_state)
+        config.sim.run_iterations(iterations=config.iterations, workers=workers, seed=config.seed, sink=sink,
+                                  checkpoint=checkpoint, resume_state=resume_state, convergence=config.convergence,
+                                  cache=cache)
+        config.save(sink, export_xls_path)
+        summary.append((config, time.time() - t1, time.time() - t2))
+    return summary
+
+
+def print_summary(summary):
+    """
+    Prints for every config the wall time from the start of the run until its results were written and the
+    time spent running its iterations
+    :param summary (list): (config, wall time, busy time) for every config
+    :return:
+    """
+    width = max(len(c.input_file) for c, _, _ in summary)
+    print("{}  {:>10}  {:>10}  {:>10}  {:>10}".format("Config".ljust(width), "Engine", "Iterations", "Wall(s)",
+                                                      "Busy(s)"))
+    for config, wall, busy in summary:
+        print("{}  {:>10}  {:>10}  {:>10.2f}  {:>10.2f}".format(config.input_file.ljust(width),
+                                                                config.sim.engine_mode, config.iterations_run, wall,
+                                                                busy))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configs = [SimulationConfig(f, args.seed) for f in find_configs(args.input_files)]
+    if len(configs) > 1 and args.export_xls:
+        raise SystemExit("--export-xls can only be used with a single config")
+
+    logger = JsonLinesLogger(args.log_jsonl) if args.log_jsonl else None
+    for config in configs:
+        if not args.quiet:
+            config.sim.add_observer(PrintObserver())
+        if logger is not None:
+            config.sim.add_observer(logger)
+        if config.convergence is not None:
+            config.convergence.verbose = not args.quiet
+
+    checkpointing = args.checkpoint_every is not None or args.checkpoint_seconds is not None or args.resume
+    # Adaptive iteration counts are only known as the batches are collected, such configs run one after the other
+    adaptive = any(config.convergence is not None for config in configs)
+
+    cache = None if args.no_cache else ResultCache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+
+    t1 = time.time()
+    if args.analytic or args.approximate:
+        from mendelianPea.simulate.analytic import AnalyticNotTractable
+        for config in configs:
+            try:
+                config.save_analytic(config.sim.run_analytic(args.approximate, args.max_states))
+            except AnalyticNotTractable as e:
+                print("{} : {}, no exact results written. Raise --max-states or use --approximate".format(
+                    config.input_file, e))
+    elif len(configs) > 1 and args.workers > 1 and not checkpointing and not adaptive:
+        print_summary(run_batch(configs, args.workers, cache))
+    else:
+        try:
+            summary = run_serial(configs, args.workers, args.export_xls, args.checkpoint_every,
+                                 args.checkpoint_seconds, args.resume, cache)
+        except SinkNotAvailable as e:
+            raise SystemExit(str(e))
+        if len(configs) > 1:
+            print_summary(summary)
+    if logger is not None:
+        logger.close()
+    if cache is not None and cache.hits > 0:
+        print("Iterations read from the result cache : {}".format(cache.hits))
     t2 =time.time()
     print("Simulation took : {}secs".format(t2-t1))
@@ -0,0 +1,617 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+import itertools
+import collections
+import multiprocessing
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from mendelianPea.simulate.instrumentation import Observer
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 409: "Conflict", 415: "Unsupported Media Type", 503: "Service Unavailable"}
+
+
+# Types of the entries of a config, checked before a job is queued. The config itself is only built by the worker
+NUMBER = (int, float)
+CONFIG_SCHEMA = {
+    "no-of-iterations": int,
+    "no-of-generations-per-iteration": int,
+    "no-of-children": int,
+    "base-survival": NUMBER,
+    "advantage": dict,
+    "generation0": dict,
+    "engine": str,
+    "seed": int,
+    "convergence": dict,
+    "density-regulation": dict,
+    "genome": dict,
+    "lineage": bool,
+    "demes": (int, list),
+    "migration": (int, float, list),
+    "deme-workers": int,
+    "output-location": str,
+    "output-file": str,
+}
+# Entries that must be at least 1
+POSITIVE = ("no-of-iterations", "no-of-generations-per-iteration", "deme-workers")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class InvalidRequest(Exception):
+    pass
+
+
+# Set in every worker process by _init_worker
+_EVENTS = None
+_CANCELLED = None
+
+
+def _init_worker(events, cancelled):
+    """
+    Process pool initializer, the workers stay up between jobs so the simulation modules are only imported once
+    :param events (multiprocessing Queue): messages sent back to the server
+    :param cancelled (multiprocessing Array): cancellation flag of every pool slot
+    :return:
+    """
+    global _EVENTS, _CANCELLED
+    _EVENTS = events
+    _CANCELLED = cancelled
+    import mendelianPea.run  # noqa: F401
+    import mendelianPea.simulate.simulate  # noqa: F401
+    try:
+        # The default DataFrame engine needs pandas, the slowest import by far
+        import pandas  # noqa: F401
+    except ImportError:
+        pass
+
+
+def _warm():
+    return os.getpid()
+
+
+class StreamObserver(Observer):
+    """
+    Sends the progress of a job to the server and stops the job once it is cancelled
+    """
+
+    def __init__(self, job_id, slot):
+        """
+        :param job_id (int): job reported on
+        :param slot (int): pool slot of the job, its cancellation flag
+        """
+        self.job_id = job_id
+        self.slot = slot
+
+    def _check(self):
+        if _CANCELLED[self.slot]:
+            raise JobCancelled()
+
+    def on_generation(self, event):
+        record = event.to_dict()
+        record["event"] = "generation"
+        _EVENTS.put((self.job_id, record))
+        self._check()
+
+    def on_iteration(self, iteration, rows):
+        _EVENTS.put((self.job_id, {"event": "iteration", "iteration": iteration, "rows": rows}))
+        self._check()
+
+
+def _run_job(job_id, slot, data, seed=None):
+    """
+    Runs a job in a worker process, its progress is streamed to the server. The output file of the config is written
+    as by run.py when it has one.
+    :param job_id (int): job to run
+    :param slot (int): pool slot of the job
+    :param data (dict): config of the job, as in the run.py config files
+    :param seed (int): master seed overriding the one in the config
+    :return (str): final state of the job, also sent with its last message
+    """
+    from mendelianPea.run import SimulationConfig
+    end = {"event": "end"}
+    try:
+        config = SimulationConfig("job {}".format(job_id), seed, data)
+        config.sim.add_observer(StreamObserver(job_id, slot))
+        if config.op_file_path is not None:
+            # The output location is under the output root of the server, see confine_outputs
+            os.makedirs(os.path.dirname(config.op_file_path), exist_ok=True)
+        sink = config.open_sink() if config.op_file_path is not None else None
+        try:
+            config.sim.run_iterations(config.iterations, seed=config.seed, sink=sink,
+                                      convergence=config.convergence)
+        except Exception:
+            # The workers outlive their jobs, a cancelled or failed job still closes its output file
+            if sink is not None:
+                sink.close()
+            raise
+        if config.op_file_path is not None:
+            config.save(sink)
+        end.update({"status": DONE, "seed": config.sim.seed, "iterations": config.iterations_run})
+    except JobCancelled:
+        end["status"] = CANCELLED
+    except Exception as e:
+        end.update({"status": FAILED, "error": "{}: {}".format(type(e).__name__, e)})
+    _EVENTS.put((job_id, end))
+    return end["status"]
+
+
+def _type_names(types):
+    types = types if isinstance(types, tuple) else (types,)
+    return " or ".join(t.__name__ for t in types)
+
+
+def validate_config(data):
+    """
+    Checks the entries of a config and their types, cheap enough for the event loop. The values themselves are
+    checked by the worker building the simulation, the job fails if they are invalid.
+    :param data (dict): config, as in the run.py config files
+    :return:
+    :raise InvalidRequest: on an unknown entry or an entry of the wrong type
+    """
+    for key, value in data.items():
+        if key not in CONFIG_SCHEMA:
+            raise InvalidRequest("Invalid config: unknown entry {}".format(key))
+        types = CONFIG_SCHEMA[key]
+        if value is None:
+            continue
+        # JSON true and false are bools, which are also ints
+        if (isinstance(value, bool) and types is not bool) or not isinstance(value, types):
+            raise InvalidRequest("Invalid config: {} must be {}, got {}".format(
+                key, _type_names(types), json.dumps(value)))
+        if key in POSITIVE and value < 1:
+            raise InvalidRequest("Invalid config: {} must be at least 1, got {}".format(key, value))
+        if key == "no-of-children" and value < 0:
+            raise InvalidRequest("Invalid config: no-of-children must be at least 0, got {}".format(value))
+
+
+def confine_outputs(data, output_root):
+    """
+    Moves the output of a config under the output root of the server
+    :param data (dict): config, as in the run.py config files
+    :param output_root (str): directory the outputs of the jobs are written under
+    :return (dict): the config with an output-location under output_root
+    :raise InvalidRequest: if the output-location or output-file is absolute or goes up with ..
+    """
+    if data.get("output-file") is None:
+        return data
+    location = data.get("output-location") or ""
+    for path in (location, data["output-file"]):
+        if os.path.isabs(path) or os.path.splitdrive(path)[0] or ".." in path.replace("\\", "/").split("/"):
+            raise InvalidRequest("Invalid config: output paths must be relative to the output root and not use .., "
+                                 "got {}".format(path))
+    return dict(data, **{"output-location": os.path.join(output_root, location)})
+
+
+def _to_json(value):
+    # numpy scalars in the stats rows
+    return value.item()
+
+
+class Job(object):
+    """
+    A config submitted to the server along with its progress. The last max_messages messages of the job are kept
+    so a client streaming it late gets the most recent ones, older progress events are dropped.
+    """
+
+    def __init__(self, job_id, data, seed=None, max_messages=1000):
+        """
+        :param job_id (int):
+        :param data (dict): config of the job
+        :param seed (int): master seed overriding the one in the config
+        :param max_messages (int): number of messages kept for the clients streaming the job late
+        """
+        self.id = job_id
+        self.data = data
+        self.seed = seed
+        self.status = QUEUED
+        self.error = None
+        self.result_seed = None
+        self.iterations = 0
+        self.generations = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.messages = collections.deque(maxlen=max_messages)
+        self.subscribers = set()
+        # Set once the last message of the worker is received
+        self.drained = asyncio.Event()
+
+    def publish(self, message):
+        """
+        Keeps the message and sends it to every streaming client
+        :param message (dict):
+        :return:
+        """
+        event = message.get("event")
+        if event == "generation":
+            self.generations += 1
+        elif event == "iteration":
+            self.iterations += 1
+        elif event == "end":
+            self.result_seed = message.get("seed")
+            self.error = message.get("error")
+        self.messages.append(message)
+        for subscriber in self.subscribers:
+            subscriber.put_nowait(message)
+
+    def set_status(self, status):
+        self.status = status
+        if status == RUNNING:
+            self.started = time.time()
+        elif status in FINISHED:
+            self.finished = time.time()
+        self.publish({"event": "status", "id": self.id, "status": status})
+
+    def to_dict(self):
+        return {"id": self.id, "status": self.status, "iterations": self.iterations,
+                "generations": self.generations, "seed": self.result_seed, "error": self.error,
+                "submitted": self.submitted, "started": self.started, "finished": self.finished}
+
+
+class JobServer(object):
+    """
+    Local simulation job server. Jobs are the run.py json configs, posted over HTTP on a TCP port or a Unix socket,
+    queued and run on a bounded pool of warm worker processes:
+
+    * POST /jobs runs a config posted as application/json, the response is the job status; with ?stream=1 the
+      progress of the job is streamed in the response instead, see GET /jobs/<id>/stream. ?seed=N overrides the seed
+      of the config. Its output file is written under the output root of the server
+    * GET /jobs lists the status of every job
+    * GET /jobs/<id> is the status of a job
+    * GET /jobs/<id>/stream streams every message of the job as JSON lines as it is produced: the status changes,
+      one generation event per generation (as written by run.py --log-jsonl), one iteration event per iteration and
+      a last end message with the final status. A client streaming a long job late only gets its last messages
+    * DELETE /jobs/<id> cancels a job, it stops at the end of the generation in progress
+    """
+
+    def __init__(self, workers=2, max_queued=64, max_finished=256, max_messages=1000, output_root="."):
+        """
+        :param workers (int): number of worker processes, also the number of jobs running at once
+        :param max_queued (int): number of jobs waiting for a worker past which new jobs are refused
+        :param max_finished (int): number of finished jobs whose status and messages are kept
+        :param max_messages (int): number of messages kept per job for the clients streaming it late
+        :param output_root (str): directory the output files of the jobs are written under
+        """
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.max_messages = max_messages
+        self.output_root = os.path.abspath(output_root)
+        # Host headers accepted, any when None. Set by serve for a TCP port so pages of other sites can not reach
+        # the server through a DNS name pointing to this host
+        self.allowed_hosts = None
+        # Number of jobs waiting for a worker, cancelled ones stop counting right away
+        self._queued = 0
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._queue = None
+        self._executor = None
+        self._events = None
+        self._cancelled = None
+        self._running = {}
+        self._loop = None
+        self._tasks = []
+        self._pump = None
+
+    def _start_pool(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(self._events, self._cancelled))
+
+    async def start(self):
+        """
+        Starts the worker processes and the job dispatchers
+        :return:
+        """
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._events = multiprocessing.Queue()
+        self._cancelled = multiprocessing.Array("b", self.workers, lock=False)
+        self._start_pool()
+        self._pump = threading.Thread(target=self._read_events, daemon=True)
+        self._pump.start()
+        await asyncio.gather(*[self._loop.run_in_executor(self._executor, _warm) for _ in range(self.workers)])
+        self._tasks = [asyncio.create_task(self._dispatch(slot)) for slot in range(self.workers)]
+
+    async def stop(self):
+        """
+        Cancels every job and stops the workers
+        :return:
+        """
+        for job in self.jobs.values():
+            if job.status not in FINISHED:
+                self.cancel(job.id)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+        self._events.put(None)
+        self._pump.join()
+
+    def _read_events(self):
+        # Runs on its own thread, the messages of the workers are handed over to the event loop
+        while True:
+            message = self._events.get()
+            if message is None:
+                return
+            self._loop.call_soon_threadsafe(self._publish, *message)
+
+    def _publish(self, job_id, message):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+        job.publish(message)
+        if message["event"] == "end":
+            job.drained.set()
+
+    def submit(self, data, seed=None):
+        """
+        Queues a job, the entries of the config are checked here so malformed ones are refused right away. The
+        simulation is only built by the worker running the job.
+        :param data (dict): config, as in the run.py config files
+        :param seed (int): master seed overriding the one in the config
+        :return (Job):
+        :raise InvalidRequest: if the config is malformed
+        """
+        if self._queued >= self.max_queued:
+            raise asyncio.QueueFull()
+        validate_config(data)
+        data = confine_outputs(data, self.output_root)
+        job = Job(next(self._ids), data, seed, self.max_messages)
+        self.jobs[job.id] = job
+        job.publish({"event": "status", "id": job.id, "status": QUEUED})
+        self._queued += 1
+        self._queue.put_nowait(job)
+        self._forget()
+        return job
+
+    def cancel(self, job_id):
+        """
+        :param job_id (int):
+        :return (Job): the job, None if unknown. A running job is only cancelled once its worker stops it
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status == QUEUED:
+            # Its entry in the queue is skipped by the dispatchers
+            self._queued -= 1
+            job.publish({"event": "end", "status": CANCELLED})
+            job.set_status(CANCELLED)
+        elif job.status == RUNNING:
+            self._cancelled[self._running[job_id]] = 1
+        return job
+
+    def _forget(self):
+        # Drops the oldest finished jobs past max_finished
+        finished = [job for job in self.jobs.values() if job.status in FINISHED]
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.id]
+
+    async def _dispatch(self, slot):
+        """
+        Runs the queued jobs one after the other, there is one dispatcher per worker
+        :param slot (int): cancellation flag of the jobs run by this dispatcher
+        :return:
+        """
+        while True:
+            job = await self._queue.get()
+            if job.status != QUEUED:
+                continue
+            self._queued -= 1
+            self._cancelled[slot] = 0
+            self._running[job.id] = slot
+            job.set_status(RUNNING)
+            executor = self._executor
+            try:
+                status = await self._loop.run_in_executor(executor, _run_job, job.id, slot, job.data, job.seed)
+                # The result can come back before the last messages of the job
+                await job.drained.wait()
+            except BrokenProcessPool as e:
+                status = FAILED
+                job.publish({"event": "end", "status": FAILED, "error": "Worker process died: {}".format(e)})
+                # Every job of the broken pool ends up here, only the first one replaces it
+                if self._executor is executor:
+                    executor.shutdown(wait=False)
+                    self._start_pool()
+            except Exception as e:
+                status = FAILED
+                job.publish({"event": "end", "status": FAILED, "error": "{}: {}".format(type(e).__name__, e)})
+            finally:
+                del self._running[job.id]
+            job.set_status(status)
+            self._forget()
+
+    async def stream(self, job):
+        """
+        :param job (Job):
+        :return: async generator of the messages of the job, the ones still kept first, until it is finished
+        """
+        subscriber = asyncio.Queue()
+        messages = list(job.messages)
+        job.subscribers.add(subscriber)
+        try:
+            for message in messages:
+                yield message
+            if job.status in FINISHED:
+                return
+            while True:
+                message = await subscriber.get()
+                yield message
+                if message["event"] == "status" and message["status"] in FINISHED:
+                    return
+        finally:
+            job.subscribers.discard(subscriber)
+
+    async def handle(self, reader, writer):
+        """
+        Serves one HTTP request, the connection is closed afterwards
+        :param reader (asyncio StreamReader):
+        :param writer (asyncio StreamWriter):
+        :return:
+        """
+        try:
+            method, path, query, headers, body = await self._read_request(reader)
+            if self.allowed_hosts is not None and headers.get("host", "").lower() not in self.allowed_hosts:
+                return await self._respond(writer, 403, {"error": "Unknown host {}".format(headers.get("host"))})
+            await self._route(writer, method, path, query, headers, body)
+        except InvalidRequest as e:
+            await self._respond(writer, 400, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    @staticmethod
+    async def _read_request(reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise InvalidRequest("Malformed request line")
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise InvalidRequest("Invalid Content-Length")
+        body = await reader.readexactly(length) if length > 0 else b""
+        url = urlsplit(target)
+        return method.upper(), url.path.rstrip("/"), parse_qs(url.query), headers, body
+
+    async def _route(self, writer, method, path, query, headers, body):
+        parts = path.strip("/").split("/")
+        if parts[0] != "jobs" or len(parts) > 3:
+            return await self._respond(writer, 404, {"error": "Unknown path {}".format(path)})
+        if len(parts) == 1:
+            if method == "GET":
+                return await self._respond(writer, 200, [job.to_dict() for job in self.jobs.values()])
+            if method != "POST":
+                return await self._respond(writer, 405, {"error": "Use GET or POST on /jobs"})
+            # Browsers can only send other sites' JSON after a CORS preflight the server never answers
+            if headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+                return await self._respond(writer, 415, {"error": "Configs must be posted as application/json"})
+            try:
+                data = json.loads(body)
+                seed = int(query["seed"][0]) if "seed" in query else None
+            except ValueError as e:
+                raise InvalidRequest("Invalid request: {}".format(e))
+            if not isinstance(data, dict):
+                raise InvalidRequest("The config must be a JSON object")
+            try:
+                job = self.submit(data, seed)
+            except asyncio.QueueFull:
+                return await self._respond(writer, 503, {"error": "Too many queued jobs"})
+            if query.get("stream", ["0"])[0] not in ("0", "false"):
+                return await self._stream(writer, job)
+            return await self._respond(writer, 202, job.to_dict())
+
+        try:
+            job = self.jobs[int(parts[1])]
+        except (ValueError, KeyError):
+            return await self._respond(writer, 404, {"error": "Unknown job {}".format(parts[1])})
+        if len(parts) == 3:
+            if parts[2] != "stream" or method != "GET":
+                return await self._respond(writer, 404, {"error": "Unknown path {}".format(path)})
+            return await self._stream(writer, job)
+        if method == "GET":
+            return await self._respond(writer, 200, job.to_dict())
+        if method == "DELETE":
+            if job.status in FINISHED:
+                return await self._respond(writer, 409, job.to_dict())
+            return await self._respond(writer, 202, self.cancel(job.id).to_dict())
+        return await self._respond(writer, 405, {"error": "Use GET or DELETE on /jobs/<id>"})
+
+    @staticmethod
+    def _headers(status, content_type, extra=""):
+        return "HTTP/1.1 {} {}\r\nContent-Type: {}\r\n{}Connection: close\r\n\r\n".format(
+            status, HTTP_REASONS[status], content_type, extra).encode("latin-1")
+
+    async def _respond(self, writer, status, payload):
+        body = json.dumps(payload, default=_to_json).encode()
+        writer.write(self._headers(status, "application/json", "Content-Length: {}\r\n".format(len(body))) + body)
+        await writer.drain()
+
+    async def _stream(self, writer, job):
+        # Chunked response, one JSON line per chunk
+        writer.write(self._headers(200, "application/x-ndjson", "Transfer-Encoding: chunked\r\n"))
+        async for message in self.stream(job):
+            line = (json.dumps(message, default=_to_json) + "\n").encode()
+            writer.write("{:x}\r\n".format(len(line)).encode() + line + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def serve(server, host="127.0.0.1", port=8765, unix_socket=None):
+    """
+    Runs the job server until it is cancelled
+    :param server (JobServer):
+    :param host (str): address to listen on
+    :param port (int): TCP port to listen on
+    :param unix_socket (str): Unix socket to listen on instead of the TCP port
+    :return:
+    """
+    await server.start()
+    if unix_socket is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=unix_socket)
+        print("Job server listening on {} with {} workers".format(unix_socket, server.workers))
+    else:
+        names = {host, "localhost", "127.0.0.1", "[::1]"}
+        server.allowed_hosts = {name.lower() for name in names} | {"{}:{}".format(name, port).lower() for name in names}
+        listener = await asyncio.start_server(server.handle, host, port)
+        print("Job server listening on http://{}:{} with {} workers".format(host, port, server.workers))
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.stop()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mendelian Pea Simulator job server.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', dest='host', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, dest='port', help='TCP port to listen on')
+    parser.add_argument('--unix-socket', type=str, default=None, dest='unix_socket',
+                        help='Listen on this Unix socket instead of the TCP port')
+    parser.add_argument('-w', '--workers', type=int, default=2, dest='workers',
+                        help='Number of worker processes, the number of jobs run at once')
+    parser.add_argument('--max-queued', type=int, default=64, dest='max_queued',
+                        help='Number of jobs waiting for a worker past which new jobs are refused')
+    parser.add_argument('--output-root', type=str, default='.', dest='output_root',
+                        help='Directory the output files of the jobs are written under')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        asyncio.run(serve(JobServer(args.workers, args.max_queued, output_root=args.output_root), args.host, args.port,
+                          args.unix_socket))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,467 @@
+import math
+from functools import lru_cache
+import numpy as np
+from mendelianPea.simulate.engine import MENDELIAN_TABLE, genotype_survival
+from mendelianPea.simulate.stats import GenerationStats, NO_OF_GENOTYPES
+from mendelianPea.simulate.regulation import _keep_probabilities
+
+
+# Number of distributions worth of states added up before they are merged, and kept in the transition memo
+_MERGE_FACTOR = 4
+
+
+class AnalyticNotTractable(Exception):
+    """
+    Exception class for an exact distribution needing more states than allowed
+    """
+    pass
+
+
+def _compositions(limits, total):
+    """
+    :param limits (tuple): maximum of every part
+    :param total (int): sum of the parts
+    :return: generator of the tuples of parts, each one at most its limit, summing to total
+    """
+    if len(limits) == 1:
+        if total <= limits[0]:
+            yield (total,)
+        return
+    for first in range(min(limits[0], total) + 1):
+        for rest in _compositions(limits[1:], total - first):
+            yield (first,) + rest
+
+
+@lru_cache(maxsize=None)
+def _hypergeometric(counts, n):
+    """
+    :param counts (tuple): number of peas of every genotype
+    :param n (int): number of peas drawn without replacement
+    :return (tuple): (m, len(counts)) drawn counts and probability of every outcome
+    """
+    denominator = math.comb(sum(counts), n)
+    drawn = list(_compositions(counts, n))
+    probabilities = [math.prod(math.comb(c, d) for c, d in zip(counts, outcome)) / denominator for outcome in drawn]
+    return np.array(drawn, dtype=np.int64).reshape(-1, len(counts)), np.array(probabilities)
+
+
+def _add(distribution, state, probability):
+    distribution[state] = distribution.get(state, 0.0) + probability
+
+
+def _merge(states, probabilities):
+    """
+    Adds up the probabilities of identical states
+    :param states (ndarray): (n, 9) genotype counts
+    :param probabilities (ndarray): probability of every state
+    :return (tuple): the distinct states, sorted, and their probabilities
+    """
+    base = int(states.max()) + 1 if len(states) > 0 else 1
+    if base ** states.shape[1] < 2 ** 63:
+        keys = states @ (base ** np.arange(states.shape[1], dtype=np.int64))
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        unique = states[first]
+    else:
+        unique, inverse = np.unique(states, axis=0, return_inverse=True)
+    return unique, np.bincount(inverse.ravel(), weights=probabilities, minlength=len(unique))
+
+
+def _convolve(first, second, chunk_size=1 << 20):
+    """
+    :param first (tuple): genotype counts and probability of every state of a distribution
+    :param second (tuple): genotype counts and probability of every state of an independent distribution
+    :param chunk_size (int): number of state pairs added up at once
+    :return (tuple): distribution of the sum of both genotype counts
+    """
+    rows = max(1, chunk_size // len(second[0]))
+    parts = []
+    for start in range(0, len(first[0]), rows):
+        states = first[0][start:start + rows, None, :] + second[0][None, :, :]
+        probabilities = np.outer(first[1][start:start + rows], second[1])
+        parts.append(_merge(states.reshape(-1, states.shape[2]), probabilities.ravel()))
+    if len(parts) == 1:
+        return parts[0]
+    return _merge(np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]))
+
+
+def _jacobian(function, x, step=1e-6):
+    """
+    :param function: function of an ndarray returning an ndarray
+    :param x (ndarray): point to differentiate at
+    :param step (float): relative finite difference step
+    :return (ndarray): derivative of every output by every input, by central differences
+    """
+    h = step * max(1.0, float(np.abs(x).max()))
+    columns = []
+    for k in range(len(x)):
+        dx = np.zeros(len(x))
+        dx[k] = h
+        columns.append((function(x + dx) - function(x - dx)) / (2 * h))
+    return np.column_stack(columns)
+
+
+def _stat_rows(states):
+    """
+    Vectorized GenerationStats.row
+    :param states (ndarray): (n, 9) genotype counts
+    :return (ndarray): (n, 11) statistic columns of Simulate.ITERATION_COLUMNS, all zero for an empty generation
+    """
+    total = states.sum(axis=1).astype(float)
+    genes = states.reshape(-1, 3, 3)
+    color, shape = genes.sum(axis=2), genes.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rows = np.column_stack([1 - color[:, 2] / total, color[:, 2] / total, 1 - shape[:, 2] / total,
+                                shape[:, 2] / total, color[:, 0] / total, color[:, 2] / total, color[:, 1] / total,
+                                shape[:, 0] / total, shape[:, 2] / total, shape[:, 1] / total, total])
+    rows[total == 0] = 0
+    return rows
+
+
+class AnalyticModel(object):
+    """
+    Deterministic counterpart of the count engine. A generation is random pairing (an odd pea out is discarded), the
+    children of every pair drawn from the Mendelian table, a survival roll per child and the density regulation if
+    any, so the next generation only depends on the 9 genotype counts of the current one.
+
+    mean_field iterates the expected counts, the exact expectation for one generation and the large population
+    limit over several, and linear_noise the covariance around them. distributions follows the whole Markov chain
+    over the genotype counts, which is exact but only tractable for a handful of peas: every transition is computed
+    once and memoized.
+    """
+
+    def __init__(self, no_of_children, survival=None, regulation=None, max_states=200000):
+        """
+        :param no_of_children (int): Number of children a pair of peas can spawn per generation
+        :param survival (ndarray): survival chance of every genotype index, from the current Pea settings if not
+                                   supplied
+        :param regulation (DensityRegulation): culls the surviving children when supplied
+        :param max_states (int): largest number of genotype count states a distribution may reach, counted as the
+                                 states are reached
+        """
+        self.no_of_children = no_of_children
+        self.survival = np.asarray(survival if survival is not None else genotype_survival(), dtype=float)
+        self.regulation = regulation
+        self.max_states = max_states
+        # Probability of every surviving genotype, and of a dead child last, for every pair of parent genotypes
+        outcomes = MENDELIAN_TABLE * self.survival
+        self._outcomes = np.concatenate((outcomes, 1 - outcomes.sum(axis=2, keepdims=True)), axis=2)
+        # Memoized outcomes of a pair or of a tuple of pairs, of the regulation and of every state
+        self._pair_offspring = {}
+        self._regulations = {}
+        self._transitions = {}
+        self._memoized = 0
+
+    def _pair_chances(self, counts):
+        """
+        :param counts (ndarray): genotype counts of a generation
+        :return (tuple): 9x9 probability of every parent genotype pair and 9x9x9 chance of a child of every pair to
+                         survive with every genotype
+        """
+        total = counts.sum()
+        # Both parents of a pair are two peas drawn without replacement, an odd pea out only drops a pair
+        return (np.outer(counts, counts) - np.diag(counts)) / (total * (total - 1)), MENDELIAN_TABLE * self.survival
+
+    def _regulated(self, survivors, parents):
+        """
+        :param survivors (ndarray): expected genotype counts of the surviving children
+        :param parents (float): size of the parent generation
+        :return (ndarray): expected genotype counts once regulated
+        """
+        if self.regulation is None or survivors.sum() <= 0:
+            return survivors
+        return survivors * self.regulation.keep_probabilities(self.survival, survivors, parents)
+
+    def _expected_survivors(self, counts, no_of_pairs):
+        if counts.sum() < 2:
+            return np.zeros(NO_OF_GENOTYPES)
+        parents, chances = self._pair_chances(counts)
+        survivors = self.no_of_children * no_of_pairs * np.einsum("ij,ijk->k", parents, chances)
+        return self._regulated(survivors, counts.sum())
+
+    def expected_next(self, counts):
+        """
+        :param counts (ndarray): genotype counts of a generation, expected counts are accepted
+        :return (ndarray): expected genotype counts of the next generation
+        """
+        counts = np.asarray(counts, dtype=float)
+        total = counts.sum()
+        return self._expected_survivors(counts, total // 2 if float(total).is_integer() else total / 2)
+
+    def mean_field(self, counts, no_of_generations):
+        """
+        :param counts (ndarray): genotype counts of generation 0
+        :param no_of_generations (int): number of generations
+        :return (ndarray): (no_of_generations + 1, 9) expected genotype counts of every generation
+        """
+        trajectory = [np.asarray(counts, dtype=float)]
+        for _ in range(no_of_generations):
+            trajectory.append(self.expected_next(trajectory[-1]))
+        return np.array(trajectory)
+
+    def linear_noise(self, counts, no_of_generations):
+        """
+        Covariance of the genotype counts around the mean field trajectory: the covariance of a generation is carried
+        to the next one through the derivative of expected_next, plus the noise of drawing its pairs and children
+        :param counts (ndarray): genotype counts of generation 0
+        :param no_of_generations (int): number of generations
+        :return (tuple): the mean field trajectory and the (no_of_generations + 1, 9, 9) covariances
+        """
+        trajectory = self.mean_field(counts, no_of_generations)
+        covariances = [np.zeros((NO_OF_GENOTYPES, NO_OF_GENOTYPES))]
+        for counts in trajectory[:-1]:
+            total = counts.sum()
+            if total < 2:
+                covariances.append(np.zeros((NO_OF_GENOTYPES, NO_OF_GENOTYPES)))
+                continue
+            # The children of a pair are multinomial given its parents. As every pea is the parent of exactly one
+            # pair the parent effects add up to a constant, the pairing only adds the noise of their interaction
+            no_of_pairs, n = total / 2, self.no_of_children
+            parents, chances = self._pair_chances(counts)
+            mean = np.einsum("ij,ijk->k", parents, chances)
+            effect = np.einsum("j,ijk->ik", counts / total, chances) - mean
+            interaction = chances - mean - effect[:, None, :] - effect[None, :, :]
+            noise = no_of_pairs * n * (np.diag(mean) - np.einsum("ij,ijk,ijl->kl", parents, chances, chances)) + \
+                no_of_pairs * n * n * np.einsum("ij,ijk,ijl->kl", parents, interaction, interaction)
+            if self.regulation is not None:
+                # Every survivor is then kept with a chance depending on the number of survivors
+                survivors = no_of_pairs * n * mean
+                regulation = _jacobian(lambda c: self._regulated(c, total), survivors)
+                kept = self._regulated(survivors, total)
+                keep = np.divide(kept, survivors, out=np.zeros(NO_OF_GENOTYPES), where=survivors > 0)
+                noise = regulation @ noise @ regulation.T + np.diag(kept * (1 - keep))
+            jacobian = _jacobian(lambda c: self._expected_survivors(c, c.sum() / 2), counts)
+            covariances.append(jacobian @ covariances[-1] @ jacobian.T + noise)
+        return trajectory, np.array(covariances)
+
+    def _check(self, size):
+        if size > self.max_states:
+            raise AnalyticNotTractable("The distribution needs more than {} states".format(self.max_states))
+
+    def _merge_all(self, parts):
+        """
+        Adds up the probabilities of identical states of several distributions, merging them as they come so the
+        states reached are counted before the next ones are built
+        :param parts: iterable of (n, 9) genotype counts and probability of every state
+        :return (tuple): the distinct states, sorted, and their probabilities
+        """
+        states, probabilities, rows = [], [], 0
+        for part_states, part_probabilities in parts:
+            states.append(part_states)
+            probabilities.append(part_probabilities)
+            rows += len(part_states)
+            if rows > _MERGE_FACTOR * self.max_states:
+                merged = _merge(np.concatenate(states), np.concatenate(probabilities))
+                self._check(len(merged[0]))
+                states, probabilities, rows = [merged[0]], [merged[1]], len(merged[0])
+        merged = _merge(np.concatenate(states), np.concatenate(probabilities))
+        self._check(len(merged[0]))
+        return merged
+
+    def _memoize(self, memo, key, value):
+        """
+        Memoizes a distribution, the memos are cleared once they hold a few distributions worth of states
+        """
+        self._memoized += len(value[0])
+        if self._memoized > _MERGE_FACTOR * self.max_states:
+            self._pair_offspring.clear()
+            self._transitions.clear()
+            self._memoized = len(value[0])
+        memo[key] = value
+
+    def pair_offspring(self, first, second):
+        """
+        :param first (int): genotype index of a parent
+        :param second (int): genotype index of the other parent
+        :return (tuple): (n, 9) surviving children counts and probability of every outcome of the pair
+        """
+        key = (min(first, second), max(first, second))
+        offspring = self._pair_offspring.get(key)
+        if offspring is None:
+            n = self.no_of_children
+            children = np.array(list(_compositions((n,) * (NO_OF_GENOTYPES + 1), n)), dtype=np.int64)
+            factorials = np.array([math.factorial(x) for x in range(n + 1)], dtype=float)
+            probabilities = math.factorial(n) * np.prod(self._outcomes[key] ** children / factorials[children],
+                                                        axis=1)
+            possible = probabilities > 0
+            offspring = _merge(children[possible, :NO_OF_GENOTYPES], probabilities[possible])
+            self._memoize(self._pair_offspring, key, offspring)
+        return offspring
+
+    def _pairings(self, state):
+        """
+        Pairs off the lowest genotype left with a uniform partner among the other peas left, which gives a uniform
+        random pairing. An odd pea out is discarded first.
+        :param state (tuple): genotype counts
+        :return (dict): probability of every sorted tuple of (genotype, genotype) pairs
+        """
+        total = sum(state)
+        pending = {}
+        if total % 2 == 1:
+            for k in range(NO_OF_GENOTYPES):
+                if state[k] > 0:
+                    _add(pending, (state[:k] + (state[k] - 1,) + state[k + 1:], ()), state[k] / total)
+        else:
+            pending[(state, ())] = 1.0
+        for _ in range(total // 2):
+            next_pending = {}
+            for (remaining, pairs), p in pending.items():
+                left = sum(remaining)
+                first = next(k for k in range(NO_OF_GENOTYPES) if remaining[k] > 0)
+                remaining = remaining[:first] + (remaining[first] - 1,) + remaining[first + 1:]
+                for second in range(first, NO_OF_GENOTYPES):
+                    if remaining[second] > 0:
+                        rest = remaining[:second] + (remaining[second] - 1,) + remaining[second + 1:]
+                        _add(next_pending, (rest, pairs + ((first, second),)), p * remaining[second] / (left - 1))
+            pending = next_pending
+        return {pairs: p for (_, pairs), p in pending.items()}
+
+    def _offspring(self, pairs):
+        """
+        :param pairs (tuple): sorted (genotype, genotype) pairs
+        :return (tuple): surviving children counts and probability of every outcome of all the pairs, memoized and
+                         built from the outcomes of all the pairs but the last
+        """
+        offspring = self._pair_offspring.get(pairs)
+        if offspring is None:
+            if len(pairs) == 0:
+                offspring = (np.zeros((1, NO_OF_GENOTYPES), dtype=np.int64), np.ones(1))
+            else:
+                offspring = _convolve(self._offspring(pairs[:-1]), self.pair_offspring(*pairs[-1]))
+            self._check(len(offspring[0]))
+            self._memoize(self._pair_offspring, pairs, offspring)
+        return offspring
+
+    def _regulate(self, survivors, target):
+        """
+        Distribution of the regulated generation, the same draws as DensityRegulation.cull_counts
+        :param survivors (tuple): genotype counts of the surviving children, more than the regulation target
+        :param target (float): expected size of the regulated generation, see DensityRegulation.target
+        :return (tuple): genotype counts and probability of every regulated generation
+        """
+        weights = self.survival if self.regulation.weighted else np.ones(NO_OF_GENOTYPES)
+        keep = _keep_probabilities(weights, np.array(survivors), target)
+        states, probabilities = np.zeros((1, 0), dtype=np.int64), np.ones(1)
+        for n, q in zip(survivors, keep.tolist()):
+            kept = np.arange(n + 1)
+            binomial = np.array([math.comb(n, x) for x in kept]) * q ** kept * (1 - q) ** (n - kept)
+            states = np.column_stack((np.repeat(states, n + 1, axis=0), np.tile(kept, len(states))))
+            probabilities = np.outer(probabilities, binomial).ravel()
+        if not self.regulation.EXACT:
+            return states, probabilities
+        # Remove or add back peas at random to hit the target
+        target = int(target)
+        totals = states.sum(axis=1)
+        result = [(states[totals == target], probabilities[totals == target])]
+        for state, p, total in zip(states.tolist(), probabilities.tolist(), totals.tolist()):
+            if target < total:
+                drawn, q = _hypergeometric(tuple(state), total - target)
+                result.append((np.array(state) - drawn, p * q))
+            elif target > total:
+                drawn, q = _hypergeometric(tuple(a - b for a, b in zip(survivors, state)), target - total)
+                result.append((np.array(state) + drawn, p * q))
+        return _merge(np.concatenate([r[0] for r in result]), np.concatenate([r[1] for r in result]))
+
+    def transition(self, state):
+        """
+        :param state (tuple): genotype counts of a generation
+        :return (tuple): genotype counts and probability of every next generation, memoized per state
+        """
+        transition = self._transitions.get(state)
+        if transition is None:
+            states, probabilities = self._merge_all((offspring[0], offspring[1] * p) for offspring, p in
+                                                    ((self._offspring(pairs), p)
+                                                     for pairs, p in self._pairings(state).items()))
+            if self.regulation is not None:
+                targets = [self.regulation.target(size, sum(state)) for size in states.sum(axis=1).tolist()]
+                culled = np.array([target < size for target, size in zip(targets, states.sum(axis=1).tolist())],
+                                  dtype=bool)
+                regulated = [(states[~culled], probabilities[~culled])]
+                for survivors, p, target in zip(map(tuple, states[culled].tolist()), probabilities[culled].tolist(),
+                                                np.array(targets)[culled].tolist()):
+                    # The regulation only depends on the parents through the target
+                    key = (survivors, target)
+                    if key not in self._regulations:
+                        self._regulations[key] = self._regulate(survivors, target)
+                    regulated.append((self._regulations[key][0], self._regulations[key][1] * p))
+                states, probabilities = self._merge_all(regulated)
+            transition = (states, probabilities)
+            self._memoize(self._transitions, state, transition)
+        return transition
+
+    def distributions(self, counts, no_of_generations):
+        """
+        :param counts (ndarray): genotype counts of generation 0
+        :param no_of_generations (int): number of generations
+        :return (list): (n, 9) genotype counts and probability of every state, for every generation
+        :raise AnalyticNotTractable: as soon as a generation, or the outcomes of a transition, reach more than
+                                     max_states states
+        """
+        distribution = (np.array([counts], dtype=np.int64), np.ones(1))
+        result = [distribution]
+        for _ in range(no_of_generations):
+            distribution = self._merge_all((outcomes[0], outcomes[1] * p) for outcomes, p in
+                                           ((self.transition(state), p) for state, p in
+                                            zip(map(tuple, distribution[0].tolist()), distribution[1].tolist())))
+            result.append(distribution)
+        return result
+
+
+class AnalyticResult(object):
+    """
+    Expected statistic columns of every generation with their variance, and the genotype count distributions when
+    they were computed exactly
+    """
+
+    def __init__(self, expected, variance=None, distributions=None):
+        """
+        :param expected (ndarray): (no_of_generations + 1, 11) expected statistic columns of every generation
+        :param variance (ndarray): variance of the same columns
+        :param distributions (list): (n, 9) genotype counts and probability of every state of every generation, None
+                                     for the mean field approximation
+        """
+        self.expected = expected
+        self.variance = variance
+        self.distributions = distributions
+
+    @classmethod
+    def from_distributions(cls, distributions):
+        expected, variance = [], []
+        for states, p in distributions:
+            rows = _stat_rows(states)
+            mean = p @ rows
+            expected.append(mean)
+            variance.append(p @ (rows - mean) ** 2)
+        return cls(np.array(expected), np.array(variance), distributions)
+
+    @classmethod
+    def from_mean_field(cls, trajectory, covariances):
+        # Delta method: the variance of a column is its gradient by the genotype counts through the covariance
+        variance = []
+        for counts, covariance in zip(trajectory, covariances):
+            gradient = _jacobian(lambda c: _stat_rows(c[None, :])[0], counts)
+            variance.append(np.einsum("ij,jk,ik->i", gradient, covariance, gradient))
+        return cls(_stat_rows(trajectory), np.array(variance))
+
+    @property
+    def exact(self):
+        return self.distributions is not None
+
+    def rows(self):
+        """
+        :return (list): one row of Simulate.ANALYTIC_COLUMNS per generation
+        """
+        return [[generation] + expected + variance
+                for generation, (expected, variance) in enumerate(zip(self.expected.tolist(), self.variance.tolist()))]
+
+    def probability(self, generation, predicate):
+        """
+        Probability of an event, for instance that 90% of the population is color dominant homozygote:
+        result.probability(30, lambda stats: stats.color_counts[0] >= 0.9 * stats.total)
+        :param generation (int): generation index
+        :param predicate: function of a GenerationStats returning True for the generations in the event
+        :return (float):
+        """
+        if self.distributions is None:
+            raise AnalyticNotTractable("Probabilities need the exact distributions")
+        states, probabilities = self.distributions[generation]
+        return float(sum(p for state, p in zip(states, probabilities) if predicate(GenerationStats(state))))
@@ -0,0 +1,197 @@
+import os
+import json
+import pickle
+import hashlib
+from mendelianPea import __version__
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mendelian-pea")
+
+
+def _digest(values):
+    """
+    :param values: array like of numbers or strings
+    :return (str): sha256 of the values, in order
+    """
+    digest = hashlib.sha256()
+    for value in values:
+        digest.update(repr(value).encode())
+        digest.update(b",")
+    return digest.hexdigest()
+
+
+def scenario(simulation, seed):
+    """
+    Normalized description of everything the results of an iteration depend on, except the number of iterations:
+    an iteration only depends on its own seed, derived from the master seed and its index
+    :param simulation (Simulate): simulation to describe
+    :param seed (int): master seed
+    :return (dict):
+    """
+    generation0 = simulation.generation0
+    if simulation.engine_mode == simulation.DATAFRAME_ENGINE:
+        peas = zip(generation0["color_gene"], generation0["shape_gene"])
+    elif simulation.engine_mode == simulation.COUNT_ENGINE:
+        peas = generation0.counts.tolist()
+    elif simulation.engine_mode == simulation.GENOME_ENGINE:
+        peas = generation0.words.ravel().tolist()
+    else:
+        peas = generation0.codes.ravel().tolist()
+    regulation = simulation.regulation
+    genome = getattr(simulation.engine, "genome", None)
+    demes = getattr(simulation, "demes", None)
+    return {"version": __version__, "cache-version": ResultCache.VERSION, "seed": seed,
+            "engine": simulation.engine_mode, "engine-revision": simulation.ENGINE_REVISION[simulation.engine_mode],
+            "generation0": _digest(peas),
+            "no-of-generations": simulation.no_of_generations, "no-of-children": simulation.no_of_children,
+            "base-survival": simulation.base_survival,
+            "advantage": sorted((simulation.advantage or {}).items()),
+            "density-regulation": None if regulation is None else
+            [type(regulation).__name__, regulation.REVISION, regulation.capacity, regulation.weighted],
+            "genome": None if genome is None else
+            [[locus.name, list(locus.alleles), locus.dominance, sorted(locus.advantage.items())]
+             for locus in genome.loci],
+            "demes": None if demes is None else dict(demes.to_dict(), sizes=list(generation0.sizes),
+                                                     revision=type(simulation.engine).REVISION)}
+
+
+def scenario_digest(simulation, seed):
+    """
+    :param simulation (Simulate): simulation to describe
+    :param seed (int): master seed
+    :return (str): sha256 of the scenario of the simulation
+    """
+    return hashlib.sha256(json.dumps(scenario(simulation, seed), sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache(object):
+    """
+    On-disk cache of iteration results, content addressed by the sha256 of the normalized scenario of the run
+    (see scenario) and keyed by iteration index, so a run of more iterations of a cached scenario only simulates the
+    new ones. Every iteration is one file, the least recently used ones are evicted once the cache holds more than
+    max_bytes.
+    """
+    VERSION = 1
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=1 << 30):
+        """
+        :param directory (str): cache directory, created when needed
+        :param max_bytes (int): size the cache is brought back to by evict
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, simulation, seed):
+        """
+        :param simulation (Simulate): simulation to run
+        :param seed (int): master seed
+        :return (str): key of the scenario
+        """
+        return scenario_digest(simulation, seed)
+
+    def _path(self, key, iteration):
+        return os.path.join(self.directory, key[:2], key, "{}.pkl".format(iteration))
+
+    def contains(self, key, iteration):
+        return os.path.exists(self._path(key, iteration))
+
+    def get(self, key, iteration):
+        """
+        :param key (str): key of the scenario
+        :param iteration (int): iteration index
+        :return (tuple): the per generation and final result rows of the iteration, None if not cached
+        """
+        path = self._path(key, iteration)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        # The modification time is the last use of the entry
+        os.utime(path)
+        self.hits += 1
+        return result
+
+    def put(self, key, iteration, rows, final_rows):
+        """
+        Atomically writes the results of an iteration
+        :param key (str): key of the scenario
+        :param iteration (int): iteration index
+        :param rows (list): result rows of every generation
+        :param final_rows (list): result rows of the final generation
+        :return:
+        """
+        path = self._path(key, iteration)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((rows, final_rows), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def results(self, key, iterations, compute):
+        """
+        Results of the iterations in order, read from the cache or computed and cached
+        :param key (str): key of the scenario
+        :param iterations (range): iteration indexes
+        :param compute: function of the list of the iterations missing from the cache returning an iterable of
+                        their results in order, as (rows, final rows, events) tuples
+        :return: generator of (rows, final rows, events) tuples, the events of cached iterations are not kept
+        """
+        missing = [y for y in iterations if not self.contains(key, y)]
+        self.misses += len(missing)
+        # compute may start a process pool, it is not called when every iteration is cached
+        computed = iter(compute(missing)) if missing else iter(())
+        missing = set(missing)
+        for y in iterations:
+            cached = None if y in missing else self.get(key, y)
+            if cached is None:
+                result = next(computed) if y in missing else next(iter(compute([y])))
+                self.put(key, y, result[0], result[1])
+                yield result
+            else:
+                yield cached + ([],)
+
+    def size(self):
+        """
+        :return (int): number of bytes held by the cache
+        """
+        return sum(os.path.getsize(path) for path, _ in self._entries())
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".pkl"):
+                    path = os.path.join(root, name)
+                    yield path, os.path.getmtime(path)
+
+    def evict(self):
+        """
+        Removes the least recently used iterations until the cache holds at most max_bytes
+        :return (int): number of iterations removed
+        """
+        entries = sorted(((mtime, path, os.path.getsize(path)) for path, mtime in self._entries()))
+        total = sum(size for _, _, size in entries)
+        removed = 0
+        for _, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+            # The directories of the scenario and of its key prefix go once empty
+            try:
+                os.rmdir(os.path.dirname(path))
+                os.rmdir(os.path.dirname(os.path.dirname(path)))
+            except OSError:
+                pass
+        return removed
+
+    def clear(self):
+        """
+        Removes every cached iteration
+        :return:
+        """
+        for path, _ in list(self._entries()):
+            os.remove(path)
@@ -0,0 +1,128 @@
+import os
+import time
+import pickle
+
+
+class InvalidCheckpoint(Exception):
+    """
+    Exception class for a checkpoint that can not be resumed
+    """
+    pass
+
+
+class Checkpoint(object):
+    """
+    Periodically writes a snapshot of a running simulation to a file so an interrupted run can be resumed.
+    A snapshot is taken once every_generations generations or every_seconds seconds have passed since the last one,
+    whichever comes first. The result rows collected so far are appended to a journal next to the checkpoint file,
+    every snapshot only writes the rows collected since the previous one and the journal offset they end at.
+    """
+    VERSION = 3
+
+    def __init__(self, file_path, every_generations=None, every_seconds=None):
+        """
+        :param file_path (str): checkpoint file
+        :param every_generations (int): number of generations between snapshots
+        :param every_seconds (float): number of seconds between snapshots
+        """
+        self.file_path = file_path
+        self.journal_path = file_path + ".rows"
+        self.every_generations = every_generations
+        self.every_seconds = every_seconds
+        self._generations = 0
+        self._last_save = time.time()
+        # Number of generation and iteration result rows in the journal, and its size. None until the journal of
+        # this run is started by save or load
+        self._journaled = None
+
+    def due(self, generations=1):
+        """
+        Counts completed generations and tells whether a snapshot should be taken now
+        :param generations (int): number of generations completed since the last call
+        :return (bool):
+        """
+        self._generations += generations
+        if self.every_generations is not None and self._generations >= self.every_generations:
+            return True
+        return self.every_seconds is not None and time.time() - self._last_save >= self.every_seconds
+
+    def _journal(self, generation_rows, iteration_rows):
+        """
+        Appends the result rows not in the journal yet
+        :param generation_rows (list): generation result rows of every iteration collected so far
+        :param iteration_rows (list): iteration result rows collected so far
+        :return (tuple): number of generation and iteration result rows in the journal and its size
+        """
+        if self._journaled is None:
+            # A new run, the journal of a previous one is discarded
+            open(self.journal_path, "wb").close()
+            self._journaled = (0, 0, 0)
+        generations, iterations, offset = self._journaled
+        if len(generation_rows) > generations or len(iteration_rows) > iterations:
+            with open(self.journal_path, "r+b") as f:
+                # Rows appended after the snapshot the run resumed from are dropped
+                f.truncate(offset)
+                f.seek(offset)
+                pickle.dump((generation_rows[generations:], iteration_rows[iterations:]), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+                self._journaled = (len(generation_rows), len(iteration_rows), f.tell())
+        return self._journaled
+
+    def save(self, state, generation_rows=(), iteration_rows=()):
+        """
+        Atomically replaces the checkpoint file with a new snapshot
+        :param state (dict): simulation state
+        :param generation_rows (list): generation result rows of every iteration collected so far, only the ones
+                                       collected since the last snapshot are written
+        :param iteration_rows (list): iteration result rows collected so far, only the new ones are written
+        :return:
+        """
+        journaled = self._journal(generation_rows, iteration_rows)
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": Checkpoint.VERSION, "state": state, "journaled": journaled}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.file_path)
+        self._generations = 0
+        self._last_save = time.time()
+
+    def load(self):
+        """
+        :return (dict): the last snapshot with the result rows collected until then in "generation_results" and
+                        "iteration_results", None if there is no checkpoint file
+        """
+        if not os.path.exists(self.file_path):
+            return None
+        with open(self.file_path, "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot.get("version") != Checkpoint.VERSION:
+            raise InvalidCheckpoint("Checkpoint {} has version {}, expected {}".format(
+                self.file_path, snapshot.get("version"), Checkpoint.VERSION))
+        state = snapshot["state"]
+        generations, iterations, offset = snapshot["journaled"]
+        state["generation_results"], state["iteration_results"] = [], []
+        if offset > 0:
+            if not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) < offset:
+                raise InvalidCheckpoint("Result journal {} of checkpoint {} is missing or truncated".format(
+                    self.journal_path, self.file_path))
+            with open(self.journal_path, "rb") as f:
+                # Rows appended after the snapshot, by a run killed before its next one, are ignored
+                while f.tell() < offset:
+                    generation_rows, iteration_rows = pickle.load(f)
+                    state["generation_results"].extend(generation_rows)
+                    state["iteration_results"].extend(iteration_rows)
+        if len(state["generation_results"]) != generations or len(state["iteration_results"]) != iterations:
+            raise InvalidCheckpoint("Result journal {} does not match checkpoint {}".format(
+                self.journal_path, self.file_path))
+        # The resumed run appends to the journal from the end of the snapshot
+        self._journaled = (generations, iterations, offset) if offset > 0 else None
+        return state
+
+    def remove(self):
+        """
+        Removes the checkpoint file and its result journal once the run is complete
+        :return:
+        """
+        for path in (self.file_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
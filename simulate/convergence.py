@@ -0,0 +1,169 @@
+import math
+from statistics import NormalDist
+from mendelianPea.simulate.instrumentation import Observer
+
+# Columns naming the locus or deme of a result row
+LABEL_COLUMNS = ("Locus", "Deme")
+
+
+class InvalidConvergence(Exception):
+    """
+    Exception class for a convergence target that does not match the results of the simulation
+    """
+    pass
+
+
+class RunningMean(object):
+    """
+    Running mean and variance of a series of values (Welford's algorithm)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        """
+        :param value (float):
+        :return:
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        """
+        :return (float): sample standard deviation, 0 for less than 2 values
+        """
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+class Convergence(Observer):
+    """
+    Tracks the mean of some result columns over the final generation of every iteration, along with the half width
+    of their confidence interval, so run_iterations can stop once every half width is within its target.
+
+    Targets are keyed by column name, or by "locus/column" for the per locus results of the genome engine
+    and "deme/column" for the per deme results of a structured population.
+    """
+
+    def __init__(self, targets, confidence=0.95, batch_size=10, min_iterations=10, verbose=False):
+        """
+        :param targets (dict): target confidence interval half width of every tracked column
+        :param confidence (float): confidence level of the intervals, they use the normal approximation
+        :param batch_size (int): number of iterations run between two convergence checks
+        :param min_iterations (int): number of iterations run before the first convergence check
+        :param verbose (bool): print the estimates after every batch
+        """
+        if not targets:
+            raise InvalidConvergence("At least one convergence target is needed")
+        if not 0 < confidence < 1:
+            raise InvalidConvergence("The confidence level must be between 0 and 1, got {}".format(confidence))
+        if batch_size < 1:
+            raise InvalidConvergence("The batch size must be at least 1, got {}".format(batch_size))
+        self.targets = dict(targets)
+        self.confidence = confidence
+        self.batch_size = batch_size
+        self.min_iterations = max(min_iterations, 2)
+        self.verbose = verbose
+        self._z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self._means = {key: RunningMean() for key in self.targets}
+        self._selectors = None
+        self.history = []
+
+    @classmethod
+    def from_config(cls, config, verbose=False):
+        """
+        :param config (dict): the "convergence" entry of a config file, e.g.
+                              {"targets": {"Total": 5}, "confidence": 0.95, "batch-size": 10, "min-iterations": 10}
+        :param verbose (bool): print the estimates after every batch
+        :return (Convergence): None if config is None
+        """
+        if config is None:
+            return None
+        return cls(config.get("targets"), config.get("confidence", 0.95), config.get("batch-size", 10),
+                   config.get("min-iterations", 10), verbose)
+
+    def bind(self, columns):
+        """
+        Resolves the targets against the result columns of the simulation
+        :param columns (list): Simulate.columns
+        :return:
+        """
+        self._selectors = {}
+        # Targets of a locus or deme other than the first row are prefixed with its name
+        label = next((c for c in LABEL_COLUMNS if c in columns), None)
+        for key in self.targets:
+            locus, _, column = key.rpartition("/")
+            if column not in columns or (locus and label is None):
+                raise InvalidConvergence("Not a valid convergence target {}, expected one of {}".format(
+                    key, columns))
+            self._selectors[key] = (locus or None, columns.index(column), columns.index(label) if locus else None)
+
+    def _value(self, key, rows):
+        locus, column, locus_column = self._selectors[key]
+        if locus is None:
+            return rows[0][column]
+        for row in rows:
+            if row[locus_column] == locus:
+                return row[column]
+        raise InvalidConvergence("No locus or deme {} in the results".format(locus))
+
+    def on_iteration(self, iteration, rows):
+        for key, mean in self._means.items():
+            mean.add(float(self._value(key, rows)))
+
+    def replay(self, rows):
+        """
+        Feeds the final rows of iterations collected before a resume
+        :param rows (list): Simulate.iteration_result_rows
+        :return:
+        """
+        start = 0
+        for n in range(1, len(rows) + 1):
+            if n == len(rows) or rows[n][0] != rows[start][0]:
+                self.on_iteration(rows[start][0], rows[start:n])
+                start = n
+
+    @property
+    def iterations(self):
+        return next(iter(self._means.values())).count
+
+    def estimates(self):
+        """
+        :return (dict): (mean, confidence interval half width, target) of every tracked column
+        """
+        return {key: (mean.mean, self._z * mean.std / math.sqrt(mean.count) if mean.count > 0 else float("inf"),
+                      self.targets[key]) for key, mean in self._means.items()}
+
+    def converged(self):
+        """
+        :return (bool): True once min_iterations ran and every half width is within its target
+        """
+        return self.iterations >= self.min_iterations and \
+            all(half_width <= target for _, half_width, target in self.estimates().values())
+
+    def batch_end(self, start):
+        """
+        :param start (int): first iteration not run yet
+        :return (int): end of the batch starting there, batches are aligned on multiples of batch_size so the
+                       convergence checks happen at the same iterations when a run is resumed
+        """
+        return (start // self.batch_size + 1) * self.batch_size
+
+    def end_batch(self):
+        """
+        Records, and prints when verbose, the estimates once a batch is collected
+        :return:
+        """
+        estimates = self.estimates()
+        self.history.append({"iterations": self.iterations, "converged": self.converged(),
+                             "estimates": {key: {"mean": m, "half_width": h, "target": t}
+                                           for key, (m, h, t) in estimates.items()}})
+        if self.verbose:
+            print("Iterations : {} : {}".format(self.iterations, " , ".join(
+                "{} : {:.6g} +/- {:.3g} (target {:.3g})".format(key, m, h, t) for key, (m, h, t) in
+                estimates.items())))
@@ -0,0 +1,500 @@
+import multiprocessing
+import multiprocessing.util
+import numpy as np
+from mendelianPea.pea.pea import Pea
+from mendelianPea.pea.population import PeaPopulation, survival_table
+from mendelianPea.simulate.engine import VectorizedEngine
+from mendelianPea.simulate.stats import GenerationStats, DemeStats, code_genotypes
+from mendelianPea.simulate.instrumentation import new_timings
+
+# Bytes per pea in the migration buffers, its color and shape codes
+_PEA_BYTES = 2
+
+
+class InvalidDemes(Exception):
+    """
+    Exception class for an invalid structured population config
+    """
+    pass
+
+
+def deme_survival_table(advantage, base_survival):
+    """
+    :param advantage (dict): gene advantages of the deme, the current Pea ones if None
+    :param base_survival (float): base survival chance of the deme, the current Pea one if None
+    :return (ndarray): 4x4 survival table of the deme, see pea.population.survival_table. The Pea settings are left
+                       unchanged
+    """
+    if advantage is None and base_survival is None:
+        return survival_table()
+    saved = Pea.ADVANTAGE, Pea.BASE_SURVIVAL_CHANCE
+    try:
+        if advantage is not None:
+            Pea.set_advantage(advantage)
+        if base_survival is not None:
+            Pea.set_base_survival(base_survival)
+        return survival_table()
+    finally:
+        Pea.set_advantage(saved[0])
+        Pea.set_base_survival(saved[1])
+
+
+class Deme(object):
+    """
+    A subpopulation with its own environment
+    """
+
+    def __init__(self, name, advantage=None, base_survival=None, generation0=None):
+        """
+        :param name (str): name of the deme in the results
+        :param advantage (dict): gene advantages in the deme, the ones of the simulation if None
+        :param base_survival (float): base survival chance in the deme, the one of the simulation if None
+        :param generation0 (dict): generation0 config of the deme, it gets a share of the generation0 of the
+                                   simulation if None
+        """
+        self.name = name
+        self.advantage = advantage
+        self.base_survival = base_survival
+        self.generation0 = generation0
+
+    def to_dict(self):
+        return {"name": self.name, "advantage": None if self.advantage is None else sorted(self.advantage.items()),
+                "base-survival": self.base_survival, "generation0": self.generation0}
+
+
+class Demes(object):
+    """
+    Structured population: demes evolving side by side, exchanging migrants after every generation. Every pea of
+    deme i moves to deme j with probability migration[i][j], after the survival and density regulation of the
+    generation.
+    """
+
+    def __init__(self, demes, migration, workers=1):
+        """
+        :param demes (list): Deme of every deme
+        :param migration (ndarray): (demes, demes) migration matrix, every row sums to 1
+        :param workers (int): number of processes the demes are spread over, demes run in this process when 1
+        """
+        self.demes = demes
+        self.migration = np.asarray(migration, dtype=float)
+        self.workers = workers
+        k = len(demes)
+        if k == 0:
+            raise InvalidDemes("At least one deme is needed")
+        if self.migration.shape != (k, k):
+            raise InvalidDemes("The migration matrix must be {0}x{0}, got {1}".format(k, self.migration.shape))
+        if (self.migration < 0).any() or not np.allclose(self.migration.sum(axis=1), 1):
+            raise InvalidDemes("Every row of the migration matrix must be probabilities summing to 1")
+        if len(set(self.names)) != k or DemeStats.GLOBAL_DEME in self.names:
+            raise InvalidDemes("Deme names must be unique and not {}".format(DemeStats.GLOBAL_DEME))
+
+    @classmethod
+    def from_config(cls, demes, migration=None, workers=1):
+        """
+        :param demes: number of demes or list of deme configs with an optional name, advantage, base-survival and
+                      generation0
+        :param migration: migration matrix, or migration rate m of the island model where a pea moves to each of
+                          the other demes with probability m / (demes - 1). No migration if None
+        :param workers (int): number of processes the demes are spread over
+        :return (Demes):
+        """
+        if isinstance(demes, int):
+            demes = [{}] * demes
+        demes = [Deme(config.get("name", str(n)), config.get("advantage"), config.get("base-survival"),
+                      config.get("generation0")) for n, config in enumerate(demes)]
+        k = len(demes)
+        if migration is None:
+            migration = 0.0
+        if isinstance(migration, (int, float)):
+            if not 0 <= migration <= 1:
+                raise InvalidDemes("The migration rate must be between 0 and 1, got {}".format(migration))
+            migration = np.full((k, k), migration / (k - 1) if k > 1 else 0.0)
+            np.fill_diagonal(migration, 1 - migration.sum(axis=1) + np.diag(migration))
+        return cls(demes, migration, workers)
+
+    @property
+    def names(self):
+        return [deme.name for deme in self.demes]
+
+    def __len__(self):
+        return len(self.demes)
+
+    def population(self, peas, deme_peas):
+        """
+        Splits generation0 in demes
+        :param peas: peas of the simulation generation0, shared in turn between the demes without their own
+        :param deme_peas (list): peas of every deme, None for the demes getting a share of peas
+        :return (DemePopulation):
+        """
+        peas = PeaPopulation.from_peas(peas)
+        sharing = [d for d, own in enumerate(deme_peas) if own is None]
+        populations = [PeaPopulation.from_peas(own) if own is not None else None for own in deme_peas]
+        for n, d in enumerate(sharing):
+            populations[d] = PeaPopulation(peas.codes[n::len(sharing)].copy())
+        return DemePopulation(populations)
+
+    def to_dict(self):
+        return {"demes": [deme.to_dict() for deme in self.demes], "migration": self.migration.tolist()}
+
+
+class DemePopulation(object):
+    """
+    A generation split in demes. The generations produced by DemeEngine only hold the size of every deme, the peas
+    stay with the processes running the demes, see DemeEngine.snapshot.
+    """
+
+    def __init__(self, populations=None, sizes=None, rng_states=None):
+        """
+        :param populations (list): PeaPopulation of every deme, None when held by the deme processes
+        :param sizes (list): size of every deme, from the populations if None
+        :param rng_states (list): random generator state of every deme to continue from, for checkpoints
+        """
+        self.populations = populations
+        self.sizes = sizes if sizes is not None else [len(p) for p in populations]
+        self.rng_states = rng_states
+
+    def __len__(self):
+        return int(sum(self.sizes))
+
+    @property
+    def codes(self):
+        """
+        :return (ndarray): (n, 2) color and shape codes of all the peas, deme after deme
+        """
+        return np.concatenate([p.codes for p in self.populations])
+
+    def survival(self):
+        """
+        :return (ndarray): survival chance of every pea with the current Pea settings
+        """
+        return np.concatenate([p.survival() for p in self.populations])
+
+
+class _DemeRunner(object):
+    """
+    Runs some of the demes of a structured population, in the main process or in a deme process
+    """
+
+    def __init__(self, deme_ids, no_of_children, regulation, tables, migration):
+        """
+        :param deme_ids (list): demes run
+        :param no_of_children (int): Number of children a pair of peas can spawn per generation
+        :param regulation (DensityRegulation): culls the survivors of every deme
+        :param tables (list): survival table of every deme
+        :param migration (ndarray): migration matrix
+        """
+        self.deme_ids = deme_ids
+        self.migration = migration
+        self.thresholds = np.cumsum(migration, axis=1)
+        self.engines = {d: VectorizedEngine(no_of_children, regulation=regulation, survival=tables[d])
+                        for d in deme_ids}
+        self.populations = {}
+        self._stayers = {}
+
+    def load(self, codes, rng_states):
+        """
+        :param codes (dict): gene codes of the peas of every deme
+        :param rng_states (dict): random generator state of every deme
+        :return:
+        """
+        for d in self.deme_ids:
+            self.populations[d] = PeaPopulation(np.array(codes[d], dtype=np.uint8).reshape(-1, _PEA_BYTES))
+            self.engines[d].rng = np.random.default_rng()
+            self.engines[d].rng.bit_generator.state = rng_states[d]
+
+    def step(self):
+        """
+        Produces the next generation of every deme and picks the deme every child moves to
+        :return (tuple): for every deme the codes of its children grouped by destination deme and the number of
+                         children going to every deme, and the time spent in every phase over the demes
+        """
+        results = {}
+        timings = new_timings()
+        for d in self.deme_ids:
+            engine = self.engines[d]
+            children = engine.next_generation(self.populations[d])
+            for phase, seconds in engine.timings.items():
+                timings[phase] += seconds
+            destinations = np.searchsorted(self.thresholds[d], engine.rng.random(len(children)), side="right")
+            destinations = np.minimum(destinations, len(self.migration) - 1)
+            order = np.argsort(destinations, kind="stable")
+            results[d] = (children.codes[order], np.bincount(destinations, minlength=len(self.migration)))
+        return results, timings
+
+    def immigrate(self, arrivals):
+        """
+        :param arrivals (dict): for every deme the codes of the peas moving in from every deme, itself included, in
+                                deme order
+        :return (dict): genotype counts of every deme
+        """
+        counts = {}
+        for d in self.deme_ids:
+            population = PeaPopulation(np.concatenate(arrivals[d]) if arrivals[d] else
+                                       np.empty((0, _PEA_BYTES), dtype=np.uint8))
+            self.populations[d] = population
+            counts[d] = np.bincount(code_genotypes(population.color, population.shape), minlength=9)
+        return counts
+
+    def snapshot(self):
+        """
+        :return (dict): codes of the peas and random generator state of every deme
+        """
+        return {d: (self.populations[d].codes.copy(), self.engines[d].rng.bit_generator.state)
+                for d in self.deme_ids}
+
+
+def _deme_process(connection, runner):
+    """
+    Main loop of a deme process. Migrants are written to an outbox in shared memory owned by the process, the
+    other deme processes copy the peas moving to their demes straight from it. Only the owner unlinks an outbox.
+    :param connection (multiprocessing Connection): commands from the DemeEngine
+    :param runner (_DemeRunner): demes of the process
+    :return:
+    """
+    from multiprocessing import shared_memory
+    outbox = None
+    attached = {}
+    try:
+        while True:
+            command, payload = connection.recv()
+            if command == "load":
+                runner.load(*payload)
+                connection.send(None)
+            elif command == "step":
+                results, timings = runner.step()
+                size = sum(len(codes) for codes, _ in results.values()) * _PEA_BYTES
+                if outbox is None or outbox.size < size:
+                    if outbox is not None:
+                        outbox.close()
+                        outbox.unlink()
+                    outbox = shared_memory.SharedMemory(create=True, size=max(2 * size, 4096))
+                offsets, offset = {}, 0
+                for d, (codes, destinations) in results.items():
+                    outbox.buf[offset * _PEA_BYTES:(offset + len(codes)) * _PEA_BYTES] = codes.tobytes()
+                    offsets[d] = (offset, destinations)
+                    offset += len(codes)
+                connection.send((outbox.name, offsets, timings))
+            elif command == "immigrate":
+                for name in set(attached) - {name for plan in payload.values() for name, _, _ in plan}:
+                    attached.pop(name).close()
+                arrivals = {}
+                for d, plan in payload.items():
+                    arrivals[d] = []
+                    for name, start, count in plan:
+                        if name not in attached:
+                            attached[name] = shared_memory.SharedMemory(name=name)
+                        arrivals[d].append(np.frombuffer(attached[name].buf, dtype=np.uint8, count=count * _PEA_BYTES,
+                                                         offset=start * _PEA_BYTES).reshape(-1, _PEA_BYTES).copy())
+                connection.send(runner.immigrate(arrivals))
+            elif command == "snapshot":
+                connection.send(runner.snapshot())
+            elif command == "close":
+                return
+    finally:
+        for memory in attached.values():
+            memory.close()
+        if outbox is not None:
+            outbox.close()
+            outbox.unlink()
+
+
+def _stop(processes):
+    for process, connection, _ in processes:
+        try:
+            connection.send(("close", None))
+        except (OSError, EOFError):
+            pass
+    for process, connection, _ in processes:
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+        connection.close()
+
+
+class DemeEngine(object):
+    """
+    Generation engine for structured populations, see Demes. Every deme follows the model of VectorizedEngine with
+    its own survival table and random stream, then the children move between demes along the migration matrix.
+    With more than one worker the demes are spread over persistent processes and the migrants go through shared
+    memory, the results are the same whatever the number of workers.
+    """
+    # Revision of the migration sampling, see Simulate.ENGINE_REVISION
+    REVISION = 1
+
+    def __init__(self, no_of_children, demes, advantage=None, base_survival=None, rng=None, regulation=None):
+        """
+        :param no_of_children (int): Number of children a pair of peas can spawn per generation
+        :param demes (Demes): demes and migration matrix
+        :param advantage (dict): gene advantages of the demes without their own, the Pea settings if None
+        :param base_survival (float): base survival chance of the demes without their own, the Pea setting if None
+        :param rng (numpy Generator): random generator the deme random streams are drawn from
+        :param regulation (DensityRegulation): culls the survivors of every deme
+        """
+        self.no_of_children = no_of_children
+        self.demes = demes
+        self.regulation = regulation
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.advantage = advantage
+        self.base_survival = base_survival
+        self.timings = new_timings()
+        self.last_stats = DemeStats(demes.names, [GenerationStats() for _ in demes.demes])
+        self._runner = None
+        self._processes = None
+        self._finalizer = None
+        self._current = None
+
+    def __getstate__(self):
+        # Shipped to a worker process without the deme processes
+        state = self.__dict__.copy()
+        state.update(_runner=None, _processes=None, _current=None, _finalizer=None)
+        return state
+
+    def _start(self):
+        # The survival tables are built when the run starts, from the Pea settings of the run
+        k = len(self.demes)
+        tables = [deme_survival_table(deme.advantage if deme.advantage is not None else self.advantage,
+                                      deme.base_survival if deme.base_survival is not None else self.base_survival)
+                  for deme in self.demes.demes]
+        workers = min(self.demes.workers, k)
+        if workers <= 1:
+            self._runner = _DemeRunner(list(range(k)), self.no_of_children, self.regulation, tables,
+                                       self.demes.migration)
+            return
+        # The deme processes share the resource tracker of this process, so an outbox is tracked until its owner
+        # unlinks it whichever processes attached it
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+        self._processes = []
+        for w in range(workers):
+            deme_ids = list(range(w, k, workers))
+            runner = _DemeRunner(deme_ids, self.no_of_children, self.regulation, tables, self.demes.migration)
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_deme_process, args=(child, runner), daemon=True)
+            process.start()
+            child.close()
+            self._processes.append((process, connection, deme_ids))
+        # Stops the deme processes cleanly when the engine is dropped or its process exits, e.g. a pool worker,
+        # before multiprocessing terminates them
+        self._finalizer = multiprocessing.util.Finalize(self, _stop, args=(self._processes,), exitpriority=10)
+
+    def _call(self, command, payloads=None):
+        """
+        Runs a command on every deme process
+        :param payloads (list): payload of every process
+        :return (list): reply of every process
+        """
+        for n, (_, connection, _) in enumerate(self._processes):
+            connection.send((command, payloads[n] if payloads is not None else None))
+        return [connection.recv() for _, connection, _ in self._processes]
+
+    def close(self):
+        """
+        Stops the deme processes
+        :return:
+        """
+        if self._processes is not None:
+            self._finalizer()
+        self._processes = None
+        self._runner = None
+        self._current = None
+
+    def from_peas(self, peas):
+        """
+        :param peas (DemePopulation): generation0 split in demes, see Demes.population
+        :return (DemePopulation):
+        """
+        if not isinstance(peas, DemePopulation):
+            raise InvalidDemes("A structured population starts from a DemePopulation, see Demes.population")
+        return peas
+
+    def generation_stats(self, generation):
+        """
+        :param generation (DemePopulation): generation to summarise
+        :return (DemeStats): genotype counts of every deme
+        """
+        if generation.populations is None:
+            generation = self.snapshot(generation)
+        return DemeStats(self.demes.names,
+                         [GenerationStats.from_genotypes(code_genotypes(p.color, p.shape))
+                          for p in generation.populations])
+
+    def _load(self, generation):
+        # Hands a generation over to the demes, a new iteration draws the random stream of every deme
+        if self._runner is None and self._processes is None:
+            self._start()
+        k = len(self.demes)
+        rng_states = generation.rng_states
+        if rng_states is None:
+            rng_states = [np.random.default_rng(seed).bit_generator.state
+                          for seed in self.rng.integers(0, 2 ** 63, size=k)]
+        codes = {d: generation.populations[d].codes for d in range(k)}
+        states = dict(enumerate(rng_states))
+        if self._runner is not None:
+            self._runner.load(codes, states)
+        else:
+            self._call("load", [({d: codes[d] for d in ids}, {d: states[d] for d in ids})
+                                for _, _, ids in self._processes])
+
+    def next_generation(self, generation):
+        """
+        Generates the surviving children of every deme and moves the migrants
+        :param generation (DemePopulation): current generation
+        :return (DemePopulation): next generation, held by the demes
+        """
+        if generation is not self._current:
+            self._load(generation)
+        k = len(self.demes)
+        if self._runner is not None:
+            results, self.timings = self._runner.step()
+            arrivals = {j: [] for j in range(k)}
+            for d in range(k):
+                codes, destinations = results[d]
+                bounds = np.concatenate(([0], np.cumsum(destinations)))
+                for j in range(k):
+                    arrivals[j].append(codes[bounds[j]:bounds[j + 1]])
+            counts = self._runner.immigrate(arrivals)
+        else:
+            # The outbox of every process holds the children of its demes, grouped by destination
+            replies = self._call("step")
+            self.timings = new_timings()
+            sources = {}
+            for name, offsets, timings in replies:
+                for phase, seconds in timings.items():
+                    self.timings[phase] += seconds
+                for d, (offset, destinations) in offsets.items():
+                    sources[d] = (name, offset, destinations)
+            plans = []
+            for _, _, ids in self._processes:
+                plan = {}
+                for j in ids:
+                    plan[j] = []
+                    for d in range(k):
+                        name, offset, destinations = sources[d]
+                        plan[j].append((name, offset + int(destinations[:j].sum()), int(destinations[j])))
+                plans.append(plan)
+            counts = {}
+            for reply in self._call("immigrate", plans):
+                counts.update(reply)
+        self.last_stats = DemeStats(self.demes.names, [GenerationStats(counts[d]) for d in range(k)])
+        self._current = DemePopulation(sizes=[self.last_stats.demes[d].total for d in range(k)])
+        return self._current
+
+    def snapshot(self, generation):
+        """
+        :param generation (DemePopulation): generation returned by next_generation
+        :return (DemePopulation): the generation with the peas and random stream of every deme, e.g. for a
+                                  checkpoint
+        """
+        if generation.populations is not None:
+            return generation
+        if generation is not self._current:
+            raise InvalidDemes("Only the last generation produced is held by the demes")
+        if self._runner is not None:
+            snapshots = self._runner.snapshot()
+        else:
+            snapshots = {}
+            for reply in self._call("snapshot"):
+                snapshots.update(reply)
+        k = len(self.demes)
+        return DemePopulation([PeaPopulation(snapshots[d][0]) for d in range(k)],
+                              rng_states=[snapshots[d][1] for d in range(k)])
@@ -0,0 +1,308 @@
+import time
+import numpy as np
+from mendelianPea.simulate.instrumentation import new_timings, PAIRING, SPAWNING, SURVIVAL
+from mendelianPea.simulate.stats import GenerationStats, GenomeStats, NO_OF_GENOTYPES, pea_genotype, code_genotypes
+from mendelianPea.pea.pea import Pea
+from mendelianPea.pea.population import PeaPopulation, survival_table, DOMINANT_HOMOZYGOTE, RECESSIVE_HOMOZYGOTE
+from mendelianPea.pea.genome import Genome, GenomePopulation, InvalidGenome, gametes
+
+
+class InvalidEngine(Exception):
+    """
+    Exception class for an unknown simulation engine mode
+    """
+    pass
+
+
+class VectorizedEngine(object):
+    """
+    Generation engine working on whole generations of gene codes with batched random draws.
+    It follows the same model as Simulate.get_next_generation: the generation is shuffled, consecutive peas
+    pair up (an odd pea out is discarded), every pair spawns no_of_children children, each child
+    survives with the survival chance of its genes and the survivors go through the density regulation if any.
+    """
+
+    def __init__(self, no_of_children, rng=None, regulation=None, survival=None):
+        """
+        :param no_of_children (int): Number of children a pair of peas can spawn per generation
+        :param rng (numpy Generator): random generator to draw from, a fresh one if not supplied
+        :param regulation (DensityRegulation): culls the surviving children when supplied
+        :param survival (ndarray): 4x4 survival table by color and shape code, read from the current Pea settings
+                                   every generation if not supplied (see pea.population.survival_table)
+        """
+        self.no_of_children = no_of_children
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.regulation = regulation
+        self.survival = survival
+        self.timings = new_timings()
+        # Genotype counts of the last generation produced, counted in one pass over its survivors once they are drawn
+        self.last_stats = GenerationStats()
+        # Records the parents and allele picks of the survivors when set, see simulate.lineage
+        self.lineage = None
+
+    def from_peas(self, peas):
+        """
+        :param peas: list of peas
+        :return (PeaPopulation): the generation in the engine representation
+        """
+        return PeaPopulation.from_peas(peas)
+
+    def next_generation(self, generation):
+        """
+        Generates the surviving children of the supplied generation. Unlike the per child updates of the dataframe
+        engine, last_stats is a single bincount over the survivors after the survival roll and the culling, a rescan
+        of the new generation that is cheaper than counting every child and removing the dead ones
+        :param generation (PeaPopulation): current generation
+        :return (PeaPopulation): next generation
+        """
+        t1 = time.perf_counter()
+        order = self.rng.permutation(len(generation))
+        no_of_pairs = len(order) // 2
+        parent1 = np.repeat(order[0:2 * no_of_pairs:2], self.no_of_children)
+        parent2 = np.repeat(order[1:2 * no_of_pairs:2], self.no_of_children)
+        t2 = time.perf_counter()
+
+        # One allele pick per parent per gene, then a single survival roll per child
+        picks = self.rng.integers(0, 2, size=(4, len(parent1)), dtype=np.uint8)
+        color_codes, shape_codes = generation.color, generation.shape
+        color = ((color_codes[parent1] >> picks[0]) & 1) | (((color_codes[parent2] >> picks[1]) & 1) << 1)
+        shape = ((shape_codes[parent1] >> picks[2]) & 1) | (((shape_codes[parent2] >> picks[3]) & 1) << 1)
+        t3 = time.perf_counter()
+
+        survival = (self.survival if self.survival is not None else survival_table())[color, shape]
+        alive = self.rng.random(len(color)) < survival
+        if self.regulation is not None:
+            alive[alive] = self.regulation.cull(survival[alive], len(generation), self.rng)
+        if self.lineage is not None:
+            self.lineage.record(parent1[alive], parent2[alive], picks[:, alive])
+        color, shape = color[alive], shape[alive]
+        self.last_stats = GenerationStats.from_genotypes(code_genotypes(color, shape))
+        next_generation = PeaPopulation.from_codes(color, shape)
+        self.timings = {PAIRING: t2 - t1, SPAWNING: t3 - t2, SURVIVAL: time.perf_counter() - t3}
+        return next_generation
+
+    def generation_stats(self, generation):
+        """
+        :param generation (PeaPopulation): generation to summarise
+        :return (GenerationStats): genotype counts of the generation, scanning every pea
+        """
+        return GenerationStats.from_genotypes(code_genotypes(generation.color, generation.shape))
+
+
+# Gene code of every unordered genotype class, see simulate.stats
+CLASS_TO_CODE = (DOMINANT_HOMOZYGOTE, 1, RECESSIVE_HOMOZYGOTE)
+
+
+def _mendelian_table():
+    """
+    :return (ndarray): 9x9x9 table with the probability of every child genotype for every pair of parent genotypes
+    """
+    # Probability of a child gene class given the classes of both parents, a parent passes its recessive allele
+    # with probability class / 2
+    gene = np.empty((3, 3, 3))
+    for a in range(3):
+        for b in range(3):
+            pa, pb = a / 2, b / 2
+            gene[a, b] = [(1 - pa) * (1 - pb), pa * (1 - pb) + (1 - pa) * pb, pa * pb]
+    table = np.empty((NO_OF_GENOTYPES, NO_OF_GENOTYPES, NO_OF_GENOTYPES))
+    for i in range(NO_OF_GENOTYPES):
+        for j in range(NO_OF_GENOTYPES):
+            table[i, j] = np.outer(gene[i // 3, j // 3], gene[i % 3, j % 3]).ravel()
+    return table
+
+
+MENDELIAN_TABLE = _mendelian_table()
+
+
+def genotype_survival():
+    """
+    :return (ndarray): survival chance of every unordered genotype index from the current Pea settings
+    """
+    table = survival_table()
+    return np.array([table[CLASS_TO_CODE[g // 3], CLASS_TO_CODE[g % 3]] for g in range(NO_OF_GENOTYPES)])
+
+
+class GenotypeCounts(object):
+    """
+    A generation of peas held as the number of peas of each of the 9 unordered genotypes
+    """
+
+    def __init__(self, counts):
+        """
+        :param counts (ndarray): int64 count per genotype index
+        """
+        self.counts = counts
+
+    @classmethod
+    def from_peas(cls, peas):
+        """
+        Builds the counts from a list of Peas or a PeaPopulation
+        :param peas: list of peas
+        :return (GenotypeCounts):
+        """
+        if isinstance(peas, PeaPopulation):
+            return cls(np.bincount(code_genotypes(peas.color, peas.shape), minlength=NO_OF_GENOTYPES).astype(np.int64))
+        counts = np.zeros(NO_OF_GENOTYPES, dtype=np.int64)
+        for p in peas:
+            counts[pea_genotype(p)] += 1
+        return cls(counts)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+
+class CountEngine(object):
+    """
+    Generation engine working on genotype counts instead of individual peas.
+    Pairing, spawning and survival are multivariate hypergeometric, multinomial and binomial draws over the
+    9 genotype counts, so a generation costs the same whatever the population size.
+    """
+
+    # Above this population size the pairing is drawn with replacement, numpy's hypergeometric
+    # sampler does not support larger populations and the difference is negligible there
+    EXACT_PAIRING_LIMIT = 10 ** 9
+
+    def __init__(self, no_of_children, rng=None, regulation=None):
+        """
+        :param no_of_children (int): Number of children a pair of peas can spawn per generation
+        :param rng (numpy Generator): random generator to draw from, a fresh one if not supplied
+        :param regulation (DensityRegulation): culls the surviving children when supplied
+        """
+        self.no_of_children = no_of_children
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.regulation = regulation
+        self.timings = new_timings()
+        # Genotype counts of the last generation produced, the survivor counts themselves so never rescanned
+        self.last_stats = GenerationStats()
+
+    def from_peas(self, peas):
+        """
+        :param peas: list of peas
+        :return (GenotypeCounts): the generation in the engine representation
+        """
+        return GenotypeCounts.from_peas(peas)
+
+    def _pairs(self, counts):
+        """
+        Randomly pairs up the peas, discarding an odd pea out
+        :param counts (ndarray): genotype counts
+        :return (ndarray): 9x9 matrix with the number of pairs for every (parent 1, parent 2) genotype
+        """
+        total = int(counts.sum())
+        if total % 2 == 1:
+            counts = counts - self.rng.multinomial(1, counts / total)
+            total -= 1
+        no_of_pairs = total // 2
+        if no_of_pairs == 0:
+            return np.zeros((NO_OF_GENOTYPES, NO_OF_GENOTYPES), dtype=np.int64)
+
+        if total >= CountEngine.EXACT_PAIRING_LIMIT:
+            frequency = counts / total
+            return self.rng.multinomial(no_of_pairs, np.outer(frequency, frequency).ravel()).reshape(
+                NO_OF_GENOTYPES, NO_OF_GENOTYPES)
+
+        first = self.rng.multivariate_hypergeometric(counts, no_of_pairs)
+        second = counts - first
+        pairs = np.zeros((NO_OF_GENOTYPES, NO_OF_GENOTYPES), dtype=np.int64)
+        for i in np.flatnonzero(first):
+            pairs[i] = self.rng.multivariate_hypergeometric(second, first[i])
+            second = second - pairs[i]
+        return pairs
+
+    def next_generation(self, generation):
+        """
+        Generates the surviving children of the supplied generation
+        :param generation (GenotypeCounts): current generation
+        :return (GenotypeCounts): next generation
+        """
+        t1 = time.perf_counter()
+        pairs = self._pairs(generation.counts).ravel()
+        t2 = time.perf_counter()
+        children = self.rng.multinomial(pairs * self.no_of_children,
+                                        MENDELIAN_TABLE.reshape(-1, NO_OF_GENOTYPES)).sum(axis=0)
+        t3 = time.perf_counter()
+        survival = genotype_survival()
+        survivors = self.rng.binomial(children, survival)
+        if self.regulation is not None:
+            survivors = self.regulation.cull_counts(survivors, survival, len(generation), self.rng)
+        next_generation = GenotypeCounts(survivors)
+        self.last_stats = GenerationStats(survivors)
+        self.timings = {PAIRING: t2 - t1, SPAWNING: t3 - t2, SURVIVAL: time.perf_counter() - t3}
+        return next_generation
+
+    def generation_stats(self, generation):
+        """
+        :param generation (GenotypeCounts): generation to summarise
+        :return (GenerationStats): genotype counts of the generation
+        """
+        return GenerationStats(generation.counts)
+
+
+class GenomeEngine(object):
+    """
+    Generation engine for multi-locus genomes, see pea.genome. It follows the same model as VectorizedEngine with
+    every genome packed 2 bits per locus into uint64 words: a parent passes one allele of every locus at once
+    through bitwise operations on its words and survival is looked up byte by byte.
+    """
+
+    def __init__(self, no_of_children, rng=None, regulation=None, genome=None):
+        """
+        :param no_of_children (int): Number of children a pair of peas can spawn per generation
+        :param rng (numpy Generator): random generator to draw from, a fresh one if not supplied
+        :param regulation (DensityRegulation): culls the surviving children when supplied
+        :param genome (Genome): genome definition, the two locus pea genome with the current Pea.ADVANTAGE if not
+                                supplied
+        """
+        self.no_of_children = no_of_children
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.regulation = regulation
+        self.genome = genome if genome is not None else Genome.default(Pea.ADVANTAGE)
+        self.timings = new_timings()
+        # Locus counts of the last generation produced, counted in one pass over its survivors once they are drawn
+        self.last_stats = GenomeStats(self.genome)
+
+    def from_peas(self, peas):
+        """
+        :param peas: a GenomePopulation, or a list of peas or a PeaPopulation for the default genome
+        :return (GenomePopulation): the generation in the engine representation
+        """
+        if isinstance(peas, GenomePopulation):
+            return peas
+        if self.genome.names != Genome.default().names:
+            raise InvalidGenome("Peas can only start a two locus genome, build a GenomePopulation for {}".format(
+                self.genome.names))
+        population = PeaPopulation.from_peas(peas)
+        return GenomePopulation(self.genome.pack(population.codes), self.genome)
+
+    def next_generation(self, generation):
+        """
+        Generates the surviving children of the supplied generation
+        :param generation (GenomePopulation): current generation
+        :return (GenomePopulation): next generation
+        """
+        t1 = time.perf_counter()
+        order = self.rng.permutation(len(generation))
+        no_of_pairs = len(order) // 2
+        parent1 = np.repeat(order[0:2 * no_of_pairs:2], self.no_of_children)
+        parent2 = np.repeat(order[1:2 * no_of_pairs:2], self.no_of_children)
+        t2 = time.perf_counter()
+
+        words = generation.words
+        children = gametes(words[parent1], self.rng) | (gametes(words[parent2], self.rng) << np.uint64(1))
+        t3 = time.perf_counter()
+
+        survival = self.genome.survival(children, Pea.BASE_SURVIVAL_CHANCE)
+        alive = self.rng.random(len(children)) < survival
+        if self.regulation is not None:
+            alive[alive] = self.regulation.cull(survival[alive], len(generation), self.rng)
+        next_generation = GenomePopulation(children[alive], self.genome)
+        self.last_stats = self.generation_stats(next_generation)
+        self.timings = {PAIRING: t2 - t1, SPAWNING: t3 - t2, SURVIVAL: time.perf_counter() - t3}
+        return next_generation
+
+    def generation_stats(self, generation):
+        """
+        :param generation (GenomePopulation): generation to summarise
+        :return (GenomeStats): genotype counts of every locus of the generation
+        """
+        return GenomeStats(self.genome, self.genome.locus_counts(generation.words))
@@ -0,0 +1,165 @@
+import json
+import time
+
+# Phases of a generation timed by the engines
+PAIRING = "pairing"
+SPAWNING = "spawning"
+SURVIVAL = "survival"
+STATS = "stats"
+PHASES = (PAIRING, SPAWNING, SURVIVAL, STATS)
+
+
+def new_timings():
+    """
+    :return (dict): time spent in every phase of a generation, in seconds
+    """
+    return dict.fromkeys(PHASES, 0.0)
+
+
+class GenerationEvent(object):
+    """
+    Event sent to the observers of a simulation once a generation is complete
+    """
+    __slots__ = ("iteration", "generation", "population", "rows", "timings", "genotypes")
+
+    def __init__(self, iteration, generation, population, rows, timings, genotypes=None):
+        """
+        :param iteration (int): iteration index
+        :param generation (int): generation index
+        :param population (int): size of the new generation
+        :param rows (list): the result rows of Simulate.columns for the new generation
+        :param timings (dict): time spent in every phase of the generation, in seconds
+        :param genotypes (GenerationStats or GenomeStats): genotype counts of the new generation
+        """
+        self.iteration = iteration
+        self.generation = generation
+        self.population = population
+        self.rows = rows
+        self.timings = timings
+        self.genotypes = genotypes
+
+    def to_dict(self):
+        result = {"iteration": self.iteration, "generation": self.generation, "population": self.population,
+                  "rows": self.rows, "timings": self.timings}
+        if self.genotypes is not None:
+            result.update(self.genotypes.summary())
+        return result
+
+
+class Observer(object):
+    """
+    Base class for the observers of a simulation, registered with Simulate.add_observer. It does nothing so
+    observers only override the notifications they need.
+    """
+
+    def on_generation(self, event):
+        """
+        Called once a generation is complete
+        :param event (GenerationEvent):
+        :return:
+        """
+        pass
+
+    def on_iteration(self, iteration, rows):
+        """
+        Called once an iteration is complete
+        :param iteration (int): iteration index
+        :param rows (list): the result rows of Simulate.columns for the last generation of the iteration
+        :return:
+        """
+        pass
+
+
+class NullObserver(Observer):
+    """
+    Observer ignoring every event
+    """
+    pass
+
+
+class PrintObserver(Observer):
+    """
+    Prints the progress of the simulation
+    """
+
+    def on_generation(self, event):
+        print("Completed Generation : {} : Total Population: {}".format(event.generation, event.population))
+
+    def on_iteration(self, iteration, rows):
+        print("Iteration : {} : TotalPoulation : {}".format(iteration, rows[0][-1]))
+
+
+class EventRecorder(Observer):
+    """
+    Keeps the generation events in memory, used to send the events of worker processes back to the main one
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def on_generation(self, event):
+        self.events.append(event)
+
+
+def _to_json(value):
+    # numpy scalars in the stats rows
+    return value.item()
+
+
+class JsonLinesLogger(Observer):
+    """
+    Writes one JSON object per event to a file
+    """
+
+    def __init__(self, file_path):
+        """
+        :param file_path (str): JSON lines file, truncated when the logger is created
+        """
+        self._file = open(file_path, "w")
+
+    def on_generation(self, event):
+        record = event.to_dict()
+        record["event"] = "generation"
+        self._file.write(json.dumps(record, default=_to_json) + "\n")
+
+    def on_iteration(self, iteration, rows):
+        self._file.write(json.dumps({"event": "iteration", "iteration": iteration, "rows": rows},
+                                    default=_to_json) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class Aggregator(Observer):
+    """
+    Low overhead in-memory totals of the generation events
+    """
+
+    def __init__(self):
+        self.generations = 0
+        self.iterations = 0
+        self.peas = 0
+        self.max_population = 0
+        self.timings = new_timings()
+        self._start = time.time()
+
+    def on_generation(self, event):
+        self.generations += 1
+        self.peas += event.population
+        if event.population > self.max_population:
+            self.max_population = event.population
+        for phase, seconds in event.timings.items():
+            self.timings[phase] += seconds
+
+    def on_iteration(self, iteration, rows):
+        self.iterations += 1
+
+    def summary(self):
+        """
+        :return (dict): the totals along with the share of the timed time spent in every phase
+        """
+        timed = sum(self.timings.values())
+        return {"iterations": self.iterations, "generations": self.generations, "peas": self.peas,
+                "max_population": self.max_population, "wall_time": time.time() - self._start,
+                "timings": dict(self.timings),
+                "share": {phase: seconds / timed if timed > 0 else 0.0 for phase, seconds in self.timings.items()}}
@@ -0,0 +1,252 @@
+import numpy as np
+
+GENES = ("color", "shape")
+# Allele carried by an allele copy, the bit of the gene code
+DOMINANT = 0
+RECESSIVE = 1
+
+
+class InvalidLineageQuery(Exception):
+    pass
+
+
+class Lineage(object):
+    """
+    Genetic ancestry of the living population, recorded tree sequence style. Every pea carries two copies (slots)
+    of every gene, an allele copy being identified by individual * 2 + slot within its generation. For every gene
+    and generation only two int32 arrays are kept:
+
+    * parents: the copy of the previous generation every copy was inherited from, i.e. the parent index and the
+      allele choice of the child
+    * nodes: the identifier of every kept copy in its generation, None while none of its copies was pruned
+
+    Every few generations the copies without living descendants are pruned (simplify). Allele lineages coalesce
+    going back in time, so the memory used is proportional to the surviving lineages, plus the last few complete
+    generations, rather than to all the peas ever born.
+    """
+
+    def __init__(self, founders, simplify_every=20):
+        """
+        :param founders (PeaPopulation): generation0
+        :param simplify_every (int): number of generations between prunings. Pruning walks back until a generation
+                                     loses no copy, which is often most of the history, so it is not done every
+                                     generation
+        """
+        self.simplify_every = simplify_every
+        self.founder_count = len(founders)
+        codes = {"color": founders.color, "shape": founders.shape}
+        slots = np.arange(2, dtype=np.uint8)
+        # Allele of every founder copy, indexed by identifier
+        self.founder_alleles = {gene: ((codes[gene][:, None] >> slots[None, :]) & 1).ravel().astype(np.uint8)
+                                for gene in GENES}
+        self.parents = {gene: [np.empty(0, dtype=np.int32)] for gene in GENES}
+        self.nodes = {gene: [np.arange(2 * self.founder_count, dtype=np.int32)] for gene in GENES}
+        # Last generation of the previous simplify, every older generation only keeps copies with descendants in it
+        self.simplified = 0
+
+    @property
+    def generations(self):
+        """
+        :return (int): number of generations recorded after generation0
+        """
+        return len(self.nodes[GENES[0]]) - 1
+
+    @property
+    def nbytes(self):
+        """
+        :return (int): memory held by the lineage arrays
+        """
+        return sum(a.nbytes for gene in GENES for a in self.parents[gene] + self.nodes[gene] if a is not None) + \
+            sum(a.nbytes for a in self.founder_alleles.values())
+
+    def _size(self, gene, generation):
+        # Number of kept copies of a generation
+        nodes = self.nodes[gene][generation]
+        return len(nodes) if nodes is not None else len(self.parents[gene][generation])
+
+    def node_ids(self, gene, generation):
+        """
+        :param gene (str): color or shape
+        :param generation (int):
+        :return (ndarray): identifier (individual * 2 + slot) of every kept copy of the generation
+        """
+        nodes = self.nodes[gene][generation]
+        return nodes if nodes is not None else np.arange(self._size(gene, generation), dtype=np.int32)
+
+    def record(self, parent1, parent2, picks):
+        """
+        Adds the surviving children of the current generation, the lineages that died out are pruned every
+        simplify_every generations
+        :param parent1 (ndarray): index in the current generation of the first parent of every child
+        :param parent2 (ndarray): index in the current generation of the second parent of every child
+        :param picks (ndarray): (4, children) allele slot passed by parent1 and parent2 for the color gene, then by
+                                parent1 and parent2 for the shape gene, as drawn by VectorizedEngine
+        :return:
+        """
+        parent1 = parent1.astype(np.int32)
+        parent2 = parent2.astype(np.int32)
+        for n, gene in enumerate(GENES):
+            # The first copy of a child comes from parent1, the second from parent2. The current generation is
+            # complete, so its kept copies are all the copies
+            parents = np.empty(2 * len(parent1), dtype=np.int32)
+            parents[0::2] = 2 * parent1 + picks[2 * n]
+            parents[1::2] = 2 * parent2 + picks[2 * n + 1]
+            self.parents[gene].append(parents)
+            self.nodes[gene].append(None)
+        if self.generations % self.simplify_every == 0:
+            self.simplify()
+
+    def simplify(self):
+        """
+        Removes the copies with no descendant in the last generation, walking back until a generation that was already
+        simplified loses none: the generations before it were pruned against it and nothing changed since
+        :return:
+        """
+        for gene in GENES:
+            parents, nodes = self.parents[gene], self.nodes[gene]
+            for t in range(len(nodes) - 1, 0, -1):
+                used = np.zeros(self._size(gene, t - 1), dtype=bool)
+                used[parents[t]] = True
+                if used.all():
+                    if t - 1 <= self.simplified:
+                        break
+                    continue
+                remap = (np.cumsum(used) - 1).astype(np.int32)
+                parents[t] = remap[parents[t]]
+                nodes[t - 1] = np.flatnonzero(used).astype(np.int32) if nodes[t - 1] is None else nodes[t - 1][used]
+                if t > 1:
+                    parents[t - 1] = parents[t - 1][used]
+        self.simplified = self.generations
+
+    def _check_gene(self, gene):
+        if gene not in GENES:
+            raise InvalidLineageQuery("Unknown gene {}, expected one of {}".format(gene, GENES))
+
+    def lineages(self, gene):
+        """
+        :param gene (str): color or shape
+        :return (ndarray): number of copies of every generation with descendants in the last one
+        """
+        self._check_gene(gene)
+        self.simplify()
+        return np.array([self._size(gene, t) for t in range(self.generations + 1)])
+
+    def common_ancestor_generation(self, gene):
+        """
+        :param gene (str): color or shape
+        :return (int): last generation holding a single copy every living copy of the gene descends from, None if
+                       the living copies descend from several founder copies
+        """
+        single = np.flatnonzero(self.lineages(gene) == 1)
+        return int(single[-1]) if len(single) > 0 else None
+
+    def _trace(self, gene, generation):
+        # Kept copy of generation 0 every kept copy of the generation descends from
+        index = np.arange(self._size(gene, generation))
+        for t in range(generation, 0, -1):
+            index = self.parents[gene][t][index]
+        return index
+
+    def founder_copies(self, gene, generation=None):
+        """
+        :param gene (str): color or shape
+        :param generation (int): generation of the copies, the last one if None
+        :return (ndarray): identifier (founder * 2 + slot) of the founder copy every kept copy of the generation
+                           descends from, for the last generation one per living copy in identifier order
+        """
+        self._check_gene(gene)
+        generation = self.generations if generation is None else generation
+        if generation < self.generations:
+            # Only the copies with living descendants are kept
+            self.simplify()
+        return self.nodes[gene][0][self._trace(gene, generation)]
+
+    def alleles(self, gene, generation=None):
+        """
+        :param gene (str): color or shape
+        :param generation (int): generation of the copies, the last one if None
+        :return (ndarray): allele (DOMINANT or RECESSIVE) of every kept copy of the generation
+        """
+        return self.founder_alleles[gene][self.founder_copies(gene, generation)]
+
+    def founder_contributions(self, gene=None):
+        """
+        :param gene (str): color or shape, both genes if None
+        :return (ndarray): share of the living allele copies descending from every pea of generation0
+        """
+        genes = GENES if gene is None else (gene,)
+        founders = np.concatenate([self.founder_copies(g) // 2 for g in genes])
+        if len(founders) == 0:
+            return np.zeros(self.founder_count)
+        return np.bincount(founders, minlength=self.founder_count) / len(founders)
+
+    def allele_ancestry(self, gene, individual):
+        """
+        :param gene (str): color or shape
+        :param individual (int): index of a pea of the last generation
+        :return (ndarray): (2, generations + 1) index of the ancestor every copy of the gene of the pea was
+                           inherited through, from generation0 to the last generation
+        """
+        self._check_gene(gene)
+        last = self.generations
+        if not 0 <= individual < self._size(gene, last) // 2:
+            raise InvalidLineageQuery("No pea {} in the last generation".format(individual))
+        ancestry = np.empty((2, last + 1), dtype=np.int64)
+        index = np.array([2 * individual, 2 * individual + 1])
+        for t in range(last, -1, -1):
+            nodes = self.nodes[gene][t]
+            ancestry[:, t] = (index if nodes is None else nodes[index]) // 2
+            if t > 0:
+                index = self.parents[gene][t][index]
+        return ancestry
+
+    def fixation_generation(self, gene, allele=RECESSIVE):
+        """
+        Generation from which every ancestor copy of the living population carries the allele, i.e. by which the
+        fixation of the allele in the living population was settled
+        :param gene (str): color or shape
+        :param allele (int): DOMINANT or RECESSIVE
+        :return (int): None if a living copy carries the other allele or the population died out
+        """
+        self._check_gene(gene)
+        fixed = None
+        for t in range(self.generations, -1, -1):
+            alleles = self.alleles(gene, t)
+            if len(alleles) == 0 or not (alleles == allele).all():
+                break
+            fixed = t
+        return fixed
+
+    def save(self, file_path):
+        """
+        :param file_path (str): .npz file
+        :return:
+        """
+        self.simplify()
+        arrays = {"founder_count": np.array(self.founder_count), "simplify_every": np.array(self.simplify_every)}
+        for gene in GENES:
+            arrays["{}_founder_alleles".format(gene)] = self.founder_alleles[gene]
+            for t, parents in enumerate(self.parents[gene]):
+                arrays["{}_parents_{}".format(gene, t)] = parents
+                arrays["{}_nodes_{}".format(gene, t)] = self.node_ids(gene, t)
+        np.savez(file_path, **arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        :param file_path (str): file written by save
+        :return (Lineage):
+        """
+        lineage = cls.__new__(cls)
+        with np.load(file_path) as arrays:
+            lineage.founder_count = int(arrays["founder_count"])
+            lineage.simplify_every = int(arrays["simplify_every"])
+            lineage.founder_alleles = {gene: arrays["{}_founder_alleles".format(gene)] for gene in GENES}
+            generations = sum(1 for name in arrays.files if name.startswith(GENES[0] + "_nodes_"))
+            lineage.parents = {gene: [arrays["{}_parents_{}".format(gene, t)] for t in range(generations)]
+                               for gene in GENES}
+            lineage.nodes = {gene: [arrays["{}_nodes_{}".format(gene, t)] for t in range(generations)]
+                             for gene in GENES}
+        # save simplifies first
+        lineage.simplified = lineage.generations
+        return lineage
@@ -0,0 +1,180 @@
+import abc
+import numpy as np
+
+
+class InvalidRegulation(Exception):
+    """
+    Exception class for an unknown or badly configured density regulation
+    """
+    pass
+
+
+# numpy's hypergeometric samplers do not support larger populations
+_EXACT_DRAW_LIMIT = 10 ** 9
+
+
+def _keep_probabilities(weights, counts, target):
+    """
+    Keep probability of every entry, proportional to its weight and capped at 1, so that the expected number of
+    kept peas is target
+    :param weights (ndarray): weight of every entry
+    :param counts (ndarray): number of peas of every entry
+    :param target (float): expected number of peas to keep, at most counts.sum()
+    :return (ndarray): keep probability of every entry
+    """
+    order = np.argsort(-weights, kind="stable")
+    w, n = weights[order], counts[order]
+    # With the k heaviest entries always kept the rest share target - kept, find the first k where that
+    # does not push the k-th heaviest one above 1
+    kept = np.concatenate(([0.0], np.cumsum(n, dtype=float)[:-1]))
+    rest = np.cumsum((n * w)[::-1], dtype=float)[::-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = (target - kept) / rest
+    fits = np.flatnonzero((rest > 0) & (scale * w <= 1))
+    probabilities = np.ones(len(w))
+    if len(fits) > 0:
+        k = fits[0]
+        probabilities[k:] = scale[k] * w[k:]
+    result = np.empty(len(w))
+    result[order] = probabilities
+    return result
+
+
+def _hypergeometric(counts, n, rng):
+    """
+    Draws n peas without replacement
+    :param counts (ndarray): number of peas of every entry
+    :param n (int): number of peas to draw
+    :param rng (numpy Generator):
+    :return (ndarray): number of drawn peas of every entry
+    """
+    total = int(counts.sum())
+    if total < _EXACT_DRAW_LIMIT:
+        return rng.multivariate_hypergeometric(counts, n)
+    return np.minimum(rng.multinomial(n, counts / total), counts)
+
+
+class DensityRegulation(abc.ABC):
+    """
+    Base class of the density regulations, culling the surviving children of a generation in one vectorized step.
+    Peas are culled at random by default: the genotype advantages already applied through the survival roll of the
+    children. When weighted they are kept with a chance proportional to their survival, which applies the advantages
+    a second time.
+    """
+    # Exact regulations keep exactly the target number of peas, the others only on average
+    EXACT = False
+    # Revision of the culling draws, see Simulate.ENGINE_REVISION
+    REVISION = 1
+
+    def __init__(self, capacity, weighted=False):
+        """
+        :param capacity (int): carrying capacity of the population
+        :param weighted (bool): also favour the peas with the best survival when culling
+        """
+        if capacity is None or capacity <= 0:
+            raise InvalidRegulation("The capacity of a density regulation must be positive, got {}".format(capacity))
+        self.capacity = capacity
+        self.weighted = weighted
+
+    @abc.abstractmethod
+    def target(self, survivors, parents):
+        """
+        :param survivors (int): number of surviving children
+        :param parents (int): size of the parent generation
+        :return (float): expected size of the regulated generation
+        """
+
+    def keep_probabilities(self, survival, counts, parents):
+        """
+        :param survival (ndarray): survival chance of every entry
+        :param counts (ndarray): number of peas of every entry, expected numbers are accepted
+        :param parents (int): size of the parent generation
+        :return (ndarray): keep probability of every entry
+        """
+        target = self.target(counts.sum(), parents)
+        weights = np.asarray(survival, dtype=float) if self.weighted else np.ones(len(counts))
+        return _keep_probabilities(weights, counts, target)
+
+    def cull(self, survival, parents, rng):
+        """
+        Culls a generation held pea by pea
+        :param survival (ndarray): survival chance of every pea
+        :param parents (int): size of the parent generation
+        :param rng (numpy Generator):
+        :return (ndarray): boolean mask of the kept peas
+        """
+        size = len(survival)
+        target = self.target(size, parents)
+        if size == 0 or target >= size:
+            return np.ones(size, dtype=bool)
+        keep = rng.random(size) < self.keep_probabilities(survival, np.ones(size), parents)
+        if self.EXACT:
+            # Remove or add back peas at random to hit the target
+            kept, target = int(keep.sum()), int(target)
+            if target < kept:
+                keep[rng.choice(np.flatnonzero(keep), kept - target, replace=False)] = False
+            elif target > kept:
+                keep[rng.choice(np.flatnonzero(~keep), target - kept, replace=False)] = True
+        return keep
+
+    def cull_counts(self, counts, survival, parents, rng):
+        """
+        Culls a generation held as genotype counts
+        :param counts (ndarray): number of peas of every genotype
+        :param survival (ndarray): survival chance of every genotype
+        :param parents (int): size of the parent generation
+        :param rng (numpy Generator):
+        :return (ndarray): number of kept peas of every genotype
+        """
+        size = int(counts.sum())
+        target = self.target(size, parents)
+        if size == 0 or target >= size:
+            return counts
+        kept = rng.binomial(counts, self.keep_probabilities(survival, counts, parents))
+        if self.EXACT:
+            total, target = int(kept.sum()), int(target)
+            if target < total:
+                kept = kept - _hypergeometric(kept, total - target, rng)
+            elif target > total:
+                kept = kept + _hypergeometric(counts - kept, target - total, rng)
+        return kept
+
+
+class CapRegulation(DensityRegulation):
+    """
+    Hard population cap: whenever more than capacity children survive exactly capacity of them are kept
+    """
+    EXACT = True
+
+    def target(self, survivors, parents):
+        return min(survivors, self.capacity)
+
+
+class LogisticRegulation(DensityRegulation):
+    """
+    Beverton-Holt carrying capacity: the survivors of a growing generation are kept with probability
+    1 / (1 + (survivors - parents) / capacity), so the population grows logistically to an equilibrium around
+    capacity. Shrinking generations are not culled.
+    """
+
+    def target(self, survivors, parents):
+        if survivors <= parents:
+            return survivors
+        return survivors / (1 + (survivors - parents) / self.capacity)
+
+
+REGULATIONS = {"cap": CapRegulation, "logistic": LogisticRegulation}
+
+
+def from_config(config):
+    """
+    :param config (dict): the "density-regulation" entry of a config file, e.g. {"mode": "cap", "capacity": 1000}
+    :return (DensityRegulation): None if config is None
+    """
+    if config is None:
+        return None
+    mode = config.get("mode")
+    if mode not in REGULATIONS:
+        raise InvalidRegulation("Not a valid density regulation {}, expected one of {}".format(
+            mode, list(REGULATIONS)))
+    return REGULATIONS[mode](config.get("capacity"), config.get("weighted", False))
@@ -1,12 +1,60 @@
+import os
+import time
 import random
+import numpy as np
 from mendelianPea.pea.pea import Pea
-import pandas as pd
+from mendelianPea.pea.genome import Genome, InvalidGenome
+from mendelianPea.simulate.engine import VectorizedEngine, CountEngine, GenomeEngine, InvalidEngine
+from mendelianPea.simulate.stats import GenerationStats, GenomeStats, pea_genotype
+from mendelianPea.simulate.analytic import AnalyticModel, AnalyticResult
+from mendelianPea.simulate.lineage import Lineage
+from mendelianPea.simulate.demes import DemeEngine
+from mendelianPea.simulate.cache import scenario_digest
+from mendelianPea.simulate.checkpoint import InvalidCheckpoint
+from mendelianPea.simulate.sink import SinkNotAvailable
+from mendelianPea.simulate.instrumentation import GenerationEvent, EventRecorder, new_timings, PAIRING, SPAWNING, \
+    SURVIVAL, STATS
 
 
 class SimNotRun(Exception):
     pass
 
 
+_WORKER_SIMULATION = None
+
+
+def _init_worker(simulation):
+    """
+    Process pool initializer, keeps one copy of the simulation per worker process
+    :param simulation (Simulate): simulation to run iterations of
+    :return:
+    """
+    global _WORKER_SIMULATION
+    _WORKER_SIMULATION = simulation
+
+
+def _run_worker_iteration(iteration, seed_sequence, record_events=False):
+    """
+    Runs one iteration of the worker's simulation
+    :return (tuple): see run_iteration_task
+    """
+    return run_iteration_task(_WORKER_SIMULATION, iteration, seed_sequence, record_events)
+
+
+def run_iteration_task(simulation, iteration, seed_sequence, record_events=False):
+    """
+    Runs one iteration of a simulation in a worker process
+    :param simulation (Simulate): simulation to run
+    :param iteration (int): iteration index
+    :param seed_sequence (numpy SeedSequence): seed of the iteration
+    :param record_events (bool): keep the generation events to replay them to the observers of the main process
+    :return (tuple): the per generation results, the final stats and the generation events of the iteration
+    """
+    recorder = EventRecorder()
+    simulation.observers = [recorder] if record_events else []
+    return simulation.run_iteration(iteration, seed_sequence) + (recorder.events,)
+
+
 class Simulate(object):
     """
     Simulate pea evolution for a given number of generation
@@ -18,41 +66,149 @@ class Simulate(object):
                          "Color Dominant Homozygote", "Color Recessive Homozygote", "Color Heterozygote",
                          "Shape Dominant Homozygote", "Shape Recessive Homozygote", "Shape Heterozygote", "Total"]
 
-    def __init__(self, generation0, no_of_generations, no_of_children, base_survival, advantage):
+    # Results of the genome engine, one row per locus
+    GENOME_COLUMNS = ["Iteration", "Generation"] + GenomeStats.COLUMNS
+    # Results of run_analytic, the expected statistic columns of every generation and their variance
+    ANALYTIC_COLUMNS = ["Generation"] + ITERATION_COLUMNS[2:] + [c + " Variance" for c in ITERATION_COLUMNS[2:]]
+    # Results of a structured population, one row for the whole population then one per deme
+    DEME_COLUMNS = ["Iteration", "Generation", "Deme"] + ITERATION_COLUMNS[2:]
+
+    DATAFRAME_ENGINE = "dataframe"
+    VECTORIZED_ENGINE = "vectorized"
+    COUNT_ENGINE = "counts"
+    GENOME_ENGINE = "genome"
+    ENGINES = {DATAFRAME_ENGINE: None, VECTORIZED_ENGINE: VectorizedEngine, COUNT_ENGINE: CountEngine,
+               GENOME_ENGINE: GenomeEngine}
+    # Relative cost of a pea for the per pea engines and of a generation for the count engine
+    ENGINE_COST = {DATAFRAME_ENGINE: 1000.0, VECTORIZED_ENGINE: 1.0, COUNT_ENGINE: 1000.0, GENOME_ENGINE: 2.0}
+    # Revision of the sampling of every engine, part of the result cache key. Bump it whenever a change to an engine
+    # changes the results of a seed, so the cached results of the previous revision are not read
+    ENGINE_REVISION = {DATAFRAME_ENGINE: 1, VECTORIZED_ENGINE: 1, COUNT_ENGINE: 1, GENOME_ENGINE: 1}
+
+    def __init__(self, generation0, no_of_generations, no_of_children, base_survival, advantage,
+                 engine=DATAFRAME_ENGINE, regulation=None, genome=None, lineage=False, demes=None):
         """
 
-        :param generation0 (DataFrame of peas): This is the start point for the simulation
+        :param generation0 (list of peas or PeaPopulation): This is the start point for the simulation
         :param no_of_generations (int): Total number of generations to simulate
         :param advantage (dict): Dictionary holding the gene data along with survival probability
         :param no_of_children (int): Number of children a pair of peas can spawn per generation
+        :param engine (str): Generation engine, one of Simulate.ENGINES
+        :param regulation (DensityRegulation): culls the survivors of every generation to keep the population
+                                               bounded, see simulate.regulation
+        :param genome (Genome): loci of the genome engine, the two locus pea genome if not supplied. generation0 is
+                                then a GenomePopulation
+        :param lineage (bool): record the genetic ancestry of every iteration in self.lineage, see simulate.lineage.
+                               Only the vectorized engine tracks individual peas and their parents
+        :param demes (Demes): splits the population in demes exchanging migrants, see simulate.demes. generation0 is
+                              then a DemePopulation (see Demes.population) and runs on the vectorized engine
         """
-        generation0_df = pd.DataFrame(
-            [(x._color_gene, x._shape_gene, x.active_color_gene, x.active_shape_gene, x.survival,
-              1 if x.is_color_dominant_homozygote() else 0,
-              1 if x.is_color_recessive_homozygote() else 0,
-              1 if x.is_color_hetrozygote() else 0,
-              1 if x.is_shape_dominant_homozygote() else 0,
-              1 if x.is_shape_recessive_homozygote() else 0,
-              1 if x.is_shape_hetrozygote() else 0,
-              ) for x in generation0],
-            columns=Simulate.GENERATION_COLUMNS)
+        if engine not in Simulate.ENGINES:
+            raise InvalidEngine("Not a valid engine {}, expected one of {}".format(engine, list(Simulate.ENGINES)))
+        if lineage and engine != Simulate.VECTORIZED_ENGINE:
+            raise InvalidEngine("Lineage recording needs the {} engine, got {}".format(Simulate.VECTORIZED_ENGINE,
+                                                                                      engine))
+        self.engine_mode = engine
+        self.engine = None
+        self.regulation = regulation
+        self.columns = Simulate.ITERATION_COLUMNS
+        self.demes = demes
+        if demes is not None and (engine != Simulate.VECTORIZED_ENGINE or lineage):
+            raise InvalidEngine("Demes need the {} engine without lineage recording, got {}".format(
+                Simulate.VECTORIZED_ENGINE, engine))
+        if genome is not None and engine != Simulate.GENOME_ENGINE:
+            raise InvalidGenome("A genome needs the {} engine, got {}".format(Simulate.GENOME_ENGINE, engine))
+        if engine == Simulate.GENOME_ENGINE:
+            self.engine = GenomeEngine(no_of_children, regulation=regulation,
+                                       genome=genome if genome is not None else Genome.default(advantage))
+            self.columns = Simulate.GENOME_COLUMNS
+            generation0_df = self.engine.from_peas(generation0)
+        elif demes is not None:
+            self.engine = DemeEngine(no_of_children, demes, advantage, base_survival, regulation=regulation)
+            self.columns = Simulate.DEME_COLUMNS
+            generation0_df = self.engine.from_peas(generation0)
+        elif Simulate.ENGINES[engine] is not None:
+            self.engine = Simulate.ENGINES[engine](no_of_children, regulation=regulation)
+            generation0_df = self.engine.from_peas(generation0)
+        else:
+            import pandas as pd
+            generation0_df = pd.DataFrame(
+                [(x._color_gene, x._shape_gene, x.active_color_gene, x.active_shape_gene, x.survival,
+                  1 if x.is_color_dominant_homozygote() else 0,
+                  1 if x.is_color_recessive_homozygote() else 0,
+                  1 if x.is_color_hetrozygote() else 0,
+                  1 if x.is_shape_dominant_homozygote() else 0,
+                  1 if x.is_shape_recessive_homozygote() else 0,
+                  1 if x.is_shape_hetrozygote() else 0,
+                  ) for x in generation0],
+                columns=Simulate.GENERATION_COLUMNS)
         self.generation0 = generation0_df
         self.cur_generation = generation0_df
-        self.next_generation = pd.DataFrame()
+        self.next_generation = None
 
         self.no_of_generations = no_of_generations
         self.advantage = advantage
         self.base_survival = base_survival
         self.no_of_children = no_of_children
         self.generation_index = 0
-        self.stats = None
+        # Genotype counts of cur_generation and of next_generation, updated as the children are produced
+        self.generation0_stats = self.generation_stats(generation0_df)
+        self.stats = self.generation0_stats.copy()
+        self.next_stats = GenerationStats()
+        self.seed = None
+        self.rng = np.random.default_rng()
+        self.sink = None
+        self.checkpoint = None
+        # Digest of the scenario of a checkpointed run, a snapshot is only resumed by a run of the same scenario
+        self.checkpoint_scenario = None
+        self.observers = []
+        self.timings = new_timings()
+        self.record_lineage = lineage
+        self.lineage = None
+        # Every iteration writes its lineage to iteration_<n>.npz in this directory when set
+        self.lineage_directory = None
         if self.advantage is not None:
             Pea.set_advantage(self.advantage)
         if self.base_survival is not None:
             Pea.set_base_survival(self.base_survival)
 
-        self.generation_results = []
-        self.iteration_results = pd.DataFrame()
+        # Results are kept as rows, pandas is only imported when they are read as DataFrames
+        self.generation_result_rows = []
+        self.iteration_result_rows = []
+        self._generation_frames = []
+
+    def __getstate__(self):
+        # A pickled simulation is one shipped to a worker process, results stay in the process collecting them
+        state = self.__dict__.copy()
+        state.update(generation_result_rows=[], iteration_result_rows=[], _generation_frames=[], sink=None,
+                     checkpoint=None, observers=[])
+        return state
+
+    @property
+    def generation_results(self):
+        """
+        :return (list): one DataFrame of self.columns per collected iteration with the stats of every generation
+        """
+        import pandas as pd
+        for rows in self.generation_result_rows[len(self._generation_frames):]:
+            self._generation_frames.append(pd.DataFrame(rows, columns=self.columns))
+        return self._generation_frames
+
+    @property
+    def iteration_results(self):
+        """
+        :return (DataFrame): the stats of the last generation of every collected iteration
+        """
+        import pandas as pd
+        return pd.DataFrame(self.iteration_result_rows, columns=self.columns)
+
+    def add_observer(self, observer):
+        """
+        Registers an observer notified of every generation and iteration, see simulate.instrumentation
+        :param observer (Observer):
+        :return:
+        """
+        self.observers.append(observer)
 
     def _init_data(self, ):
         """
@@ -60,13 +216,50 @@ class Simulate(object):
         :return:
         """
         self.cur_generation = self.generation0
-        self.next_generation = pd.DataFrame()
+        self.next_generation = None
 
         self.generation_index = 0
-        self.stats = None
+        self.stats = self.generation0_stats.copy()
+        if self.record_lineage:
+            self.lineage = Lineage(self.generation0)
+            self.engine.lineage = self.lineage
         Pea.set_advantage(self.advantage)
         Pea.set_base_survival(self.base_survival)
 
+    def _seed(self, seed_sequence):
+        """
+        Seeds every random stream used by an iteration
+        :param seed_sequence (numpy SeedSequence): seed of the iteration
+        :return:
+        """
+        random.seed(int(seed_sequence.generate_state(1)[0]))
+        self.rng = np.random.default_rng(seed_sequence)
+        if self.engine is not None:
+            self.engine.rng = self.rng
+
+    @staticmethod
+    def _frame_genotypes(generation):
+        """
+        :param generation (DataFrame): generation held by the DataFrame engine
+        :return (ndarray): unordered genotype index of every pea
+        """
+        # The number of recessive alleles of a gene is 2 for a recessive homozygote and 1 for a heterozygote
+        column = {c: generation[c].to_numpy(dtype=np.int64) for c in ("color_R", "color_DR", "shape_R", "shape_DR")}
+        return 3 * (2 * column["color_R"] + column["color_DR"]) + 2 * column["shape_R"] + column["shape_DR"]
+
+    def generation_stats(self, generation):
+        """
+        Counts the genotypes of a whole generation, only needed when a generation does not come from
+        get_next_generation
+        :param generation: generation in the engine representation
+        :return (GenerationStats):
+        """
+        if self.engine is not None:
+            return self.engine.generation_stats(generation)
+        if generation.empty:
+            return GenerationStats()
+        return GenerationStats.from_genotypes(Simulate._frame_genotypes(generation))
+
     def kill_peas(self, pea_df):
         """
         Randomly kills peas based on their survival probability
@@ -86,11 +279,16 @@ class Simulate(object):
         :param pea2: parent 2
         :return (list of peas): randomly selecting peas for the next generation based on their survival probability
         """
+        import pandas as pd
         result = pd.DataFrame([], columns=Simulate.GENERATION_COLUMNS)
         for _ in range(self.no_of_children):
+            t1 = time.perf_counter()
             child = Pea.spawn(pea1, pea2)
+            t2 = time.perf_counter()
+            self.timings[SPAWNING] += t2 - t1
             p = random.random()
             if p < child.survival:  # This pea survived
+                self.next_stats.add(pea_genotype(child))
                 new_df = pd.DataFrame([[child._color_gene, child._shape_gene, child.active_color_gene,
                                         child.active_shape_gene, child.survival,
                                         1 if child.is_color_dominant_homozygote() else 0,
@@ -101,6 +299,7 @@ class Simulate(object):
                                         1 if child.is_shape_hetrozygote() else 0,
                                         ]], columns=Simulate.GENERATION_COLUMNS)
                 result = pd.concat((result, new_df), ignore_index=True)
+            self.timings[SURVIVAL] += time.perf_counter() - t2
         return result
 
     def get_next_generation(self, cur_generation):
@@ -109,7 +308,18 @@ class Simulate(object):
         :param cur_generation: list of peas
         :return: next generation as a list of peas
         """
-        cur_generation = cur_generation.sample(frac=1)
+        if self.engine is not None:
+            self.next_generation = self.engine.next_generation(cur_generation)
+            self.timings = dict(self.engine.timings)
+            self.next_stats = self.engine.last_stats
+            return self.next_generation
+
+        import pandas as pd
+        self.timings = new_timings()
+        self.next_stats = GenerationStats()
+        t1 = time.perf_counter()
+        parents = len(cur_generation)
+        cur_generation = cur_generation.sample(frac=1, random_state=self.rng)
         self.next_generation = pd.DataFrame([], columns=Simulate.GENERATION_COLUMNS)
         while not cur_generation.empty:
             pea1 = cur_generation[0:1]
@@ -128,80 +338,339 @@ class Simulate(object):
                 self.next_generation = pd.concat((self.next_generation, result_df), ignore_index=True)
         if not cur_generation.empty and cur_generation.shape[0] == 1:
             cur_generation.drop(cur_generation.index, inplace=True)  # Just discard this pea
+        # Everything outside of spawn_peas is the pairing
+        self.timings[PAIRING] = time.perf_counter() - t1 - self.timings[SPAWNING] - self.timings[SURVIVAL]
+        if self.regulation is not None and not self.next_generation.empty:
+            t2 = time.perf_counter()
+            keep = self.regulation.cull(self.next_generation["survival"].to_numpy(dtype=float), parents, self.rng)
+            self.next_stats.add_counts(-GenerationStats.from_genotypes(
+                Simulate._frame_genotypes(self.next_generation[~keep])).counts)
+            self.next_generation = self.next_generation[keep].reset_index(drop=True)
+            self.timings[SURVIVAL] += time.perf_counter() - t2
         return self.next_generation
 
     def run(self, iteration, net_progression=None):
         """
-        Run the simulation based on the supplied parameters
-        :return:
+        Run the simulation based on the supplied parameters, the stats of every generation are written to
+        self.sink when there is one instead of being kept in the returned rows
+        :param iteration (int): iteration index
+        :param net_progression (list): rows of the generations already run
+        :return (list): one row of self.columns per generation, per locus for the genome engine
         """
 
         if net_progression is None:
-            net_progression = pd.DataFrame()
+            net_progression = []
 
         while len(self.cur_generation) > 0 and self.generation_index < self.no_of_generations:
 
             self.cur_generation = self.get_next_generation(self.cur_generation)
+            self.stats = self.next_stats
             self.generation_index += 1
-            lst = [[iteration, self.generation_index] + self.get_cur_generation_stats()]
+            t1 = time.perf_counter()
+            rows = self.generation_rows(iteration)
+            self.timings[STATS] = time.perf_counter() - t1
 
-            new_df = pd.DataFrame(lst, columns=Simulate.ITERATION_COLUMNS)
-            if net_progression.empty:
-                net_progression = new_df
+            if self.sink is not None:
+                for row in rows:
+                    self.sink.write(row)
             else:
-                net_progression = pd.concat((net_progression, new_df), ignore_index=True)
-            print("Completed Generation : {} : Total Population: {}".format(self.generation_index,
-                                                                            net_progression.tail(1)["Total"].values[0]))
+                net_progression.extend(rows)
+            if self.observers:
+                event = GenerationEvent(iteration, self.generation_index, self.stats.total, rows, self.timings,
+                                        self.stats)
+                for observer in self.observers:
+                    observer.on_generation(event)
+            if self.checkpoint is not None and self.checkpoint.due():
+                self.checkpoint.save(self._checkpoint_state(iteration, self.sink, net_progression),
+                                     self.generation_result_rows, self.iteration_result_rows)
 
         return net_progression
 
-    def run_iterations(self, iterations, advantage=None, base_survival=None):
-        for y in range(iterations):
-            self._init_data()
-            if advantage is not None:
-                Pea.set_advantage(self.advantage)
-            if base_survival is not None:
-                Pea.set_base_survival(self.base_survival)
-
-            cur_generation_results = self.run(y, None)
-            self.generation_results.append(cur_generation_results)
-
-            lst = [[y, self.generation_index] + self.get_cur_generation_stats()]
-            new_df = pd.DataFrame(lst, columns=Simulate.ITERATION_COLUMNS)
-            if self.iteration_results.empty:
-                self.iteration_results = new_df
+    def _checkpoint_state(self, iteration, sink, net_progression=None):
+        """
+        Snapshot of the run for a checkpoint, the result rows of the collected iterations are journaled by the
+        checkpoint instead
+        :param iteration (int): iteration to resume from
+        :param sink (ResultSink): sink the results are streamed to
+        :param net_progression (list): result rows of the iteration in progress, None between iterations
+        :return (dict):
+        """
+        state = {"seed": self.seed, "scenario": self.checkpoint_scenario, "iteration": iteration,
+                 "sink_position": sink.position() if sink is not None else None}
+        if net_progression is not None:
+            # The peas of a structured population are held by the deme processes
+            generation = self.cur_generation if self.demes is None else self.engine.snapshot(self.cur_generation)
+            state.update({"generation": generation, "generation_index": self.generation_index,
+                          "net_progression": net_progression, "random_state": random.getstate(),
+                          "rng_state": self.rng.bit_generator.state, "lineage": self.lineage})
+        return state
+
+    def _restore(self, state):
+        """
+        Restores an iteration in progress from a checkpoint snapshot
+        :param state (dict): snapshot taken by _checkpoint_state
+        :return (list): result rows of the iteration so far
+        """
+        self.cur_generation = state["generation"]
+        self.stats = self.generation_stats(self.cur_generation)
+        self.generation_index = state["generation_index"]
+        random.setstate(state["random_state"])
+        self.rng = np.random.default_rng()
+        self.rng.bit_generator.state = state["rng_state"]
+        if self.engine is not None:
+            self.engine.rng = self.rng
+        if self.record_lineage:
+            self.lineage = state["lineage"]
+            self.engine.lineage = self.lineage
+        return state["net_progression"]
+
+    def run_iteration(self, iteration, seed_sequence, advantage=None, base_survival=None, resume_state=None):
+        """
+        Runs a single iteration from generation0, the result only depends on the supplied seed
+        :param iteration (int): iteration index
+        :param seed_sequence (numpy SeedSequence): seed of the iteration
+        :param resume_state (dict): checkpoint snapshot taken during this iteration to continue from
+        :return (tuple): the result rows of every generation and of the final generation of the iteration
+        """
+        self._init_data()
+        if advantage is not None:
+            Pea.set_advantage(self.advantage)
+        if base_survival is not None:
+            Pea.set_base_survival(self.base_survival)
+        net_progression = None
+        if resume_state is None:
+            self._seed(seed_sequence)
+        else:
+            net_progression = self._restore(resume_state)
+
+        cur_generation_results = self.run(iteration, net_progression)
+        if self.lineage_directory is not None:
+            os.makedirs(self.lineage_directory, exist_ok=True)
+            self.lineage.save(os.path.join(self.lineage_directory, "iteration_{}.npz".format(iteration)))
+        return cur_generation_results, self.generation_rows(iteration)
+
+    def run_iterations(self, iterations, advantage=None, base_survival=None, workers=1, seed=None, sink=None,
+                       checkpoint=None, resume_state=None, convergence=None, cache=None):
+        """
+        Runs the simulation several times from generation0
+        :param iterations (int): number of iterations, the maximum number when convergence is supplied
+        :param workers (int): number of worker processes, iterations run in this process when 1
+        :param seed (int): master seed every iteration seed is derived from, results are identical for a given seed
+                           whatever the number of workers. A random one is picked and kept in self.seed if not supplied
+        :param sink (ResultSink): streams the stats of every generation instead of keeping them in
+                                  self.generation_results
+        :param checkpoint (Checkpoint): takes periodic snapshots of the run, between generations when iterations
+                                        run in this process and between iterations otherwise
+        :param resume_state (dict): snapshot loaded from a checkpoint to continue from, the results are the same as
+                                    the ones of an uninterrupted run. The sink must be opened at the snapshot's
+                                    "sink_position"
+        :param convergence (Convergence): runs the iterations in batches of convergence.batch_size and stops after
+                                          the first batch where every target confidence interval is reached
+        :param cache (ResultCache): reads the iterations already run with the same scenario and seed from the cache
+                                    and adds the new ones to it. Only used for seeded runs without checkpoint
+                                    that do not write lineages
+        :return:
+        :raise InvalidCheckpoint: if resume_state was taken from a run of another scenario or seed
+        :raise SinkNotAvailable: if the run is checkpointed and sink can not be resumed
+        """
+        if checkpoint is not None and sink is not None and not sink.RESUMABLE:
+            raise SinkNotAvailable("{} can not be resumed, the run can not be checkpointed".format(
+                type(sink).__name__))
+        start = 0
+        if checkpoint is not None or resume_state is not None:
+            # The seed is left out, a random one is only known once picked
+            self.checkpoint_scenario = scenario_digest(self, None)
+        if resume_state is not None:
+            if resume_state["scenario"] != self.checkpoint_scenario:
+                raise InvalidCheckpoint("The checkpoint was taken from a run of another scenario")
+            if seed is not None and seed != resume_state["seed"]:
+                raise InvalidCheckpoint("The checkpoint was taken from a run with seed {}, not {}".format(
+                    resume_state["seed"], seed))
+            seed = resume_state["seed"]
+            start = resume_state["iteration"]
+            self.generation_result_rows = resume_state["generation_results"]
+            self.iteration_result_rows = resume_state["iteration_results"]
+            self._generation_frames = []
+        iteration_seeds = self.iteration_seeds(iterations, seed)
+        if seed is None or checkpoint is not None or self.lineage_directory is not None:
+            cache = None
+        key = cache.key(self, self.seed) if cache is not None else None
+        if convergence is not None:
+            convergence.bind(self.columns)
+            convergence.replay(self.iteration_result_rows)
+
+        # Worker processes send their iterations back whole, only iterations run here stream from self.run. Cached
+        # iterations are kept whole too
+        self.sink = sink if cache is None else None
+        self.checkpoint = checkpoint
+        try:
+            if resume_state is not None and "generation" in resume_state:
+                self.collect_iterations([self.run_iteration(start, iteration_seeds[start], advantage, base_survival,
+                                                            resume_state) + ([],)], sink, convergence=convergence)
+                start += 1
+
+            if workers > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                self.sink = None
+                self.checkpoint = None
+                executor = None
+
+                def compute(batch):
+                    nonlocal executor
+                    if executor is None:
+                        # Only started once an iteration is not read from the cache
+                        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                       initargs=(self,))
+                    return executor.map(_run_worker_iteration, batch, [iteration_seeds[y] for y in batch],
+                                        [bool(self.observers)] * len(batch))
+
+                try:
+                    for batch in self._batches(start, iterations, convergence):
+                        results = compute(batch) if cache is None else cache.results(key, batch, compute)
+                        self.collect_iterations(results, sink, checkpoint, convergence)
+                finally:
+                    if executor is not None:
+                        executor.shutdown()
             else:
-                self.iteration_results = pd.concat((self.iteration_results, new_df), ignore_index=True)
-            print("Iteration : {} : TotalPoulation : {}".format(y, self.iteration_results.tail(1)["Total"].values[0]))
+                def compute(batch):
+                    return (self.run_iteration(y, iteration_seeds[y], advantage, base_survival) + ([],) for y in batch)
 
-    def get_cur_generation_stats(self):
-        if not self.cur_generation.empty:
-            total_count = self.cur_generation.shape[0]
-            green_count = self.cur_generation[self.cur_generation["color"] == "G"]["color"].count()
-            yellow_count = total_count - green_count
-            wrinkled_count = self.cur_generation[self.cur_generation["shape"] == "w"]["shape"].count()
-            round_count = total_count - wrinkled_count
-            color_D = self.cur_generation["color_D"].sum()
-            color_R = self.cur_generation["color_R"].sum()
-            color_DR = self.cur_generation["color_DR"].sum()
-            shape_D = self.cur_generation["shape_D"].sum()
-            shape_R = self.cur_generation["shape_R"].sum()
-            shape_DR = self.cur_generation["shape_DR"].sum()
-            return [green_count / total_count, yellow_count / total_count, round_count / total_count,
-                    wrinkled_count / total_count,
-                    color_D / total_count, color_R / total_count, color_DR / total_count,
-                    shape_D / total_count, shape_R / total_count, shape_DR / total_count,
-                    total_count]
+                for batch in self._batches(start, iterations, convergence):
+                    results = compute(batch) if cache is None else cache.results(key, batch, compute)
+                    self.collect_iterations(results, sink, convergence=convergence)
+        finally:
+            # The deme processes and their shared memory go away whichever way the run ends, e.g. a cancelled job
+            if self.demes is not None:
+                self.engine.close()
+        if checkpoint is not None:
+            checkpoint.remove()
+        if cache is not None:
+            cache.evict()
+
+    @staticmethod
+    def _batches(start, iterations, convergence=None):
+        """
+        :param start (int): first iteration to run
+        :param iterations (int): number of iterations
+        :param convergence (Convergence): checked after every batch, a single batch is yielded if None
+        :return: generator of the ranges of iterations to run, it stops once the convergence is reached
+        """
+        if convergence is None:
+            yield range(start, iterations)
+            return
+        while start < iterations and not convergence.converged():
+            batch = range(start, min(convergence.batch_end(start), iterations))
+            yield batch
+            convergence.end_batch()
+            start = batch.stop
+
+    def iteration_seeds(self, iterations, seed=None):
+        """
+        Derives the seed of every iteration from the master seed and keeps the master seed in self.seed
+        :param iterations (int): number of iterations
+        :param seed (int): master seed, a random one is picked if not supplied
+        :return (list): one numpy SeedSequence per iteration
+        """
+        seed_sequence = np.random.SeedSequence(seed)
+        self.seed = seed_sequence.entropy
+        return seed_sequence.spawn(iterations)
+
+    def estimated_cost(self):
+        """
+        Rough relative cost of one iteration, used to balance work across a process pool. It is the expected number
+        of peas processed over all the generations weighted by the per pea cost of the engine.
+        :return (float):
+        """
+        self._init_data()
+        if self.engine_mode == Simulate.COUNT_ENGINE:
+            return float(Simulate.ENGINE_COST[self.engine_mode] * self.no_of_generations)
+        if self.engine is None:
+            survival = [Pea(**{"color": c, "shape": s}).survival
+                        for c, s in zip(self.generation0["color_gene"], self.generation0["shape_gene"])]
         else:
-            return [0] * 11
+            survival = self.generation0.survival()
+        growth = self.no_of_children / 2 * np.mean(survival) if len(survival) > 0 else 0
+        size, peas = float(len(self.generation0)), 0.0
+        for _ in range(self.no_of_generations):
+            peas += size
+            survivors = size * growth
+            size = self.regulation.target(survivors, size) if self.regulation is not None else survivors
+        return float(Simulate.ENGINE_COST[self.engine_mode] * peas)
+
+    def collect_iterations(self, results, sink=None, checkpoint=None, convergence=None):
+        """
+        Gathers the iteration results in order
+        :param results: iterable of (generation rows, final rows, generation events) tuples as returned by
+                        run_iteration_task, the events of iterations run in worker processes are replayed to the
+                        observers
+        :param sink (ResultSink): sink receiving the per generation results instead of self.generation_results
+        :param checkpoint (Checkpoint): takes snapshots between iterations
+        :param convergence (Convergence): receives the final rows of every iteration
+        :return:
+        """
+        for cur_generation_results, final_rows, events in results:
+            for event in events:
+                for observer in self.observers:
+                    observer.on_generation(event)
+            if sink is None:
+                self.generation_result_rows.append(cur_generation_results)
+            else:
+                for row in cur_generation_results:
+                    sink.write(row)
+            self.iteration_result_rows.extend(final_rows)
+            iteration = int(final_rows[0][0])
+            for observer in self.observers:
+                observer.on_iteration(iteration, final_rows)
+            if convergence is not None:
+                convergence.on_iteration(iteration, final_rows)
+            if checkpoint is not None and checkpoint.due(len(cur_generation_results) // len(final_rows)):
+                checkpoint.save(self._checkpoint_state(iteration + 1, sink), self.generation_result_rows,
+                                self.iteration_result_rows)
+
+    def get_cur_generation_stats(self):
+        """
+        :return (list): the statistic columns of Simulate.ITERATION_COLUMNS for cur_generation, read from the genotype
+                        counts in self.stats without going through the peas. Only the first locus for the genome
+                        engine, see generation_rows
+        """
+        return self.stats.rows()[0]
+
+    def generation_rows(self, iteration):
+        """
+        :param iteration (int): iteration index
+        :return (list): the result rows of self.columns for cur_generation, one per locus for the genome engine
+        """
+        return [[iteration, self.generation_index] + row for row in self.stats.rows()]
+
+    def run_analytic(self, approximate=False, max_states=200000):
+        """
+        Computes the expected statistic columns of every generation from the model instead of sampling iterations,
+        see simulate.analytic
+        :param approximate (bool): False for the exact genotype count distributions, True for the mean field and
+                                   linear noise approximations, which are biased for small populations
+        :param max_states (int): largest number of genotype count states an exact distribution may reach
+        :return (AnalyticResult):
+        :raise AnalyticNotTractable: when an exact distribution reaches more than max_states states, the
+                                     approximation is never used in its place
+        """
+        if self.engine_mode == Simulate.GENOME_ENGINE:
+            raise InvalidEngine("The analytic mode models the two gene pea, not the {} engine".format(
+                Simulate.GENOME_ENGINE))
+        if self.demes is not None:
+            raise InvalidEngine("The analytic mode models a single population, not demes")
+        model = AnalyticModel(self.no_of_children, regulation=self.regulation, max_states=max_states)
+        counts = self.generation0_stats.counts
+        if approximate:
+            return AnalyticResult.from_mean_field(*model.linear_noise(counts, self.no_of_generations))
+        return AnalyticResult.from_distributions(model.distributions(counts, self.no_of_generations))
 
     def save_xls(self, file_path):
 
-        if len(self.generation_results) > 0:
+        if len(self.generation_result_rows) > 0:
+            import pandas as pd
             with pd.ExcelWriter(file_path) as writer:
-                self.iteration_results.to_excel(writer, "Net Results")
+                self.iteration_results.to_excel(writer, sheet_name="Net Results")
                 for n, df in enumerate(self.generation_results):
-                    df.to_excel(writer, 'iteration_{}'.format(n), index=False)
-                writer.save()
+                    df.to_excel(writer, sheet_name='iteration_{}'.format(n), index=False)
         else:
             raise SimNotRun("Please run the simulation before saving the results in an excel")
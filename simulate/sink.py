@@ -0,0 +1,242 @@
+import os
+import abc
+import csv
+
+_INTEGER_COLUMNS = ("Iteration", "Generation", "Total")
+_STRING_COLUMNS = ("Locus", "Deme")
+
+
+class SinkNotAvailable(Exception):
+    """
+    Exception class for a result format that can not be written
+    """
+    pass
+
+
+class ResultSink(abc.ABC):
+    """
+    Base class for a result sink, receives the stats row of every generation as soon as it is computed and writes
+    them as one table keyed by (Iteration, Generation). Rows are buffered in chunks of chunk_size so memory use stays
+    constant whatever the length of the run.
+    """
+    # Resumable sinks can reopen a file at a position returned by position, so runs writing to them can be
+    # checkpointed
+    RESUMABLE = False
+
+    def __init__(self, file_path, columns, chunk_size=1000):
+        """
+        :param file_path (str): file to write the results to
+        :param columns (list): column names of a row
+        :param chunk_size (int): number of rows buffered before they are written
+        """
+        self.file_path = file_path
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self._chunk = []
+
+    def write(self, row):
+        """
+        :param row (list): one value per column
+        :return:
+        """
+        self._chunk.append(row)
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows
+        :return:
+        """
+        if self._chunk:
+            self._write_chunk(self._chunk)
+            self._chunk = []
+
+    @abc.abstractmethod
+    def _write_chunk(self, rows):
+        """
+        :param rows (list): rows of the chunk to write
+        :return:
+        """
+
+    def position(self):
+        """
+        Flushes the buffered rows and returns the position to resume writing from, see open_sink
+        :return:
+        """
+        raise SinkNotAvailable("{} can not be resumed".format(type(self).__name__))
+
+    def close(self):
+        """
+        Writes the remaining rows and closes the file
+        :return:
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CSVSink(ResultSink):
+    """
+    Writes the results as a CSV file with a header line
+    """
+    RESUMABLE = True
+
+    def __init__(self, file_path, columns, chunk_size=1000, position=None):
+        super(CSVSink, self).__init__(file_path, columns, chunk_size)
+        if position is None:
+            self._file = open(file_path, "w", newline="")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(columns)
+        else:
+            self._file = open(file_path, "r+", newline="")
+            self._file.truncate(position)
+            self._file.seek(position)
+            self._writer = csv.writer(self._file)
+
+    def _write_chunk(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def position(self):
+        self.flush()
+        self._file.flush()
+        return self._file.tell()
+
+    def close(self):
+        super(CSVSink, self).close()
+        self._file.close()
+
+
+class _ArrowSink(ResultSink):
+    """
+    Base class for the sinks writing through pyarrow, each chunk is written as one record batch
+    """
+
+    def __init__(self, file_path, columns, chunk_size=1000, position=None):
+        super(_ArrowSink, self).__init__(file_path, columns, chunk_size)
+        if position is not None:
+            raise SinkNotAvailable("{} can not be resumed".format(type(self).__name__))
+        try:
+            import pyarrow
+        except ImportError:
+            raise SinkNotAvailable("pyarrow is required to write {}".format(file_path))
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([(c, pyarrow.int64() if c in _INTEGER_COLUMNS else
+                                        pyarrow.string() if c in _STRING_COLUMNS else pyarrow.float64())
+                                       for c in columns])
+        self._writer = self._open_writer()
+
+    @abc.abstractmethod
+    def _open_writer(self):
+        """
+        :return: pyarrow writer of the file
+        """
+
+    def _write_chunk(self, rows):
+        arrays = [self._pa.array([row[n] for row in rows], type=field.type) for n, field in enumerate(self._schema)]
+        self._writer.write_batch(self._pa.RecordBatch.from_arrays(arrays, schema=self._schema))
+
+    def close(self):
+        super(_ArrowSink, self).close()
+        self._writer.close()
+
+
+class ParquetSink(_ArrowSink):
+    """
+    Writes the results as a Parquet file, one row group per chunk
+    """
+
+    def _open_writer(self):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(self.file_path, self._schema)
+
+
+class ArrowSink(_ArrowSink):
+    """
+    Writes the results as an Arrow IPC (Feather v2) file
+    """
+
+    def _open_writer(self):
+        import pyarrow.ipc
+        return pyarrow.ipc.new_file(self.file_path, self._schema)
+
+
+# Results stores are directories written by simulate.store.StoreSink
+STORE_EXTENSION = ".store"
+
+SINKS = {".csv": CSVSink, ".parquet": ParquetSink, ".arrow": ArrowSink, ".feather": ArrowSink}
+
+
+def sink_class(file_path):
+    """
+    :param file_path (str): file to write the results to
+    :return (type): the ResultSink subclass writing files with the extension of file_path
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == STORE_EXTENSION:
+        from mendelianPea.simulate.store import StoreSink
+        return StoreSink
+    if extension not in SINKS:
+        raise SinkNotAvailable("No result sink for {} files, expected one of {}".format(
+            extension, list(SINKS) + [STORE_EXTENSION]))
+    return SINKS[extension]
+
+
+def open_sink(file_path, columns, chunk_size=1000, position=None, scenario=None):
+    """
+    Opens the sink matching the extension of the file
+    :param file_path (str): file to write the results to
+    :param columns (list): column names of a row
+    :param chunk_size (int): number of rows buffered before they are written
+    :param position: position returned by ResultSink.position to resume writing an existing file from,
+                     only CSV files and results stores can be resumed
+    :param scenario (str): name of the results in a results store (.store), see simulate.store
+    :return (ResultSink):
+    """
+    cls = sink_class(file_path)
+    if os.path.splitext(file_path)[1].lower() == STORE_EXTENSION:
+        return cls(file_path, columns, chunk_size, position, scenario)
+    return cls(file_path, columns, chunk_size, position)
+
+
+def read_results(file_path):
+    """
+    Reads a file written by a sink
+    :param file_path (str): result file
+    :return (DataFrame): the results
+    """
+    import pandas as pd
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".csv":
+        return pd.read_csv(file_path, float_precision="round_trip")
+    if extension == ".parquet":
+        return pd.read_parquet(file_path)
+    if extension in (".arrow", ".feather"):
+        return pd.read_feather(file_path)
+    if extension == STORE_EXTENSION:
+        from mendelianPea.simulate.store import ResultStore
+        return ResultStore(file_path).scenario().frame()
+    raise SinkNotAvailable("No result sink for {} files, expected one of {}".format(
+        extension, list(SINKS) + [STORE_EXTENSION]))
+
+
+def export_xls(result_file, xls_file):
+    """
+    Converts a result file into the workbook layout of Simulate.save_xls: a "Net Results" sheet with the last
+    generation of every iteration, all its loci for the genome engine, and one sheet per iteration
+    :param result_file (str): file written by a sink
+    :param xls_file (str): workbook to write
+    :return:
+    """
+    import pandas as pd
+    results = read_results(result_file)
+    with pd.ExcelWriter(xls_file) as writer:
+        last = results["Generation"] == results.groupby("Iteration")["Generation"].transform("max")
+        results[last].reset_index(drop=True).to_excel(writer, sheet_name="Net Results")
+        for n, df in results.groupby("Iteration"):
+            df.to_excel(writer, sheet_name='iteration_{}'.format(n), index=False)
@@ -0,0 +1,265 @@
+from collections import namedtuple
+import numpy as np
+from mendelianPea.pea.population import COLOR_ALLELES, SHAPE_ALLELES
+
+# Unordered genotype classes per gene: dominant homozygote, heterozygote and recessive homozygote.
+# A pea is one of the 9 combinations, indexed as 3 * color class + shape class.
+NO_OF_GENOTYPES = 9
+# Number of recessive alleles of a gene code
+CODE_TO_CLASS = np.array([0, 1, 1, 2])
+
+HardyWeinberg = namedtuple("HardyWeinberg", ["expected_heterozygote", "observed_heterozygote", "deviation",
+                                             "chi2"])
+
+
+def _hardy_weinberg(counts):
+    """
+    :param counts (ndarray): number of dominant homozygotes, heterozygotes and recessive homozygotes of a gene
+    :return (HardyWeinberg): deviation of the gene from the proportions expected from its allele frequencies
+    """
+    total_count = int(counts.sum())
+    if total_count == 0:
+        return HardyWeinberg(0.0, 0.0, 0.0, 0.0)
+    q = float(counts[1] + 2 * counts[2]) / (2 * total_count)
+    p = 1 - q
+    expected = np.array([p * p, 2 * p * q, q * q]) * total_count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi2 = float(np.sum(np.where(expected > 0, (counts - expected) ** 2 / expected, 0.0)))
+    heterozygote = float(counts[1]) / total_count
+    return HardyWeinberg(2 * p * q, heterozygote, heterozygote - 2 * p * q, chi2)
+
+
+def pea_genotype(pea):
+    """
+    :param pea: a Pea
+    :return (int): unordered genotype index of the pea
+    """
+    color_class = 0 if pea.is_color_dominant_homozygote() else 2 if pea.is_color_recessive_homozygote() else 1
+    shape_class = 0 if pea.is_shape_dominant_homozygote() else 2 if pea.is_shape_recessive_homozygote() else 1
+    return 3 * color_class + shape_class
+
+
+def code_genotypes(color, shape):
+    """
+    :param color (ndarray): color gene codes
+    :param shape (ndarray): shape gene codes
+    :return (ndarray): unordered genotype index of every pea
+    """
+    return 3 * CODE_TO_CLASS[color] + CODE_TO_CLASS[shape]
+
+
+class GenerationStats(object):
+    """
+    Running count of the peas of a generation per unordered genotype. Engines update it as the surviving children
+    are produced so every statistic is read from the 9 counts without going back to the peas.
+    """
+
+    def __init__(self, counts=None):
+        """
+        :param counts (ndarray): count per genotype index, all zero if not supplied
+        """
+        self.counts = np.zeros(NO_OF_GENOTYPES, dtype=np.int64) if counts is None else \
+            np.array(counts, dtype=np.int64)
+
+    @classmethod
+    def from_genotypes(cls, genotypes):
+        """
+        :param genotypes (ndarray): genotype index of every pea
+        :return (GenerationStats):
+        """
+        return cls(np.bincount(genotypes, minlength=NO_OF_GENOTYPES))
+
+    def copy(self):
+        return GenerationStats(self.counts)
+
+    def add(self, genotype, n=1):
+        """
+        :param genotype (int): genotype index
+        :param n (int): number of peas of that genotype to add
+        :return:
+        """
+        self.counts[genotype] += n
+
+    def add_counts(self, counts):
+        """
+        :param counts (ndarray): count per genotype index to add, negative to remove peas
+        :return:
+        """
+        self.counts += counts
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    @property
+    def color_counts(self):
+        """
+        :return (ndarray): number of dominant homozygotes, heterozygotes and recessive homozygotes for color
+        """
+        return self.counts.reshape(3, 3).sum(axis=1)
+
+    @property
+    def shape_counts(self):
+        """
+        :return (ndarray): number of dominant homozygotes, heterozygotes and recessive homozygotes for shape
+        """
+        return self.counts.reshape(3, 3).sum(axis=0)
+
+    def row(self):
+        """
+        :return (list): the statistic columns of Simulate.ITERATION_COLUMNS
+        """
+        total_count = self.total
+        if total_count == 0:
+            return [0] * 11
+        color_counts, shape_counts = self.color_counts, self.shape_counts
+        return [(total_count - color_counts[2]) / total_count, color_counts[2] / total_count,
+                (total_count - shape_counts[2]) / total_count, shape_counts[2] / total_count,
+                color_counts[0] / total_count, color_counts[2] / total_count, color_counts[1] / total_count,
+                shape_counts[0] / total_count, shape_counts[2] / total_count, shape_counts[1] / total_count,
+                total_count]
+
+    def rows(self):
+        """
+        :return (list): the single row of statistic columns, see GenomeStats.rows
+        """
+        return [self.row()]
+
+    def allele_frequencies(self):
+        """
+        :return (dict): frequency of every allele within its gene, 0 for an empty generation
+        """
+        total_count = self.total
+        result = {}
+        for alleles, counts in ((COLOR_ALLELES, self.color_counts), (SHAPE_ALLELES, self.shape_counts)):
+            recessive = float(counts[1] + 2 * counts[2]) / (2 * total_count) if total_count > 0 else 0.0
+            result[alleles[0]] = 1 - recessive if total_count > 0 else 0.0
+            result[alleles[1]] = recessive
+        return result
+
+    def hardy_weinberg(self):
+        """
+        Deviation of every gene from the Hardy-Weinberg proportions expected from its allele frequencies
+        :return (dict): HardyWeinberg per gene, "color" and "shape"
+        """
+        return {"color": _hardy_weinberg(self.color_counts), "shape": _hardy_weinberg(self.shape_counts)}
+
+    def summary(self):
+        """
+        :return (dict): total, genotype counts, allele frequencies and Hardy-Weinberg deviations
+        """
+        return {"total": self.total, "genotype_counts": self.counts.tolist(),
+                "allele_frequencies": self.allele_frequencies(),
+                "hardy_weinberg": {gene: hw._asdict() for gene, hw in self.hardy_weinberg().items()}}
+
+
+class GenomeStats(object):
+    """
+    Number of dominant homozygotes, heterozygotes and recessive homozygotes of every locus of a multi-locus
+    generation, reported as one row per locus
+    """
+    COLUMNS = ["Locus", "Dominant", "Recessive", "Dominant Homozygote", "Recessive Homozygote", "Heterozygote",
+               "Dominant Allele", "Recessive Allele", "Total"]
+
+    def __init__(self, genome, counts=None):
+        """
+        :param genome (Genome): genome definition
+        :param counts (ndarray): (len(genome), 3) genotype counts of every locus, all zero if not supplied
+        """
+        self.genome = genome
+        self.counts = np.zeros((len(genome), 3), dtype=np.int64) if counts is None else \
+            np.array(counts, dtype=np.int64)
+
+    def copy(self):
+        return GenomeStats(self.genome, self.counts)
+
+    @property
+    def total(self):
+        return int(self.counts[0].sum())
+
+    def rows(self):
+        """
+        :return (list): one row of GenomeStats.COLUMNS per locus
+        """
+        total_count = self.total
+        if total_count == 0:
+            return [[name] + [0] * (len(GenomeStats.COLUMNS) - 1) for name in self.genome.names]
+        frequencies = self.counts / total_count
+        recessive_allele = (self.counts[:, 1] + 2 * self.counts[:, 2]) / (2 * total_count)
+        return [[name, 1 - f[2], f[2], f[0], f[2], f[1], 1 - q, q, total_count]
+                for name, f, q in zip(self.genome.names, frequencies.tolist(), recessive_allele.tolist())]
+
+    def allele_frequencies(self):
+        """
+        :return (dict): frequency of every allele within its locus, keyed by locus name and allele
+        """
+        total_count = self.total
+        recessive = (self.counts[:, 1] + 2 * self.counts[:, 2]) / (2 * total_count) if total_count > 0 else \
+            np.zeros(len(self.counts))
+        return {locus.name: {locus.alleles[0]: 1 - q if total_count > 0 else 0.0, locus.alleles[1]: q}
+                for locus, q in zip(self.genome.loci, recessive.tolist())}
+
+    def hardy_weinberg(self):
+        """
+        :return (dict): HardyWeinberg of every locus, keyed by locus name
+        """
+        return {name: _hardy_weinberg(counts) for name, counts in zip(self.genome.names, self.counts)}
+
+    def summary(self):
+        """
+        :return (dict): total, allele frequencies and Hardy-Weinberg deviations
+        """
+        return {"total": self.total, "allele_frequencies": self.allele_frequencies(),
+                "hardy_weinberg": {name: hw._asdict() for name, hw in self.hardy_weinberg().items()}}
+
+
+class DemeStats(object):
+    """
+    Genotype counts of a generation split in demes, reported as one row for the whole population (deme
+    GLOBAL_DEME) followed by one row per deme
+    """
+    GLOBAL_DEME = "all"
+
+    def __init__(self, names, demes):
+        """
+        :param names (list): deme names
+        :param demes (list): GenerationStats of every deme
+        """
+        self.names = names
+        self.demes = demes
+        self.population = GenerationStats(np.sum([deme.counts for deme in demes], axis=0))
+
+    def copy(self):
+        return DemeStats(self.names, [deme.copy() for deme in self.demes])
+
+    @property
+    def counts(self):
+        return self.population.counts
+
+    @property
+    def total(self):
+        return self.population.total
+
+    def rows(self):
+        """
+        :return (list): the deme name followed by the statistic columns of Simulate.ITERATION_COLUMNS, for the whole
+                        population then for every deme
+        """
+        return [[DemeStats.GLOBAL_DEME] + self.population.row()] + \
+            [[name] + deme.row() for name, deme in zip(self.names, self.demes)]
+
+    def allele_frequencies(self):
+        return self.population.allele_frequencies()
+
+    def hardy_weinberg(self):
+        return self.population.hardy_weinberg()
+
+    def summary(self):
+        """
+        :return (dict): GenerationStats.summary of the whole population, with the total and allele frequencies of
+                        every deme
+        """
+        result = self.population.summary()
+        result["demes"] = {name: {"total": deme.total, "allele_frequencies": deme.allele_frequencies()}
+                           for name, deme in zip(self.names, self.demes)}
+        return result
@@ -0,0 +1,356 @@
+import os
+import json
+import shutil
+import warnings
+import numpy as np
+from mendelianPea.simulate.sink import ResultSink, SinkNotAvailable, _INTEGER_COLUMNS, _STRING_COLUMNS
+
+DEFAULT_SCENARIO = "default"
+
+# Fixed width little endian encoding of the columns, strings (the genome Locus, the Deme) are stored as codes
+_INTEGER_DTYPE = "<i8"
+_FLOAT_DTYPE = "<f8"
+_CODE_DTYPE = "<i4"
+# Every iteration of the index: its number, first row and end row
+_INDEX_FILE = "index.i8"
+_META_FILE = "meta.json"
+
+
+class InvalidQuery(Exception):
+    pass
+
+
+def _dtype(column):
+    return _INTEGER_DTYPE if column in _INTEGER_COLUMNS else _CODE_DTYPE if column in _STRING_COLUMNS else \
+        _FLOAT_DTYPE
+
+
+def _column_file(column):
+    return column.replace(" ", "_") + ".col"
+
+
+def _write_json(file_path, data):
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "w") as json_file:
+        json.dump(data, json_file, indent=2)
+    os.replace(tmp_path, file_path)
+
+
+class StoreSink(ResultSink):
+    """
+    Writes the results of one scenario into a results store (see ResultStore): one fixed width binary file per
+    column, appended to chunk by chunk, and an index of the rows of every iteration written on close. Writing a
+    scenario again replaces it.
+    """
+    RESUMABLE = True
+
+    def __init__(self, file_path, columns, chunk_size=1000, position=None, scenario=None):
+        """
+        :param file_path (str): store directory, created when needed
+        :param columns (list): column names of a row
+        :param chunk_size (int): number of rows buffered before they are written
+        :param position (int): number of rows to keep when resuming the scenario, see ResultSink.position
+        :param scenario (str): name of the results in the store
+        """
+        super(StoreSink, self).__init__(file_path, columns, chunk_size)
+        self.scenario = scenario or DEFAULT_SCENARIO
+        self.directory = os.path.join(file_path, self.scenario)
+        self.rows = 0
+        self.codes = {}
+        if position is None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory)
+        else:
+            with open(os.path.join(self.directory, _META_FILE)) as json_file:
+                meta = json.load(json_file)
+            self.codes = {value: code for code, value in enumerate(meta["codes"])}
+            self.rows = position
+            for column in columns:
+                with open(os.path.join(self.directory, _column_file(column)), "r+b") as f:
+                    f.truncate(position * np.dtype(_dtype(column)).itemsize)
+        self._files = [open(os.path.join(self.directory, _column_file(column)), "ab") for column in columns]
+        self._write_meta()
+
+    def _encode(self, value):
+        if value not in self.codes:
+            self.codes[value] = len(self.codes)
+        return self.codes[value]
+
+    def _write_chunk(self, rows):
+        for n, (column, f) in enumerate(zip(self.columns, self._files)):
+            values = [row[n] for row in rows]
+            if column in _STRING_COLUMNS:
+                values = [self._encode(value) for value in values]
+            np.asarray(values, dtype=_dtype(column)).tofile(f)
+            f.flush()
+        self.rows += len(rows)
+        self._write_meta()
+
+    def _write_meta(self, indexed=False):
+        _write_json(os.path.join(self.directory, _META_FILE),
+                    {"columns": self.columns, "dtypes": [_dtype(column) for column in self.columns],
+                     "files": [_column_file(column) for column in self.columns], "rows": self.rows,
+                     "codes": sorted(self.codes, key=self.codes.get), "indexed": indexed})
+
+    def position(self):
+        self.flush()
+        return self.rows
+
+    def close(self):
+        super(StoreSink, self).close()
+        for f in self._files:
+            f.close()
+        Scenario.build_index(self.directory)
+        self._write_meta(indexed=True)
+
+
+class Scenario(object):
+    """
+    The results of one scenario in a results store. Columns are memory mapped when first used, queries look the rows
+    up in the (iteration, generation) index and only read the pages of the columns holding them.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory (str): scenario directory of a store
+        """
+        self.directory = directory
+        self.name = os.path.basename(directory)
+        with open(os.path.join(directory, _META_FILE)) as json_file:
+            meta = json.load(json_file)
+        self.columns = meta["columns"]
+        self.rows = meta["rows"]
+        self._dtypes = dict(zip(self.columns, meta["dtypes"]))
+        self._files = dict(zip(self.columns, meta["files"]))
+        self.loci = meta["codes"]
+        self._maps = {}
+        if not meta["indexed"]:
+            # The run was interrupted before the sink was closed
+            Scenario.build_index(directory, self.rows)
+        index = np.fromfile(os.path.join(directory, _INDEX_FILE), dtype=_INTEGER_DTYPE).reshape(-1, 3)
+        self.iterations, self._starts, self._stops = index[:, 0], index[:, 1], index[:, 2]
+        # Every generation has one row per locus or deme, in the same order
+        self.rows_per_generation = max(len(self.loci), 1)
+        self._positions = {iteration: n for n, iteration in enumerate(self.iterations.tolist())}
+
+    @staticmethod
+    def build_index(directory, rows=None):
+        """
+        Writes the index of the rows of every iteration, the rows of an iteration being consecutive
+        :param directory (str): scenario directory
+        :param rows (int): number of rows to index, all the rows of the Iteration column if None
+        :return:
+        """
+        iterations = np.fromfile(os.path.join(directory, _column_file("Iteration")), dtype=_INTEGER_DTYPE)
+        iterations = iterations[:rows]
+        if len(iterations) > 0:
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(iterations)) + 1))
+        else:
+            starts = np.empty(0, dtype=np.int64)
+        stops = np.append(starts[1:], len(iterations)) if len(starts) > 0 else starts
+        index = np.column_stack((iterations[starts], starts, stops)).astype(_INTEGER_DTYPE)
+        index.tofile(os.path.join(directory, _INDEX_FILE))
+
+    def column(self, column):
+        """
+        :param column (str): column name
+        :return (numpy memmap): every value of the column, the Locus column holds codes into self.loci
+        """
+        if column not in self._maps:
+            if column not in self._dtypes:
+                raise InvalidQuery("No column {} in scenario {}, expected one of {}".format(column, self.name,
+                                                                                           self.columns))
+            path = os.path.join(self.directory, self._files[column])
+            self._maps[column] = np.memmap(path, dtype=self._dtypes[column], mode="r", shape=(self.rows,)) \
+                if self.rows > 0 else np.empty(0, dtype=self._dtypes[column])
+        return self._maps[column]
+
+    def _locus_offset(self, locus):
+        if locus is None:
+            if len(self.loci) > 1:
+                raise InvalidQuery("Scenario {} has the loci {}, a locus is needed".format(self.name, self.loci))
+            return 0
+        if locus not in self.loci:
+            raise InvalidQuery("No locus {} in scenario {}, expected one of {}".format(locus, self.name, self.loci))
+        return self.loci.index(locus)
+
+    def _iteration_positions(self, iterations):
+        if iterations is None:
+            return np.arange(len(self.iterations))
+        try:
+            return np.array([self._positions[iteration] for iteration in iterations], dtype=np.int64)
+        except KeyError as e:
+            raise InvalidQuery("No iteration {} in scenario {}".format(e, self.name))
+
+    def generations(self, iterations=None):
+        """
+        :param iterations (list): iterations, all of them if None
+        :return (ndarray): number of generations of every iteration, fewer than asked when the population died
+        """
+        positions = self._iteration_positions(iterations)
+        return (self._stops[positions] - self._starts[positions]) // self.rows_per_generation
+
+    def row_numbers(self, iterations=None, generations=None, locus=None):
+        """
+        Looks the rows up in the index without reading any column
+        :param iterations (list): iterations, all of them if None
+        :param generations (list): generations, all of them if None
+        :param locus (str): locus of the genome engine results, all of them if None
+        :return (ndarray): row numbers ordered by iteration, generation and locus
+        """
+        positions = self._iteration_positions(iterations)
+        lengths = self.generations(self.iterations[positions])
+        if generations is None:
+            generations = np.arange(1, lengths.max() + 1 if len(lengths) > 0 else 1)
+        generations = np.asarray(generations, dtype=np.int64)
+        rows = self._starts[positions][:, None] + (generations[None, :] - 1) * self.rows_per_generation
+        valid = (generations[None, :] >= 1) & (generations[None, :] <= lengths[:, None])
+        rows = rows[valid]
+        if locus is None:
+            return (rows[:, None] + np.arange(self.rows_per_generation)[None, :]).ravel()
+        return rows + self._locus_offset(locus)
+
+    def select(self, columns=None, iterations=None, generations=None, locus=None):
+        """
+        :param columns (list): columns to read, all of them if None
+        :param iterations (list): iterations, all of them if None
+        :param generations (list): generations, all of them if None
+        :param locus (str): locus of the genome engine results, all of them if None
+        :return (dict): column name to the array of its values on the selected rows, Locus as the locus names
+        """
+        rows = self.row_numbers(iterations, generations, locus)
+        return self._read(columns, rows)
+
+    def _read(self, columns, rows):
+        result = {}
+        for column in columns or self.columns:
+            values = np.asarray(self.column(column)[rows])
+            result[column] = np.array(self.loci, dtype=object)[values] if column in _STRING_COLUMNS else values
+        return result
+
+    def final(self, columns=None, locus=None):
+        """
+        The last generation of every iteration, the "Net Results" sheet of Simulate.save_xls
+        :param columns (list): columns to read, all of them if None
+        :param locus (str): locus of the genome engine results, all of them if None
+        :return (dict): column name to the array of its values
+        """
+        rows = self._stops - self.rows_per_generation
+        if locus is None:
+            rows = (rows[:, None] + np.arange(self.rows_per_generation)[None, :]).ravel()
+        else:
+            rows = rows + self._locus_offset(locus)
+        return self._read(columns, rows)
+
+    def matrix(self, column, generations=None, locus=None):
+        """
+        :param column (str): column to read
+        :param generations (list): generations, all of them if None
+        :param locus (str): locus of the genome engine results, needed when there are several
+        :return (ndarray): (iterations, generations) values, NaN for the generations after the population died
+        """
+        offset = self._locus_offset(locus)
+        lengths = self.generations()
+        if generations is None:
+            generations = np.arange(1, lengths.max() + 1 if len(lengths) > 0 else 1)
+        generations = np.asarray(generations, dtype=np.int64)
+        rows = self._starts[:, None] + (generations[None, :] - 1) * self.rows_per_generation + offset
+        valid = (generations[None, :] >= 1) & (generations[None, :] <= lengths[:, None])
+        result = np.full(rows.shape, np.nan)
+        result[valid] = self.column(column)[rows[valid]]
+        return result
+
+    def aggregate(self, column, statistics=("mean", "std"), quantiles=(), generations=None, locus=None):
+        """
+        Aggregates of a column over the iterations, per generation. Iterations whose population died are left out of
+        the generations after it.
+        :param column (str): column to aggregate
+        :param statistics (tuple): any of count, mean, std, min and max
+        :param quantiles (tuple): quantiles between 0 and 1
+        :param generations (list): generations, all of them if None
+        :param locus (str): locus of the genome engine results, needed when there are several
+        :return (dict): Generation and one array per statistic and quantile (keyed q<quantile>), one value per
+                        generation
+        """
+        values = self.matrix(column, generations, locus)
+        if generations is None:
+            generations = np.arange(1, values.shape[1] + 1)
+        aggregates = {"count": lambda v: np.sum(~np.isnan(v), axis=0), "mean": lambda v: np.nanmean(v, axis=0),
+                      "std": lambda v: np.nanstd(v, axis=0, ddof=1), "min": lambda v: np.nanmin(v, axis=0),
+                      "max": lambda v: np.nanmax(v, axis=0)}
+        result = {"Generation": np.asarray(generations)}
+        with warnings.catch_warnings():
+            # Generations no iteration reached are all NaN, and their aggregates too
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for statistic in statistics:
+                if statistic not in aggregates:
+                    raise InvalidQuery("Unknown statistic {}, expected one of {}".format(statistic, list(aggregates)))
+                result[statistic] = aggregates[statistic](values)
+            for quantile in quantiles:
+                result["q{}".format(quantile)] = np.nanquantile(values, quantile, axis=0)
+        return result
+
+    def frame(self, columns=None, iterations=None, generations=None, locus=None):
+        """
+        :return (DataFrame): the rows of select
+        """
+        import pandas as pd
+        return pd.DataFrame(self.select(columns, iterations, generations, locus), columns=columns or self.columns)
+
+
+class ResultStore(object):
+    """
+    Results store directory written by StoreSink, the sink of the .store output files. Every scenario (by default
+    named after its config file) is a directory of fixed width column files, e.g.
+
+        results.store/no_ext_influence/meta.json, index.i8, Iteration.col, Generation.col, Green.col, ...
+
+    Several configs with the same .store output file write their scenarios side by side.
+    """
+
+    def __init__(self, file_path):
+        """
+        :param file_path (str): store directory
+        """
+        if not os.path.isdir(file_path):
+            raise SinkNotAvailable("No results store at {}".format(file_path))
+        self.file_path = file_path
+        self._scenarios = {}
+
+    @property
+    def scenarios(self):
+        """
+        :return (list): names of the scenarios of the store
+        """
+        return sorted(name for name in os.listdir(self.file_path)
+                      if os.path.exists(os.path.join(self.file_path, name, _META_FILE)))
+
+    def scenario(self, name=None):
+        """
+        :param name (str): scenario name, may be left out when the store holds a single scenario
+        :return (Scenario):
+        """
+        if name is None:
+            scenarios = self.scenarios
+            if len(scenarios) != 1:
+                raise InvalidQuery("The store has the scenarios {}, a name is needed".format(scenarios))
+            name = scenarios[0]
+        if name not in self._scenarios:
+            if name not in self.scenarios:
+                raise InvalidQuery("No scenario {} in {}, expected one of {}".format(name, self.file_path,
+                                                                                    self.scenarios))
+            self._scenarios[name] = Scenario(os.path.join(self.file_path, name))
+        return self._scenarios[name]
+
+    def __getitem__(self, name):
+        return self.scenario(name)
+
+    def aggregate(self, column, statistics=("mean", "std"), quantiles=(), generations=None, locus=None,
+                  scenarios=None):
+        """
+        Scenario.aggregate for several scenarios
+        :param scenarios (list): scenario names, all of them if None
+        :return (dict): scenario name to its aggregates
+        """
+        return {name: self.scenario(name).aggregate(column, statistics, quantiles, generations, locus)
+                for name in (scenarios or self.scenarios)}
@@ -0,0 +1,26 @@
+import unittest
+import numpy as np
+from mendelianPea.pea.pea import Pea
+from mendelianPea.simulate.simulate import Simulate
+
+ADVANTAGE = {"y": 0.1, "G": 0.15, "w": 0.1, "R": 0.01}
+
+
+class AnalyticTest(unittest.TestCase):
+
+    def test_exact_mode_matches_monte_carlo(self):
+        simulation = Simulate([Pea.get_hetrozygote()] * 4, 1, 4, 0.4, ADVANTAGE, engine="counts")
+        result = simulation.run_analytic()
+        self.assertTrue(result.exact)
+        simulation.run_iterations(3000, seed=1)
+        rows = np.array(simulation.iteration_result_rows, dtype=float)
+        # Green and Total of the last generation, within 4 standard errors of the Monte Carlo means
+        for column, expected in ((2, result.expected[-1][0]), (12, result.expected[-1][10])):
+            samples = rows[:, column]
+            error = samples.std() / np.sqrt(len(samples))
+            self.assertLess(abs(samples.mean() - expected), 4 * error, Simulate.ITERATION_COLUMNS[column])
+        self.assertAlmostEqual(rows[:, 12].var() / result.variance[-1][10], 1, delta=0.15)
+
+
+if __name__ == "__main__":
+    unittest.main()
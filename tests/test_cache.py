@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from mendelianPea.pea.pea import Pea
+from mendelianPea.simulate.simulate import Simulate
+from mendelianPea.simulate.cache import ResultCache
+
+ADVANTAGE = {"y": 0.1, "G": 0.15, "w": 0.1, "R": 0.01}
+
+
+def _simulation():
+    return Simulate([Pea.get_hetrozygote()] * 10, 5, 4, 0.35, ADVANTAGE, engine="vectorized")
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_cached_results_match_uncached(self):
+        uncached = _simulation()
+        uncached.run_iterations(6, seed=5)
+        # Cold, then partly and fully cached runs
+        for iterations, hits in ((4, 0), (6, 4), (6, 6)):
+            cache = ResultCache(self.directory.name)
+            simulation = _simulation()
+            simulation.run_iterations(iterations, seed=5, cache=cache)
+            self.assertEqual(cache.hits, hits)
+            self.assertEqual(simulation.generation_result_rows, uncached.generation_result_rows[:iterations])
+            self.assertEqual(simulation.iteration_result_rows, uncached.iteration_result_rows[:iterations])
+
+    def test_engine_revision_is_part_of_the_key(self):
+        cache = ResultCache(self.directory.name)
+        simulation = _simulation()
+        key = cache.key(simulation, 5)
+        with mock.patch.dict(Simulate.ENGINE_REVISION, {Simulate.VECTORIZED_ENGINE: 2}):
+            self.assertNotEqual(cache.key(simulation, 5), key)
+        self.assertEqual(cache.key(simulation, 5), key)
+
+    def test_evict_removes_empty_directories(self):
+        _simulation().run_iterations(2, seed=5, cache=ResultCache(self.directory.name))
+        self.assertEqual(ResultCache(self.directory.name, max_bytes=0).evict(), 2)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import filecmp
+import tempfile
+import unittest
+from mendelianPea.run import SimulationConfig, run_serial
+from mendelianPea.pea.pea import Pea
+from mendelianPea.simulate.simulate import Simulate
+from mendelianPea.simulate.checkpoint import Checkpoint, InvalidCheckpoint
+from mendelianPea.simulate.sink import open_sink, SinkNotAvailable
+
+ADVANTAGE = {"y": 0.1, "G": 0.15, "w": 0.1, "R": 0.01}
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedCheckpoint(Checkpoint):
+    """
+    Checkpoint stopping the run right after its n-th snapshot, as a killed run would
+    """
+
+    def __init__(self, file_path, every_generations, n):
+        super(InterruptedCheckpoint, self).__init__(file_path, every_generations)
+        self.n = n
+
+    def save(self, *args):
+        super(InterruptedCheckpoint, self).save(*args)
+        self.n -= 1
+        if self.n == 0:
+            raise Interrupted()
+
+
+def _simulation(no_of_generations=6):
+    return Simulate([Pea.get_hetrozygote()] * 10, no_of_generations, 4, 0.35, ADVANTAGE, engine="vectorized")
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def interrupt(self, n=3):
+        # Runs until the n-th snapshot and returns it
+        sink = open_sink(self.path("run.csv"), Simulate.ITERATION_COLUMNS, chunk_size=3)
+        with self.assertRaises(Interrupted):
+            _simulation().run_iterations(5, seed=3, sink=sink,
+                                         checkpoint=InterruptedCheckpoint(self.path("run.ckpt"), 4, n))
+        return Checkpoint(self.path("run.ckpt"), every_generations=4)
+
+    def test_resumed_run_matches_uninterrupted_csv(self):
+        with open_sink(self.path("reference.csv"), Simulate.ITERATION_COLUMNS) as sink:
+            _simulation().run_iterations(5, seed=3, sink=sink)
+        for n in (1, 3, 5):
+            checkpoint = self.interrupt(n)
+            state = checkpoint.load()
+            with open_sink(self.path("run.csv"), Simulate.ITERATION_COLUMNS, position=state["sink_position"]) as sink:
+                _simulation().run_iterations(5, sink=sink, checkpoint=checkpoint, resume_state=state)
+            self.assertTrue(filecmp.cmp(self.path("reference.csv"), self.path("run.csv"), shallow=False))
+            self.assertFalse(os.path.exists(self.path("run.ckpt")))
+
+    def test_resume_refuses_another_scenario(self):
+        checkpoint = self.interrupt()
+        state = checkpoint.load()
+        with self.assertRaises(InvalidCheckpoint):
+            _simulation(no_of_generations=7).run_iterations(5, checkpoint=checkpoint, resume_state=state)
+
+    def test_refuses_checkpointing_outputs_that_can_not_be_resumed(self):
+        data = {"no-of-iterations": 2, "no-of-generations-per-iteration": 3, "engine": "vectorized",
+                "output-location": self.directory.name}
+        configs = [SimulationConfig("csv", 1, dict(data, **{"output-file": "run.csv"})),
+                   SimulationConfig("parquet", 1, dict(data, **{"output-file": "run.parquet"}))]
+        with self.assertRaises(SinkNotAvailable):
+            run_serial(configs, 1, checkpoint_every=2)
+        # Refused before any config runs
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import numpy as np
+from mendelianPea.pea.population import PeaPopulation
+from mendelianPea.simulate.lineage import Lineage, GENES
+
+
+def _reference_lineages(history, gene):
+    """
+    :param history (list): (parent1, parent2, picks) recorded every generation
+    :param gene (str): color or shape
+    :return (list): number of copies of every generation with descendants in the last one, from the unpruned parents
+    """
+    n = GENES.index(gene)
+    parents = []
+    for parent1, parent2, picks in history:
+        copies = np.empty(2 * len(parent1), dtype=np.int64)
+        copies[0::2] = 2 * parent1 + picks[2 * n]
+        copies[1::2] = 2 * parent2 + picks[2 * n + 1]
+        parents.append(copies)
+    alive = np.arange(len(parents[-1]))
+    counts = [len(alive)]
+    for copies in reversed(parents):
+        alive = np.unique(copies[alive])
+        counts.append(len(alive))
+    return counts[::-1]
+
+
+class LineageTest(unittest.TestCase):
+
+    def test_simplify_prunes_generations_never_simplified(self):
+        # Every copy of generation 1 is used by generation 2 but only founder copy 0 is used by generation 1
+        lineage = Lineage(PeaPopulation.from_codes(np.array([1, 1], dtype=np.uint8), np.array([1, 1], dtype=np.uint8)),
+                          simplify_every=100)
+        lineage.record(np.array([0, 0]), np.array([0, 0]), np.zeros((4, 2), dtype=np.uint8))
+        lineage.record(np.array([0, 0]), np.array([1, 1]), np.array([[0, 1]] * 4, dtype=np.uint8))
+        self.assertEqual(lineage.lineages("color").tolist(), [1, 4, 4])
+        self.assertEqual(lineage.common_ancestor_generation("color"), 0)
+
+    def test_pruned_counts_across_simplify_calls(self):
+        rng = np.random.default_rng(3)
+        founders = PeaPopulation.from_codes(rng.integers(0, 4, 30).astype(np.uint8),
+                                            rng.integers(0, 4, 30).astype(np.uint8))
+        lineage = Lineage(founders, simplify_every=3)
+        history, size = [], len(founders)
+        for generation in range(1, 25):
+            # A small generation followed by a large one usually passes on all its copies
+            children = 8 if generation % 2 else 60
+            record = (rng.integers(0, size, children), rng.integers(0, size, children),
+                      rng.integers(0, 2, (4, children)).astype(np.uint8))
+            lineage.record(*record)
+            history.append(record)
+            size = children
+            if generation % 5 == 0:
+                for gene in GENES:
+                    self.assertEqual(lineage.lineages(gene).tolist(), _reference_lineages(history, gene))
+        for gene in GENES:
+            self.assertEqual(lineage.lineages(gene).tolist(), _reference_lineages(history, gene))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+from mendelianPea.pea.pea import Pea
+from mendelianPea.simulate.simulate import Simulate
+
+ADVANTAGE = {"y": 0.1, "G": 0.15, "w": 0.1, "R": 0.01}
+
+
+class ParallelTest(unittest.TestCase):
+
+    def test_workers_give_identical_results(self):
+        for engine in (Simulate.DATAFRAME_ENGINE, Simulate.VECTORIZED_ENGINE, Simulate.COUNT_ENGINE):
+            results = []
+            for workers in (1, 3):
+                simulation = Simulate([Pea.get_hetrozygote()] * 10, 5, 4, 0.35, ADVANTAGE, engine=engine)
+                simulation.run_iterations(6, seed=11, workers=workers)
+                results.append((simulation.generation_result_rows, simulation.iteration_result_rows))
+            self.assertEqual(results[0], results[1], engine)
+
+
+if __name__ == "__main__":
+    unittest.main()
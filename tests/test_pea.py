@@ -0,0 +1,24 @@
+import unittest
+from mendelianPea.pea.pea import Pea
+
+
+class PeaTest(unittest.TestCase):
+
+    def test_kill_returns_the_dead_pea_and_leaves_the_shared_one_alive(self):
+        pea = Pea(**{"color": "Gy", "shape": "Rw"})
+        dead = pea.kill()
+        self.assertTrue(pea.is_alive)
+        self.assertFalse(dead.is_alive)
+        self.assertIs(dead, Pea(**{"color": "Gy", "shape": "Rw", "is-alive": False}))
+
+    def test_peas_are_immutable(self):
+        pea = Pea(**{"color": "GG", "shape": "RR"})
+        with self.assertRaisesRegex(AttributeError, "kill"):
+            pea.is_alive = False
+        with self.assertRaises(AttributeError):
+            pea.survival = 1
+        self.assertTrue(Pea(**{"color": "GG", "shape": "RR"}).is_alive)
+
+
+if __name__ == "__main__":
+    unittest.main()